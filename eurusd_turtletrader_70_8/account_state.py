@@ -0,0 +1,69 @@
+#####################################################
+# Indexed account value cache.
+#
+# Keeps every account value keyed by (tag, currency, account), current
+# from accountValueEvent, so balances are O(1) dictionary lookups instead
+# of linear scans of ib.accountValues(). Each change bumps a version
+# number. snapshot() freezes the values so one strategy cycle sees a
+# consistent view of the account.
+
+
+#####################################################
+class AccountSnapshot(object):
+    """
+    Frozen account values with typed accessors
+    """
+
+    def __init__(self, values, version, account, base_currency):
+        """Initialize snapshot"""
+        self.values = values
+        self.version = version
+        self.account = account
+        self.base_currency = base_currency
+
+    def get(self, tag, currency='', account=None, default=None):
+        """Returns an account value as its raw string"""
+        if account is None:
+            account = self.account
+        return self.values.get((tag, currency, account), default)
+
+    def get_float(self, tag, currency='', account=None, default=0.0):
+        """Returns an account value as a float"""
+        value = self.get(tag, currency, account)
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return default
+
+
+#####################################################
+class AccountState(AccountSnapshot):
+    """
+    Live account values, kept current from accountValueEvent
+    """
+
+    def __init__(self, ib, account=None):
+        """Initialize from the current account values and subscribe"""
+        AccountSnapshot.__init__(self, {}, 0, account, '')
+        if self.account is None and ib.managedAccounts():
+            self.account = ib.managedAccounts()[0]
+        ib.accountValueEvent += self.on_account_value
+        for value in ib.accountValues():
+            self.on_account_value(value)
+
+    def on_account_value(self, value):
+        """Stores an updated account value"""
+        if self.account is None:
+            self.account = value.account
+        if value.tag == 'AvailableFunds' and value.account == self.account:
+            # Available funds are reported in the account's base currency
+            self.base_currency = value.currency
+        key = (value.tag, value.currency, value.account)
+        if self.values.get(key) != value.value:
+            self.values[key] = value.value
+            self.version += 1
+
+    def snapshot(self):
+        """Returns a frozen copy of the current account values"""
+        return AccountSnapshot(dict(self.values), self.version,
+                               self.account, self.base_currency)
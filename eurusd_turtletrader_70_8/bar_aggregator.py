@@ -0,0 +1,97 @@
+#####################################################
+# Real-time bar aggregation.
+#
+# Subscribes once per contract to TWS 5 second real-time bars and builds
+# minute and hour bars from them locally. A bar is emitted as soon as
+# the 5 second bar that ends it arrives, so there is no history request
+# and no polling at bar boundaries. Bars are aligned to the clock (UTC
+# epoch), as TWS aligns its historical bars.
+import datetime
+from eventkit import Event
+from ib_insync import BarData
+
+# TWS real-time bars are always 5 seconds long
+REALTIME_BAR_SECONDS = 5
+
+
+#####################################################
+def bar_size_minutes(bar_size):
+    """Returns the minutes in a bar size such as '1 min' or '2 hours'"""
+    count, unit = bar_size.split(' ')
+    if unit in ('min', 'mins'):
+        return int(count)
+    if unit in ('hour', 'hours'):
+        return 60 * int(count)
+    raise ValueError('Invalid intraday bar size: {}'.format(bar_size))
+
+
+#####################################################
+class BarAggregator(object):
+    """
+    Builds bars of several sizes from one real-time bar subscription.
+    barEvent emits (contract, bar_size, bar) for each completed bar,
+    where bar is a BarData whose date is the bar's UTC start time.
+    """
+
+    def __init__(self, ib, contract, bar_sizes, what_to_show='MIDPOINT',
+                 use_rth=True):
+        """Initialize aggregator"""
+        self.ib = ib
+        self.contract = contract
+        self.what_to_show = what_to_show
+        self.use_rth = use_rth
+        self.seconds = {b: 60 * bar_size_minutes(b) for b in bar_sizes}
+        self.forming = {}   # bar size -> BarData being built
+        self.barEvent = Event('barEvent')
+        self.realtime_bars = None
+
+    def start(self):
+        """Subscribes to 5 second real-time bars"""
+        if self.realtime_bars is None:
+            self.realtime_bars = self.ib.reqRealTimeBars(
+                self.contract, REALTIME_BAR_SECONDS, self.what_to_show,
+                self.use_rth)
+            self.realtime_bars.updateEvent += self.on_realtime_bars
+
+    def stop(self):
+        """Cancels the real-time bar subscription"""
+        if self.realtime_bars is not None:
+            self.realtime_bars.updateEvent -= self.on_realtime_bars
+            self.ib.cancelRealTimeBars(self.realtime_bars)
+            self.realtime_bars = None
+        self.forming.clear()
+
+    def on_realtime_bars(self, bars, has_new_bar):
+        """Adds the newest 5 second bar to every bar size"""
+        if has_new_bar and bars:
+            bar = bars[-1]
+            # Only the newest bar is needed, so don't let the list grow
+            del bars[:-1]
+            self.add(bar.time, bar.open_, bar.high, bar.low, bar.close)
+
+    def add(self, time, open_, high, low, close):
+        """Adds a 5 second bar starting at time (aware datetime)"""
+        epoch = int(time.timestamp())
+        for bar_size, seconds in self.seconds.items():
+            start = epoch - epoch % seconds
+            bar = self.forming.get(bar_size)
+            if bar is not None and int(bar.date.timestamp()) != start:
+                # A 5 second bar was missed at the end of the last bar
+                self.emit(bar_size)
+                bar = None
+            if bar is None:
+                bar = BarData(date=datetime.datetime.fromtimestamp(
+                                  start, datetime.timezone.utc),
+                              open=open_, high=high, low=low, close=close)
+                self.forming[bar_size] = bar
+            else:
+                bar.high = max(bar.high, high)
+                bar.low = min(bar.low, low)
+                bar.close = close
+            if epoch + REALTIME_BAR_SECONDS >= start + seconds:
+                self.emit(bar_size)
+
+    def emit(self, bar_size):
+        """Emits and clears the bar being built for bar_size"""
+        bar = self.forming.pop(bar_size)
+        self.barEvent.emit(self.contract, bar_size, bar)
@@ -0,0 +1,131 @@
+#####################################################
+# Fixed-capacity bar frames.
+#
+# A BarFrame holds the most recent bars of one instrument/bar size in
+# preallocated NumPy columns. Each column is a ring buffer written twice,
+# at i and i + capacity, so the live rows are always one contiguous
+# slice: appends are O(1) and never copy the frame, and columns can be
+# handed to callers as pandas Series that view the buffer.
+# Views are only valid until the next append.
+import numpy as np
+import pandas as pd
+
+
+#####################################################
+class BarFrame(object):
+    """
+    Ring buffer of bars with OHLC and indicator columns
+    """
+
+    def __init__(self, columns, capacity, timezone=None):
+        """
+        Initialize an empty frame. columns is a list of (name, dtype);
+        bar dates are stored as UTC nanoseconds and shown in timezone.
+        """
+        self.capacity = capacity
+        self.timezone = timezone
+        self.dtypes = dict(columns)
+        self.dates = np.zeros(2 * capacity, dtype='<i8')
+        self.columns = {name: np.zeros(2 * capacity, dtype=dtype)
+                        for name, dtype in columns}
+        self.start = 0
+        self.count = 0
+        self._index = None
+
+    @classmethod
+    def from_frame(cls, df, columns, capacity):
+        """Returns a frame holding the last capacity rows of df"""
+        dtypes = [(c, bool if df[c].dtype == bool else np.float64)
+                  for c in columns]
+        frame = cls(dtypes, capacity, timezone=df.index.tz)
+        tail = df.iloc[-capacity:]
+        n = len(tail)
+        # Index values are UTC (or naive) datetime64s
+        dates = tail.index.values.astype('datetime64[ns]').view('<i8')
+        frame.dates[:n] = dates
+        frame.dates[capacity:capacity + n] = dates
+        for name, values in frame.columns.items():
+            column = tail[name].to_numpy(dtype=values.dtype,
+                                         na_value=values.dtype.type(0)
+                                         if values.dtype == bool else np.nan)
+            values[:n] = column
+            values[capacity:capacity + n] = column
+        frame.count = n
+        return frame
+
+    def __len__(self):
+        """Number of bars held"""
+        return self.count
+
+    def position(self, i):
+        """Returns the buffer slot of row i (negative i counts back)"""
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('Bar {} out of range'.format(i))
+        return (self.start + i) % self.capacity
+
+    def append(self, date, **values):
+        """Adds a bar, dropping the oldest bar when the frame is full"""
+        if self.count == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+            self.count -= 1
+        self.count += 1
+        slot = self.position(-1)
+        stamp = pd.Timestamp(date)
+        if stamp.tzinfo is None:
+            stamp = stamp.tz_localize('UTC')
+        self.dates[slot] = self.dates[slot + self.capacity] = stamp.value
+        for name, column in self.columns.items():
+            value = values.get(name, False if column.dtype == bool
+                               else np.nan)
+            column[slot] = column[slot + self.capacity] = value
+        self._index = None
+
+    def truncate(self, date):
+        """Drops the most recent bars dated at or after date"""
+        self.count = int(self.index.searchsorted(date, side='left'))
+        self._index = None
+
+    @property
+    def index(self):
+        """Bar dates as a DatetimeIndex"""
+        if self._index is None:
+            dates = self.dates[self.start:self.start + self.count]
+            index = pd.DatetimeIndex(dates.view('datetime64[ns]'))
+            index = index.tz_localize('UTC')
+            if self.timezone is not None:
+                index = index.tz_convert(self.timezone)
+            self._index = index
+        return self._index
+
+    def values(self, name):
+        """Returns a column's live rows as an array view"""
+        return self.columns[name][self.start:self.start + self.count]
+
+    def __getitem__(self, name):
+        """Returns a column as a Series viewing the buffer"""
+        return pd.Series(self.values(name), index=self.index, name=name,
+                         copy=False)
+
+    def __setitem__(self, name, value):
+        """Sets a column's live rows from a scalar or array"""
+        if name not in self.columns:
+            self.columns[name] = np.zeros(2 * self.capacity,
+                                          dtype=np.asarray(value).dtype)
+            self.dtypes[name] = self.columns[name].dtype
+        column = self.columns[name]
+        slots = (self.start + np.arange(self.count)) % self.capacity
+        column[slots] = column[slots + self.capacity] = value
+
+    def row(self, i):
+        """Returns bar i as a dict, with its date"""
+        slot = self.position(i)
+        row = {name: column[slot] for name, column in self.columns.items()}
+        row['date'] = self.index[i]
+        return row
+
+    def to_frame(self):
+        """Returns a copy of the live rows as a DataFrame"""
+        return pd.DataFrame({name: self.values(name).copy()
+                             for name in self.columns}, index=self.index)
@@ -0,0 +1,281 @@
+#####################################################
+# Local persistent bar store.
+#
+# Bars are stored column by column as raw little-endian arrays in one
+# directory per (conId, bar size, whatToShow, useRTH):
+#   <root>/<conId>_<bar size>_<whatToShow>_<RTH|ALL>/{date,open,...}.bin
+# Stored bars are memory-mapped on read, and only the missing tail (from
+# the last stored bar to now) is requested from TWS. The last stored bar
+# is always re-requested, since it may have still been forming. The tail
+# is never longer than the duration asked for, which TWS accepts for the
+# bar size, and uses 'Y' beyond 365 days. If a longer duration is asked
+# for than the series was stored with, the missing head is requested
+# too, ending at the first stored bar, and merged in front. start.bin records how far back a series has been
+# requested, so history TWS does not have is not asked for again.
+# Intraday bar times are stored in UTC; naive times from TWS are taken to
+# be in the store's timezone (the TWS timezone).
+import datetime
+import math
+import os
+import numpy as np
+import pandas as pd
+
+COLUMNS = [('date', '<i8'),  # seconds since epoch
+           ('open', '<f8'),
+           ('high', '<f8'),
+           ('low', '<f8'),
+           ('close', '<f8')]
+
+DURATION_UNITS = {'S': datetime.timedelta(seconds=1),
+                  'D': datetime.timedelta(days=1),
+                  'W': datetime.timedelta(weeks=1),
+                  'M': datetime.timedelta(days=31),
+                  'Y': datetime.timedelta(days=366)}
+
+
+#####################################################
+def parse_duration(duration):
+    """Returns an IB duration string ('6 M', '1 D', ...) as a timedelta"""
+    count, unit = duration.split(' ')
+    if unit not in DURATION_UNITS:
+        raise ValueError('Invalid duration: {}'.format(duration))
+    return int(count) * DURATION_UNITS[unit]
+
+
+#####################################################
+def tail_duration(gap, bar_size, duration):
+    """
+    Returns the smallest IB duration string covering a timedelta, or
+    duration if the gap is at least as long
+    """
+    if gap >= parse_duration(duration):
+        return duration
+    seconds = max(int(math.ceil(gap.total_seconds())), 60)
+    if seconds <= 86400 and bar_size not in ['1 day', '1 week', '1 month']:
+        return '{} S'.format(seconds)
+    days = int(math.ceil(seconds / 86400.0))
+    if days <= 365:
+        return '{} D'.format(days)
+    # TWS takes at most 365 D
+    return '{} Y'.format(int(math.ceil(days / 365.0)))
+
+
+#####################################################
+def utc_now():
+    """Returns the current UTC time as a naive datetime"""
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+#####################################################
+def to_epoch(date, timezone=None):
+    """Returns a bar date/datetime as seconds since epoch (UTC)"""
+    timestamp = pd.Timestamp(date)
+    if isinstance(date, datetime.datetime) and timestamp.tzinfo is None \
+       and timezone is not None:
+        timestamp = timestamp.tz_localize(timezone)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert('UTC').tz_localize(None)
+    return int(timestamp.value // 10**9)
+
+
+#####################################################
+class BarStore(object):
+    """
+    On-disk columnar store of historical bars, topped up from TWS
+    """
+
+    def __init__(self, ib, root='bar_store', timezone=None):
+        """Initialize store in directory root"""
+        self.ib = ib
+        self.root = root
+        self.timezone = timezone
+
+    def path(self, contract, bar_size, what_to_show, use_rth):
+        """Returns the directory holding a series"""
+        name = '{}_{}_{}_{}'.format(contract.conId,
+                                    bar_size.replace(' ', ''),
+                                    what_to_show,
+                                    'RTH' if use_rth else 'ALL')
+        return os.path.join(self.root, name)
+
+    def count(self, path):
+        """Returns the number of bars stored in a series"""
+        try:
+            return os.path.getsize(os.path.join(path, 'date.bin')) // 8
+        except OSError:
+            return 0
+
+    def read(self, path):
+        """Returns a series' columns as read-only memory maps"""
+        count = self.count(path)
+        columns = {}
+        for name, dtype in COLUMNS:
+            if count == 0:
+                columns[name] = np.empty(0, dtype=dtype)
+            else:
+                columns[name] = np.memmap(os.path.join(path, name + '.bin'),
+                                          dtype=dtype, mode='r',
+                                          shape=(count,))
+        return columns
+
+    def write(self, path, bars):
+        """Replaces stored bars from the first new bar onwards"""
+        if len(bars) == 0:
+            return
+        os.makedirs(path, exist_ok=True)
+        new = {'date': np.array([to_epoch(b.date, self.timezone)
+                                 for b in bars], dtype='<i8')}
+        for name, dtype in COLUMNS[1:]:
+            new[name] = np.array([getattr(b, name) for b in bars],
+                                 dtype=dtype)
+
+        # Drop stored bars that the new bars overlap
+        columns = self.read(path)
+        keep = int(np.searchsorted(columns['date'], new['date'][0],
+                                   side='left'))
+        # Written to .tmp files first, so a crash part way through
+        # cannot leave columns of different lengths
+        for name, dtype in COLUMNS:
+            filename = os.path.join(path, name + '.bin')
+            with open(filename + '.tmp', 'wb') as f:
+                f.write(np.asarray(columns[name][:keep]).tobytes())
+                f.write(new[name].tobytes())
+        del columns
+        for name, dtype in COLUMNS:
+            filename = os.path.join(path, name + '.bin')
+            os.replace(filename + '.tmp', filename)
+
+    def write_head(self, path, bars):
+        """Adds bars before the first stored bar in front of the series"""
+        columns = self.read(path)
+        dates = np.array([to_epoch(b.date, self.timezone) for b in bars],
+                         dtype='<i8')
+        head = dates < columns['date'][0] if len(columns['date']) > 0 \
+            else np.ones(len(dates), dtype=bool)
+        if not head.any():
+            return
+        new = {'date': dates[head]}
+        for name, dtype in COLUMNS[1:]:
+            new[name] = np.array([getattr(b, name) for b in bars],
+                                 dtype=dtype)[head]
+        for name, dtype in COLUMNS:
+            filename = os.path.join(path, name + '.bin')
+            with open(filename + '.tmp', 'wb') as f:
+                f.write(new[name].tobytes())
+                f.write(np.asarray(columns[name]).tobytes())
+        del columns
+        for name, dtype in COLUMNS:
+            filename = os.path.join(path, name + '.bin')
+            os.replace(filename + '.tmp', filename)
+
+    def requested_start(self, path):
+        """Returns how far back a series has been requested, or None"""
+        try:
+            with open(os.path.join(path, 'start.bin'), 'rb') as f:
+                return int(np.frombuffer(f.read(), dtype='<i8')[0])
+        except (OSError, IndexError):
+            dates = self.read(path)['date']
+            return int(dates[0]) if len(dates) > 0 else None
+
+    def set_requested_start(self, path, start):
+        """Records how far back a series has been requested"""
+        if not os.path.isdir(path):
+            return
+        previous = self.requested_start(path)
+        if previous is not None:
+            start = min(start, previous)
+        with open(os.path.join(path, 'start.bin'), 'wb') as f:
+            f.write(np.array([start], dtype='<i8').tobytes())
+
+    def head_request(self, path, bar_size, what_to_show, duration, use_rth):
+        """
+        Returns the request for the bars missing before a stored series,
+        or None, and the start of duration in seconds since epoch
+        """
+        start = utc_now() - parse_duration(duration)
+        start_epoch = to_epoch(start)
+        requested = self.requested_start(path)
+        if requested is None or requested <= start_epoch:
+            return None, start_epoch
+        first = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc) \
+            + datetime.timedelta(seconds=requested)
+        request = dict(endDateTime=first,
+                       durationStr=tail_duration(
+                           first.replace(tzinfo=None) - start, bar_size,
+                           duration),
+                       barSizeSetting=bar_size,
+                       whatToShow=what_to_show,
+                       useRTH=use_rth)
+        return request, start_epoch
+
+    def tail_request(self, contract, bar_size, what_to_show, duration,
+                     use_rth):
+        """Returns a series' path and the request for its missing bars"""
+        path = self.path(contract, bar_size, what_to_show, use_rth)
+        dates = self.read(path)['date']
+        if len(dates) > 0:
+            last = datetime.datetime(1970, 1, 1) \
+                + datetime.timedelta(seconds=int(dates[-1]))
+            duration = tail_duration(utc_now() - last, bar_size, duration)
+        del dates
+        request = dict(endDateTime='',
+                       durationStr=duration,
+                       barSizeSetting=bar_size,
+                       whatToShow=what_to_show,
+                       useRTH=use_rth)
+        return path, request
+
+    def update(self, contract, bar_size, what_to_show, duration, use_rth):
+        """Requests the bars missing from a series and stores them"""
+        path, request = self.tail_request(contract, bar_size, what_to_show,
+                                          duration, use_rth)
+        head, start = self.head_request(path, bar_size, what_to_show,
+                                        duration, use_rth)
+        if head is not None:
+            self.write_head(path, self.ib.reqHistoricalData(contract, **head))
+        self.write(path, self.ib.reqHistoricalData(contract, **request))
+        self.set_requested_start(path, start)
+        return path
+
+    async def update_async(self, contract, bar_size, what_to_show, duration,
+                           use_rth):
+        """As update(), without blocking the event loop"""
+        path, request = self.tail_request(contract, bar_size, what_to_show,
+                                          duration, use_rth)
+        head, start = self.head_request(path, bar_size, what_to_show,
+                                        duration, use_rth)
+        if head is not None:
+            self.write_head(path, await self.ib.reqHistoricalDataAsync(
+                contract, **head))
+        bars = await self.ib.reqHistoricalDataAsync(contract, **request)
+        self.write(path, bars)
+        self.set_requested_start(path, start)
+        return path
+
+    def frame(self, path, duration):
+        """Returns the last duration of a stored series as a DataFrame"""
+        columns = self.read(path)
+        start = utc_now() - parse_duration(duration)
+        first = int(np.searchsorted(columns['date'], to_epoch(start)))
+        df = pd.DataFrame({name: columns[name][first:]
+                           for name, dtype in COLUMNS})
+        df['date'] = pd.to_datetime(df['date'], unit='s')
+        return df
+
+    def get_bars(self, contract, bar_size, what_to_show='MIDPOINT',
+                 duration='6 M', use_rth=True):
+        """
+        Returns the last duration of bars as a DataFrame with date, open,
+        high, low and close columns, fetching only the missing tail.
+        """
+        path = self.update(contract, bar_size, what_to_show, duration,
+                           use_rth)
+        return self.frame(path, duration)
+
+    async def get_bars_async(self, contract, bar_size,
+                             what_to_show='MIDPOINT', duration='6 M',
+                             use_rth=True):
+        """As get_bars(), without blocking the event loop"""
+        path = await self.update_async(contract, bar_size, what_to_show,
+                                       duration, use_rth)
+        return self.frame(path, duration)
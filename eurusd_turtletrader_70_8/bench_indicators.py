@@ -0,0 +1,113 @@
+#####################################################
+# Benchmark of the test2.py ATR calculation.
+#
+# Times the original row-wise true range (four scratch columns and
+# DataFrame.apply(max, axis=1)) against the vectorized
+# indicators.average_true_range on random-walk bars, and checks that
+# both give the same values. Also checks the indicator pipeline's RSI,
+# configured alongside a Wilders ATR of another length, against the
+# original get_RSI. Run with an optional bar count:
+#   python bench_indicators.py 100000
+import sys
+import time
+import numpy as np
+import pandas as pd
+from indicators import ATR, average_true_range
+from indicator_pipeline import IndicatorPipeline, indicator_nodes
+
+
+#####################################################
+def random_bars(count, seed=0):
+    """Returns a DataFrame of random-walk OHLC bars"""
+    rng = np.random.default_rng(seed)
+    close = 1.1 + np.cumsum(rng.normal(0, 1e-4, count))
+    open_ = np.concatenate(([close[0]], close[:-1]))
+    spread = np.abs(rng.normal(0, 1e-4, (2, count)))
+    return pd.DataFrame({'open': open_,
+                         'high': np.maximum(open_, close) + spread[0],
+                         'low': np.minimum(open_, close) - spread[1],
+                         'close': close})
+
+
+#####################################################
+def apply_atr(df, length):
+    """The original get_ATR: row-wise max over scratch columns"""
+    df['tr1'] = df['high'] - df['low']
+    df['tr2'] = abs(df['high'] - df['close'].shift())
+    df['tr3'] = abs(df['low'] - df['close'].shift())
+    df['tr'] = df[['tr1', 'tr2', 'tr3']].apply(max, axis=1)
+    df['atr'] = df['tr'].rolling(length).mean()
+    return df['atr'].values
+
+
+#####################################################
+def series_rsi(df, length):
+    """The original get_RSI, with Wilder's alpha"""
+    delta = df['close'].diff()
+    alpha = 1.0 / length
+    avg_gain = delta.clip(lower=0).ewm(alpha=alpha).mean()
+    avg_loss = delta.clip(upper=0).ewm(alpha=alpha).mean()
+    return (100.0 - 100.0 / (1 + abs(avg_gain / avg_loss))).values
+
+
+#####################################################
+def pipeline_rsi(df, rsi_length, atr_length):
+    """RSI from a pipeline that also has a Wilders ATR, batch and streamed"""
+    pipeline = IndicatorPipeline(
+        indicator_nodes(rsi_length=rsi_length, rsi_alpha='Wilders',
+                        atr_length=atr_length, atr_mamode='Wilders'),
+        ['RSI', 'atr'])
+    engine = pipeline.engine()
+    streamed = np.array([engine.update(h, l, c)['RSI'] for h, l, c
+                         in zip(df['high'], df['low'], df['close'])])
+    return pipeline.compute(df)['RSI'].values, streamed
+
+
+#####################################################
+def streamed_atr(df, length, mamode):
+    """ATR from the streaming indicator, bar by bar"""
+    atr = ATR(length, mamode=mamode)
+    return np.array([atr.update(h, l, c)['atr'] for h, l, c
+                     in zip(df['high'], df['low'], df['close'])])
+
+
+#####################################################
+def timed(func, *args):
+    """Returns func's result and its run time in seconds"""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+#####################################################
+# MAIN PROGRAMME:
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    length = 14
+    df = random_bars(count)
+    high, low, close = df['high'].values, df['low'].values, df['close'].values
+
+    old, old_time = timed(apply_atr, df.copy(), length)
+    new, new_time = timed(average_true_range, high, low, close, length,
+                          'Simple')
+    wilders, wilders_time = timed(average_true_range, high, low, close,
+                                  length, 'Wilders')
+
+    print('{} bars, ATR({})'.format(count, length))
+    print('apply(max, axis=1):   {:.4f}s'.format(old_time))
+    print('vectorized Simple:    {:.4f}s  ({:.0f}x)'.format(
+        new_time, old_time / new_time))
+    print('vectorized Wilders:   {:.4f}s'.format(wilders_time))
+    print('Simple matches apply:     {}'.format(
+        np.allclose(old, new, equal_nan=True)))
+    print('Simple matches streamed:  {}'.format(
+        np.allclose(new, streamed_atr(df, length, 'Simple'),
+                    equal_nan=True)))
+    print('Wilders matches streamed: {}'.format(
+        np.allclose(wilders, streamed_atr(df, length, 'Wilders'),
+                    equal_nan=True)))
+    reference = series_rsi(df, length)
+    batch, streamed = pipeline_rsi(df, length, 20)
+    print('RSI with Wilders ATR({}) matches get_RSI: batch {}, streamed {}'
+          .format(20, np.allclose(batch, reference, equal_nan=True),
+                  np.allclose(streamed, reference, equal_nan=True)))
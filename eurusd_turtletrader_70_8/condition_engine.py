@@ -0,0 +1,251 @@
+#####################################################
+# Local price-condition and OCA engine.
+#
+# Holds orders with a PriceCondition locally instead of sending them to
+# TWS, and sends each as a plain order the moment a price crosses its
+# trigger. Triggers are kept per instrument in two heaps: a min-heap of
+# levels to rise to (isMore) and a max-heap of levels to fall to, so a
+# price only looks at the top of each heap, and each trigger that fires
+# costs O(log n).
+# OCA groups are applied locally when an order fires, as TWS does:
+# ocaType 1 cancels the rest of the group, ocaTypes 2 and 3 reduce their
+# quantity (cancelling those reduced to nothing).
+# Children (parentId) are armed once their parent fires, and children of
+# one parent cancel each other, as in a TWS bracket.
+# The engine sends orders through a callable, so live it is given
+# ib.placeOrder and in backtests anything that records them. Held orders
+# exist only in this process, and are lost if it stops.
+import copy
+import heapq
+import itertools
+import time
+from ib_insync import OrderStatus, Trade
+
+
+#####################################################
+def is_price_condition(order):
+    """True if order has exactly one price condition (condType 1)"""
+    return len(order.conditions) == 1 and order.conditions[0].condType == 1
+
+
+#####################################################
+def crossed(level, is_more, price):
+    """True if price has reached a trigger level"""
+    return price >= level if is_more else price <= level
+
+
+#####################################################
+class PriceLadder(object):
+    """
+    Trigger levels of one instrument, in price order
+    """
+
+    def __init__(self):
+        """Initialize empty ladder"""
+        self.above = []  # (level, seq, key) fired when price >= level
+        self.below = []  # (-level, seq, key) fired when price <= level
+        self.seq = itertools.count()
+
+    def add(self, level, is_more, key):
+        """Adds a trigger"""
+        if is_more:
+            heapq.heappush(self.above, (level, next(self.seq), key))
+        else:
+            heapq.heappush(self.below, (-level, next(self.seq), key))
+
+    def pop_crossed(self, price):
+        """Removes and returns the keys of triggers price has reached"""
+        keys = []
+        while self.above and self.above[0][0] <= price:
+            keys.append(heapq.heappop(self.above)[2])
+        while self.below and -self.below[0][0] >= price:
+            keys.append(heapq.heappop(self.below)[2])
+        return keys
+
+    def __len__(self):
+        """Number of triggers, including cancelled ones not yet popped"""
+        return len(self.above) + len(self.below)
+
+
+#####################################################
+class HeldOrder(object):
+    """
+    An order held until its price condition is met
+    """
+    __slots__ = ('key', 'trade', 'con_id', 'level', 'is_more', 'parent',
+                 'oca_group', 'oca_type', 'armed')
+
+    def __init__(self, key, trade, parent, oca_group, oca_type):
+        """Initialize from a trade whose order has one price condition"""
+        condition = trade.order.conditions[0]
+        self.key = key
+        self.trade = trade
+        self.con_id = condition.conId
+        self.level = condition.price
+        self.is_more = condition.isMore
+        self.parent = parent
+        self.oca_group = oca_group
+        self.oca_type = oca_type
+        self.armed = False
+
+
+#####################################################
+class ConditionEngine(object):
+    """
+    Price-conditioned orders held locally, sent through send(contract,
+    order) when triggered
+    """
+
+    def __init__(self, send, clock=time.perf_counter):
+        """Initialize empty engine"""
+        self.send = send
+        self.clock = clock
+        self.ladders = {}   # conId -> PriceLadder
+        self.held = {}      # key -> HeldOrder
+        self.children = {}  # parent key -> [child keys]
+        self.groups = {}    # OCA group -> set of keys
+        self.prices = {}    # conId -> latest price
+        self.sent = []      # (HeldOrder, result of send)
+        self.latencies = [] # seconds from price to order sent
+
+    def add(self, contract, order):
+        """
+        Holds an order with one price condition. Returns its key (the
+        orderId). A child is armed when its parent fires.
+        """
+        key = order.orderId
+        trade = Trade(contract=contract, order=order,
+                      orderStatus=OrderStatus(orderId=order.orderId,
+                                              status='PreSubmitted',
+                                              remaining=order.totalQuantity),
+                      fills=[], log=[])
+        parent = order.parentId if order.parentId in self.held else None
+        oca_group, oca_type = order.ocaGroup, order.ocaType
+        if parent is not None and not oca_group:
+            # Children of one parent cancel each other
+            oca_group, oca_type = 'parent_{}'.format(parent), 1
+        held = HeldOrder(key, trade, parent, oca_group, oca_type)
+        self.held[key] = held
+        if oca_group:
+            self.groups.setdefault(oca_group, set()).add(key)
+        if parent is None:
+            self.arm(held)
+        else:
+            self.children.setdefault(parent, []).append(key)
+        return key
+
+    def add_group(self, contract, orders):
+        """
+        Holds the price-conditioned orders of a group, and the children
+        of held orders. Returns the orders that are not held.
+        """
+        rest = []
+        for order in orders:
+            if is_price_condition(order) and (not order.parentId or
+                                              order.parentId in self.held):
+                self.add(contract, order)
+            elif order.parentId in self.held:
+                raise ValueError('Child order {} of a held order has no '
+                                 'price condition'.format(order.orderId))
+            else:
+                rest.append(order)
+        return rest
+
+    def arm(self, held):
+        """Starts watching a held order's trigger"""
+        held.armed = True
+        price = self.prices.get(held.con_id)
+        if price is not None and crossed(held.level, held.is_more, price):
+            self.fire(held, self.clock())
+        else:
+            self.ladders.setdefault(held.con_id, PriceLadder()).add(
+                held.level, held.is_more, held.key)
+
+    def on_price(self, con_id, price):
+        """Sends the orders a new price triggers. Returns them."""
+        start = self.clock()
+        self.prices[con_id] = price
+        ladder = self.ladders.get(con_id)
+        if ladder is None:
+            return []
+        count = len(self.sent)
+        for key in ladder.pop_crossed(price):
+            held = self.held.get(key)
+            # Cancelled orders are left in the ladder until reached
+            if held is not None and held.armed:
+                self.fire(held, start)
+        # Including children armed and triggered at once
+        return [held for held, result in self.sent[count:]]
+
+    def fire(self, held, start):
+        """Sends a triggered order as a plain order"""
+        del self.held[held.key]
+        trade = held.trade
+        order = copy.copy(trade.order)
+        order.orderId = 0
+        order.conditions = []
+        order.parentId = 0
+        order.ocaGroup = ''
+        order.ocaType = 0
+        order.transmit = True
+        self.sent.append((held, self.send(trade.contract, order)))
+        self.latencies.append(self.clock() - start)
+        trade.orderStatus.status = 'Submitted'
+
+        self.apply_oca(held)
+        for key in self.children.pop(held.key, []):
+            if key in self.held:
+                self.arm(self.held[key])
+
+    def apply_oca(self, held):
+        """Cancels (or reduces) the rest of a fired order's OCA group"""
+        if not held.oca_group:
+            return
+        group = self.groups.pop(held.oca_group, set())
+        group.discard(held.key)
+        quantity = held.trade.order.totalQuantity
+        for key in list(group):
+            other = self.held.get(key)
+            if other is None:
+                continue
+            if held.oca_type in (2, 3):
+                other.trade.order.totalQuantity -= quantity
+                other.trade.orderStatus.remaining = \
+                    other.trade.order.totalQuantity
+                if other.trade.order.totalQuantity > 0:
+                    continue
+            self.cancel(key)
+        if held.oca_type in (2, 3) and group:
+            self.groups[held.oca_group] = group
+
+    def cancel(self, key):
+        """Cancels a held order and its children. True if it was held."""
+        held = self.held.pop(key, None)
+        if held is None:
+            return False
+        held.trade.orderStatus.status = 'Cancelled'
+        if held.oca_group in self.groups:
+            self.groups[held.oca_group].discard(key)
+        for child in self.children.pop(key, []):
+            self.cancel(child)
+        if held.armed:
+            self.compact(held.con_id)
+        return True
+
+    def compact(self, con_id):
+        """Rebuilds a ladder once it is mostly cancelled triggers"""
+        ladder = self.ladders.get(con_id)
+        armed = [h for h in self.held.values()
+                 if h.armed and h.con_id == con_id]
+        if ladder is None or len(ladder) <= 2 * len(armed) + 16:
+            return
+        ladder = PriceLadder()
+        for held in armed:
+            ladder.add(held.level, held.is_more, held.key)
+        self.ladders[con_id] = ladder
+
+    def get_held(self, local_symbol=None):
+        """Returns the trades of held orders (for a localSymbol)"""
+        return [h.trade for h in self.held.values()
+                if local_symbol is None
+                or h.trade.contract.localSymbol == local_symbol]
@@ -0,0 +1,171 @@
+#####################################################
+# Structured event journal.
+#
+# Every decision, order, fill, indicator snapshot and log message is
+# recorded as one line of JSON, e.g.
+#   {"ts":1700000000.123,"kind":"fill","symbol":"EUR.USD","shares":20000}
+# record() only puts the event on a bounded queue, so the trading thread
+# never waits on the disk or the console. A background thread writes
+# queued events in batches, and echoes log messages to the console. If
+# the queue is full, events are dropped and counted rather than blocking,
+# and the writer records how many were dropped. The journal is opened
+# before the writer starts, so a bad path raises at once; a write error
+# stops the writer, is printed, and is raised again by close().
+# read_events() and load_events() read a journal back for post-trade
+# analysis, skipping lines of other kinds before parsing them.
+import atexit
+import datetime
+import json
+import queue
+import sys
+import threading
+import time
+import traceback
+import pandas as pd
+
+# Console messages are the 'msg' field of 'log' events
+LOG = 'log'
+
+
+#####################################################
+def encode(value):
+    """Encodes values json does not (numpy, datetimes, contracts)"""
+    if hasattr(value, 'item'):
+        return value.item()
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+#####################################################
+class EventJournal(object):
+    """
+    Append-only journal of events, written by a background thread
+    """
+
+    def __init__(self, path='events.ndjson', maxsize=10000, batch=256,
+                 echo=True):
+        """Initialize journal and start its writer"""
+        self.path = path
+        self.batch = batch
+        self.echo = echo
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self.written = 0
+        self.closed = False
+        self.error = None
+        self.file = open(path, 'a', encoding='utf-8')
+        self.thread = threading.Thread(target=self.write_loop,
+                                       name='EventJournal', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def record(self, kind, **fields):
+        """Queues an event, without waiting"""
+        if self.closed or self.error is not None:
+            self.dropped += 1
+            return
+        event = {'ts': time.time(), 'kind': kind}
+        event.update(fields)
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def log(self, msg=''):
+        """Queues a log message, echoed to the console by the writer"""
+        self.record(LOG, msg=str(msg))
+
+    def write_loop(self):
+        """Writes queued events until close(), or an error"""
+        try:
+            with self.file:
+                self.write_events()
+        except Exception as error:
+            self.error = error
+            sys.stderr.write('Event journal {} stopped:\n{}'.format(
+                self.path, traceback.format_exc()))
+
+    def write_events(self):
+        """Writes batches of queued events until the end sentinel"""
+        reported = 0
+        while True:
+            events = [self.queue.get()]
+            while len(events) < self.batch:
+                try:
+                    events.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            done = any(e is None for e in events)
+            events = [e for e in events if e is not None]
+            if self.dropped != reported:
+                events.append({'ts': time.time(), 'kind': 'dropped',
+                               'count': self.dropped - reported})
+                reported = self.dropped
+            self.file.write(''.join(
+                json.dumps(e, separators=(',', ':'), default=encode)
+                + '\n' for e in events))
+            self.file.flush()
+            self.written += len(events)
+            if self.echo:
+                for event in events:
+                    if event['kind'] == LOG:
+                        print(event['msg'])
+            if done:
+                return
+
+    def close(self, timeout=5.0):
+        """
+        Writes the events still queued, then stops the writer. Raises
+        the error that stopped the writer, if any.
+        """
+        if not self.closed:
+            self.closed = True
+            try:
+                if self.thread.is_alive():
+                    self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self.thread.join(timeout)
+        if self.error is not None:
+            raise self.error
+
+
+#####################################################
+def read_events(path, kinds=None, since=None, until=None):
+    """
+    Yields the events of a journal, optionally only those of kinds and
+    with timestamps in [since, until)
+    """
+    if isinstance(kinds, str):
+        kinds = [kinds]
+    # Events are written compactly, so their kind can be matched as text
+    # before paying for json.loads
+    markers = None if kinds is None else \
+        ['"kind":{}'.format(json.dumps(k)) for k in kinds]
+    with open(path, encoding='utf-8') as journal:
+        for line in journal:
+            if markers is not None and not any(m in line for m in markers):
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash
+                continue
+            if kinds is not None and event['kind'] not in kinds:
+                continue
+            if since is not None and event['ts'] < since:
+                continue
+            if until is not None and event['ts'] >= until:
+                continue
+            yield event
+
+
+#####################################################
+def load_events(path, kinds=None, since=None, until=None):
+    """Returns a journal's events as a DataFrame, indexed by time"""
+    df = pd.DataFrame(list(read_events(path, kinds, since, until)))
+    if df.empty:
+        return df
+    df['time'] = pd.to_datetime(df['ts'], unit='s', utc=True)
+    return df.set_index('time')
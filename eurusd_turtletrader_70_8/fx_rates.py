@@ -0,0 +1,139 @@
+#####################################################
+# FX conversion rate service.
+#
+# Subscribes once to each currency pair it needs and keeps the latest mid
+# price in memory from pendingTickersEvent, with the time of the last
+# update. Rates between two non-USD currencies are triangulated through
+# their USD legs, so a handful of subscriptions cover every conversion.
+import asyncio
+import math
+import time
+from ib_insync import Forex
+
+# Market convention: the currency earlier in the list is quoted first
+CURRENCY_PRIORITY = ['EUR', 'GBP', 'AUD', 'NZD', 'USD', 'CAD', 'CHF', 'JPY']
+
+
+#####################################################
+def market_pair(a, b):
+    """Returns the conventional pair for two currencies, e.g. USDJPY"""
+    def rank(currency):
+        if currency in CURRENCY_PRIORITY:
+            return CURRENCY_PRIORITY.index(currency)
+        # Other currencies are quoted against USD as USDxxx
+        return CURRENCY_PRIORITY.index('USD') + 0.5
+    if rank(a) <= rank(b):
+        return a + b
+    return b + a
+
+
+#####################################################
+class FxRateService(object):
+    """
+    Live FX mid prices with staleness timestamps
+    """
+
+    def __init__(self, ib, timeout=5.0):
+        """Initialize service, waiting up to timeout for a first price"""
+        self.ib = ib
+        self.timeout = timeout
+        self.tickers = {}   # pair -> ticker
+        self.pairs = {}     # id(ticker) -> pair
+        self.mids = {}      # pair -> latest mid price
+        self.updated = {}   # pair -> time of latest mid price
+        ib.pendingTickersEvent += self.on_pending_tickers
+
+    def subscribe(self, pair):
+        """Starts streaming a pair, once"""
+        if pair not in self.tickers:
+            ticker = self.ib.reqMktData(Forex(pair), '', False, False)
+            self.tickers[pair] = ticker
+            self.pairs[id(ticker)] = pair
+            self.on_ticker(ticker)
+
+    def unsubscribe_all(self):
+        """Cancels all market data subscriptions"""
+        for ticker in self.tickers.values():
+            self.ib.cancelMktData(ticker.contract)
+        self.tickers.clear()
+        self.pairs.clear()
+
+    def on_pending_tickers(self, tickers):
+        """Stores mid prices of updated tickers"""
+        for ticker in tickers:
+            if id(ticker) in self.pairs:
+                self.on_ticker(ticker)
+
+    def on_ticker(self, ticker):
+        """Stores a ticker's mid price if it has one"""
+        mid = ticker.midpoint()
+        if mid is None or math.isnan(mid) or mid <= 0:
+            mid = ticker.marketPrice()
+        if mid is not None and not math.isnan(mid) and mid > 0:
+            pair = self.pairs[id(ticker)]
+            self.mids[pair] = mid
+            self.updated[pair] = time.time()
+
+    def get_mid(self, pair):
+        """Returns a pair's mid price, waiting for the first one if needed"""
+        self.subscribe(pair)
+        deadline = time.time() + self.timeout
+        while pair not in self.mids:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.ib.waitOnUpdate(timeout=remaining):
+                return float('nan')
+        return self.mids[pair]
+
+    async def get_mid_async(self, pair):
+        """As get_mid(), without blocking the event loop"""
+        self.subscribe(pair)
+        deadline = time.time() + self.timeout
+        while pair not in self.mids:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return float('nan')
+            try:
+                await asyncio.wait_for(self.ib.updateEvent, remaining)
+            except asyncio.TimeoutError:
+                return float('nan')
+        return self.mids[pair]
+
+    def legs(self, base, quote):
+        """Returns the pairs needed to convert base into quote"""
+        if base == quote:
+            return []
+        if 'USD' in (base, quote):
+            return [market_pair(base, quote)]
+        return [market_pair(base, 'USD'), market_pair('USD', quote)]
+
+    def direct_rate(self, base, quote):
+        """Returns units of quote per base from a single pair"""
+        pair = market_pair(base, quote)
+        mid = self.get_mid(pair)
+        return mid if pair.startswith(base) else 1.0 / mid
+
+    def rate(self, base, quote):
+        """Returns units of quote per one unit of base"""
+        if base == quote:
+            return 1.0
+        if 'USD' in (base, quote):
+            return self.direct_rate(base, quote)
+        return self.direct_rate(base, 'USD') * self.direct_rate('USD', quote)
+
+    async def rate_async(self, base, quote):
+        """As rate(), waiting for first prices without blocking"""
+        mids = await asyncio.gather(*[self.get_mid_async(pair)
+                                      for pair in self.legs(base, quote)])
+        if any(math.isnan(mid) for mid in mids):
+            return float('nan')
+        return self.rate(base, quote)
+
+    def age(self, base, quote):
+        """Returns seconds since the oldest price behind a rate updated"""
+        now = time.time()
+        ages = [now - self.updated.get(p, 0.0) for p in self.legs(base, quote)]
+        return max(ages) if ages else 0.0
+
+    def is_stale(self, base, quote, max_age=60.0):
+        """True if a rate has not updated within max_age seconds"""
+        return self.age(base, quote) > max_age
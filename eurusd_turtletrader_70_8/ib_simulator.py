@@ -0,0 +1,757 @@
+#####################################################
+# In-process TWS simulator.
+#
+# SimulatedIB stands in for ib_insync's IB for offline load testing. It
+# implements the part of the API the strategies use, with ib_insync's own
+# objects and events:
+#   reqHistoricalData, reqMktData, reqRealTimeBars, reqContractDetails,
+#   qualifyContracts, placeOrder (PriceConditions, OCA groups, parentId,
+#   transmit), cancelOrder, openTrades, reqExecutions, positions,
+#   accountValues, sleep, waitOnUpdate and run.
+# Recorded or synthetic bid/ask ticks are replayed on the event loop at a
+# speed multiple of real time (or as fast as possible), so the simulated
+# market moves while the strategy sleeps or waits, as it would with TWS.
+# Ticks before the start time are history, served as bars.
+# The simulated clock is ib.time(); the strategies' own clocks are not
+# changed. Orders are acknowledged after ack_delay seconds and fill at
+# the touch: MKT at once, LMT/STP when the bid/ask crosses their price.
+# Orders waiting on a single PriceCondition sit in price ladders and are
+# only looked at once the midpoint reaches their trigger.
+import asyncio
+import datetime
+import heapq
+import itertools
+import math
+import numpy as np
+import pandas as pd
+import pytz
+from eventkit import Event
+from ib_insync import (AccountValue, BarData, BarDataList, CommissionReport,
+                       ContractDetails, Execution, Fill, IB, OrderStatus,
+                       Position, RealTimeBar, RealTimeBarList, Ticker, Trade,
+                       TradeLogEntry, util)
+from condition_engine import PriceLadder, crossed, is_price_condition
+
+BAR_UNITS = {'sec': 1, 'secs': 1, 'min': 60, 'mins': 60, 'hour': 3600,
+             'hours': 3600, 'day': 86400, 'days': 86400, 'week': 604800}
+DURATION_UNITS = {'S': 1, 'D': 86400, 'W': 604800, 'M': 31 * 86400,
+                  'Y': 366 * 86400}
+REALTIME_BAR_SECONDS = 5
+# Size quoted at the bid and ask
+QUOTE_SIZE = 1000000.0
+
+
+#####################################################
+def synthetic_ticks(price, start, end, interval=1.0, volatility=0.005,
+                    spread=0.00002, seed=0):
+    """
+    Returns a DataFrame (time, bid, ask) of random-walk ticks every
+    interval seconds from start to end (timestamps). volatility is the
+    daily standard deviation of returns, spread is relative to price.
+    """
+    rng = np.random.default_rng(seed)
+    times = np.arange(start, end, interval, dtype=float)
+    sigma = volatility * math.sqrt(interval / 86400.0)
+    mid = price * np.exp(np.cumsum(rng.normal(0.0, sigma, len(times))))
+    half = mid * spread / 2.0
+    return pd.DataFrame({'time': times, 'bid': mid - half, 'ask': mid + half})
+
+
+#####################################################
+def load_ticks(path):
+    """Returns recorded ticks from a CSV file with time, bid, ask columns"""
+    ticks = pd.read_csv(path)
+    if not np.issubdtype(ticks['time'].dtype, np.number):
+        ticks['time'] = pd.to_datetime(ticks['time'], utc=True).astype(
+            'datetime64[ns, UTC]').astype('int64') / 1e9
+    return ticks[['time', 'bid', 'ask']]
+
+
+#####################################################
+def fx_hours(now, days=7, timezone=pytz.timezone('US/Eastern')):
+    """Returns liquidHours for IDEALPRO FX around now (a timestamp)"""
+    today = datetime.datetime.fromtimestamp(now, timezone).date()
+    items = []
+    for n in range(-2, days):
+        day = today + datetime.timedelta(days=n)
+        # Sunday to Thursday sessions open at 17:15, close next day 17:00
+        if day.weekday() in (6, 0, 1, 2, 3):
+            next_day = day + datetime.timedelta(days=1)
+            items.append('{:%Y%m%d}:1715-{:%Y%m%d}:1700'.format(day,
+                                                                next_day))
+        else:
+            items.append('{:%Y%m%d}:CLOSED'.format(day))
+    return ';'.join(items)
+
+
+#####################################################
+class SimulatedClient(object):
+    """
+    Request and order ids, as IB.client
+    """
+
+    def __init__(self, first_id=1):
+        """Initialize ids"""
+        self.ids = itertools.count(first_id)
+
+    def getReqId(self):
+        """Returns a new id"""
+        return next(self.ids)
+
+
+#####################################################
+class SimulatedContract(object):
+    """
+    A contract's replayed ticks and its latest quote
+    """
+
+    def __init__(self, contract, ticks, min_tick, time_zone_id, hours):
+        """Initialize from a DataFrame of time, bid, ask"""
+        ticks = ticks.sort_values('time')
+        self.contract = contract
+        self.times = ticks['time'].values.astype(float)
+        self.bids = ticks['bid'].values.astype(float)
+        self.asks = ticks['ask'].values.astype(float)
+        self.mids = (self.bids + self.asks) / 2.0
+        self.min_tick = min_tick
+        self.time_zone_id = time_zone_id
+        self.hours = hours
+        self.quote = None  # (bid, ask, mid)
+        self.tickers = []
+        self.realtime_bars = []
+
+
+#####################################################
+class SimulatedIB(object):
+    """
+    Offline stand-in for ib_insync.IB, replaying ticks at a speed
+    multiple (speed=None replays as fast as possible)
+    """
+
+    oneCancelsAll = staticmethod(IB.oneCancelsAll)
+
+    def __init__(self, start=None, speed=1.0, account='DU0000000',
+                 base_currency='USD', cash=None, ack_delay=0.0,
+                 commission=0.00002, timezone=pytz.utc):
+        """
+        Initialize simulator. start is the timestamp replay begins at
+        (default: the first tick); cash is a dict of currency balances.
+        """
+        self.start = start
+        self.speed = speed
+        self.account = account
+        self.base_currency = base_currency
+        self.cash = dict(cash or {base_currency: 1000000.0})
+        self.ack_delay = ack_delay
+        self.commission = commission
+        self.timezone = timezone
+        self.now = start
+        self.client = SimulatedClient()
+        self.contracts = {}  # conId -> SimulatedContract
+        self.con_ids = itertools.count(900000001)
+        self.trades = {}     # orderId -> Trade
+        self.working = []    # transmitted trades not yet done
+        self.active = []     # working trades checked for fills every tick
+        self.ladders = {}    # conId -> PriceLadder of unmet conditions
+        self.triggered = set()  # orderIds whose conditions have been met
+        self.held = []       # trades placed with transmit=False
+        self.fill_list = []
+        self.position_map = {}  # conId -> [contract, quantity, avgCost]
+        self.exec_ids = itertools.count(1)
+        self.replay = None
+        self.tick_count = 0
+        self.connected = False
+
+        self.connectedEvent = Event('connectedEvent')
+        self.disconnectedEvent = Event('disconnectedEvent')
+        self.updateEvent = Event('updateEvent')
+        self.pendingTickersEvent = Event('pendingTickersEvent')
+        self.newOrderEvent = Event('newOrderEvent')
+        self.openOrderEvent = Event('openOrderEvent')
+        self.orderStatusEvent = Event('orderStatusEvent')
+        self.execDetailsEvent = Event('execDetailsEvent')
+        self.commissionReportEvent = Event('commissionReportEvent')
+        self.positionEvent = Event('positionEvent')
+        self.accountValueEvent = Event('accountValueEvent')
+        self.errorEvent = Event('errorEvent')
+        self.replayDoneEvent = Event('replayDoneEvent')
+
+    #####################################################
+    # Contracts and replay
+
+    def add_contract(self, contract, ticks, min_tick=0.00005,
+                     time_zone_id='US/Eastern', hours=None):
+        """
+        Adds a contract with its ticks (a DataFrame of time, bid, ask).
+        hours is its liquidHours string (default: FX hours).
+        """
+        if not contract.conId:
+            contract.conId = next(self.con_ids)
+        if contract.secType == 'CASH' and not contract.localSymbol:
+            contract.localSymbol = contract.symbol + '.' + contract.currency
+        self.contracts[contract.conId] = SimulatedContract(
+            contract, ticks, min_tick, time_zone_id, hours)
+        return contract
+
+    def lookup(self, contract):
+        """Returns the SimulatedContract of a (possibly unqualified) contract"""
+        sim = self.contracts.get(contract.conId)
+        if sim is not None:
+            return sim
+        for sim in self.contracts.values():
+            c = sim.contract
+            if (contract.localSymbol and contract.localSymbol == c.localSymbol) \
+                    or (contract.symbol == c.symbol
+                        and contract.currency == c.currency
+                        and contract.secType == c.secType):
+                return sim
+        raise ValueError('Unknown contract: {}'.format(contract))
+
+    def time(self):
+        """Returns the simulated time as a timestamp"""
+        return self.now
+
+    def connect(self, *args, **kwargs):
+        """Starts replaying ticks"""
+        if self.start is None:
+            self.start = min(s.times[0] for s in self.contracts.values())
+        self.now = self.start
+        # Quotes as of the start
+        for sim in self.contracts.values():
+            i = np.searchsorted(sim.times, self.start, side='right') - 1
+            if i >= 0:
+                sim.quote = (float(sim.bids[i]), float(sim.asks[i]),
+                             float(sim.mids[i]))
+        self.connected = True
+        self.replay = asyncio.ensure_future(self.run_replay(),
+                                            loop=util.getLoop())
+        self.connectedEvent.emit()
+        return self
+
+    def disconnect(self):
+        """Stops replaying ticks"""
+        if self.replay is not None:
+            self.replay.cancel()
+            self.replay = None
+        self.connected = False
+        self.disconnectedEvent.emit()
+
+    def isConnected(self):
+        """True while connected"""
+        return self.connected
+
+    def stream(self):
+        """Yields (time, conId, bid, ask) of every tick from the start"""
+        def ticks(sim):
+            first = np.searchsorted(sim.times, self.start, side='right')
+            con_ids = itertools.repeat(sim.contract.conId)
+            return zip(sim.times[first:].tolist(), con_ids,
+                       sim.bids[first:].tolist(), sim.asks[first:].tolist())
+        return heapq.merge(*[ticks(s) for s in self.contracts.values()])
+
+    async def run_replay(self):
+        """Replays ticks in time order, paced by speed"""
+        loop = util.getLoop()
+        real_start = loop.time()
+        for when, con_id, bid, ask in self.stream():
+            if self.speed:
+                delay = real_start + (when - self.start) / self.speed \
+                        - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif self.tick_count % 100 == 0:
+                # Let the strategy run between batches of ticks
+                await asyncio.sleep(0)
+            self.now = when
+            self.on_tick(con_id, bid, ask)
+        self.replayDoneEvent.emit()
+
+    def on_tick(self, con_id, bid, ask):
+        """Applies one tick: quotes, real-time bars and order matching"""
+        self.tick_count += 1
+        sim = self.contracts[con_id]
+        sim.quote = (bid, ask, (bid + ask) / 2.0)
+        now = datetime.datetime.fromtimestamp(self.now, pytz.utc)
+        for ticker in sim.tickers:
+            ticker.prevBid, ticker.prevAsk = ticker.bid, ticker.ask
+            ticker.bid, ticker.ask, ticker.time = bid, ask, now
+        for bars in sim.realtime_bars:
+            self.update_realtime_bars(sim, bars)
+        ladder = self.ladders.get(con_id)
+        if ladder is not None:
+            for order_id in ladder.pop_crossed(sim.quote[2]):
+                self.trigger(self.trades[order_id])
+        self.match()
+        if sim.tickers:
+            self.pendingTickersEvent.emit(set(sim.tickers))
+        self.updateEvent.emit()
+
+    #####################################################
+    # Event loop
+
+    def sleep(self, *args):
+        """Sleeps while the replay runs"""
+        util.run(asyncio.sleep(args[0] if args else 0))
+        return True
+
+    def waitOnUpdate(self, timeout=0):
+        """Waits for the next update, returning False on timeout"""
+        if timeout:
+            try:
+                util.run(asyncio.wait_for(self.updateEvent, timeout))
+            except asyncio.TimeoutError:
+                return False
+        else:
+            util.run(self.updateEvent)
+        return True
+
+    def run(self, *awaitables, timeout=None):
+        """Runs awaitables (or the event loop) to completion"""
+        return util.run(*awaitables, timeout=timeout)
+
+    #####################################################
+    # Contract details and market data
+
+    def qualifyContracts(self, *contracts):
+        """Fills in the conId and localSymbol of known contracts"""
+        for contract in contracts:
+            known = self.lookup(contract).contract
+            contract.conId = known.conId
+            contract.localSymbol = known.localSymbol
+            contract.exchange = contract.exchange or known.exchange
+        return list(contracts)
+
+    def reqContractDetails(self, contract):
+        """Returns the contract's details, with its trading hours"""
+        sim = self.lookup(contract)
+        hours = sim.hours or fx_hours(self.now or sim.times[0])
+        return [ContractDetails(contract=sim.contract, minTick=sim.min_tick,
+                                timeZoneId=sim.time_zone_id,
+                                liquidHours=hours, tradingHours=hours)]
+
+    def reqMktData(self, contract, genericTickList='', snapshot=False,
+                   regulatorySnapshot=False, mktDataOptions=None):
+        """Returns a Ticker updated on every tick"""
+        sim = self.lookup(contract)
+        ticker = Ticker(contract=contract, bidSize=QUOTE_SIZE,
+                        askSize=QUOTE_SIZE)
+        if sim.quote is not None:
+            ticker.bid, ticker.ask = sim.quote[0], sim.quote[1]
+        sim.tickers.append(ticker)
+        return ticker
+
+    def cancelMktData(self, contract):
+        """Stops updating contract's tickers"""
+        self.lookup(contract).tickers.clear()
+
+    def reqRealTimeBars(self, contract, barSize, whatToShow, useRTH,
+                        realTimeBarsOptions=None):
+        """Returns a RealTimeBarList of 5 second bars built from ticks"""
+        sim = self.lookup(contract)
+        bars = RealTimeBarList()
+        bars.reqId = self.client.getReqId()
+        bars.contract = contract
+        bars.barSize = barSize
+        bars.whatToShow = whatToShow
+        bars.useRTH = useRTH
+        bars.realTimeBarsOptions = realTimeBarsOptions or []
+        bars.forming = None
+        sim.realtime_bars.append(bars)
+        return bars
+
+    def cancelRealTimeBars(self, bars):
+        """Stops a real-time bar subscription"""
+        for sim in self.contracts.values():
+            if bars in sim.realtime_bars:
+                sim.realtime_bars.remove(bars)
+
+    def update_realtime_bars(self, sim, bars):
+        """Adds a tick to a real-time bar list, emitting closed bars"""
+        price = self.price(sim, bars.whatToShow)
+        start = self.now - self.now % REALTIME_BAR_SECONDS
+        forming = bars.forming
+        if forming is not None and start > forming[0]:
+            time, open_, high, low, close = forming
+            bars.append(RealTimeBar(
+                time=datetime.datetime.fromtimestamp(time, pytz.utc),
+                endTime=-1, open_=open_, high=high, low=low, close=close,
+                volume=-1, wap=-1, count=-1))
+            bars.updateEvent.emit(bars, True)
+            forming = None
+        if forming is None:
+            bars.forming = [start, price, price, price, price]
+        else:
+            forming[2] = max(forming[2], price)
+            forming[3] = min(forming[3], price)
+            forming[4] = price
+
+    def price(self, sim, what_to_show):
+        """Returns the latest bid, ask or midpoint"""
+        bid, ask, mid = sim.quote
+        if what_to_show == 'BID':
+            return bid
+        if what_to_show == 'ASK':
+            return ask
+        return mid
+
+    def reqHistoricalData(self, contract, endDateTime, durationStr,
+                          barSizeSetting, whatToShow, useRTH, formatDate=1,
+                          keepUpToDate=False, chartOptions=None, timeout=60):
+        """Returns bars built from the ticks before the simulated time"""
+        sim = self.lookup(contract)
+        count, unit = barSizeSetting.split(' ')
+        period = int(count) * BAR_UNITS[unit]
+        count, unit = durationStr.split(' ')
+        end = self.now if self.now is not None else sim.times[-1]
+        if isinstance(endDateTime, datetime.datetime):
+            end = min(end, endDateTime.timestamp())
+        first = np.searchsorted(sim.times,
+                                end - int(count) * DURATION_UNITS[unit])
+        last = np.searchsorted(sim.times, end)
+        values = {'BID': sim.bids, 'ASK': sim.asks}.get(whatToShow,
+                                                        sim.mids)[first:last]
+        buckets = (sim.times[first:last] // period).astype(np.int64)
+
+        bars = BarDataList()
+        bars.reqId = self.client.getReqId()
+        bars.contract = contract
+        bars.endDateTime = endDateTime
+        bars.durationStr = durationStr
+        bars.barSizeSetting = barSizeSetting
+        bars.whatToShow = whatToShow
+        bars.useRTH = useRTH
+        bars.formatDate = formatDate
+        bars.keepUpToDate = keepUpToDate
+        bars.chartOptions = chartOptions or []
+        if len(values) == 0:
+            return bars
+        starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+        ends = np.append(starts[1:], len(values)) - 1
+        highs = np.maximum.reduceat(values, starts)
+        lows = np.minimum.reduceat(values, starts)
+        for i in range(len(starts)):
+            bars.append(BarData(
+                date=self.bar_date(buckets[starts[i]] * period, period,
+                                   formatDate),
+                open=float(values[starts[i]]), high=float(highs[i]),
+                low=float(lows[i]), close=float(values[ends[i]]),
+                volume=-1, average=-1, barCount=-1))
+        return bars
+
+    async def reqHistoricalDataAsync(self, *args, **kwargs):
+        """As reqHistoricalData()"""
+        return self.reqHistoricalData(*args, **kwargs)
+
+    def bar_date(self, start, period, format_date):
+        """Returns a bar's date as TWS would"""
+        date = datetime.datetime.fromtimestamp(start, pytz.utc)
+        if period >= 86400:
+            return date.date()
+        if format_date == 2:
+            return date
+        return date.astimezone(self.timezone).replace(tzinfo=None)
+
+    #####################################################
+    # Orders
+
+    def placeOrder(self, contract, order):
+        """Places (or holds, until transmitted) an order"""
+        sim = self.lookup(contract)
+        if not order.orderId:
+            order.orderId = self.client.getReqId()
+        order.permId = order.permId or order.orderId
+        trade = self.trades.get(order.orderId)
+        if trade is not None:
+            # Modification of a live order
+            trade.order = order
+            self.openOrderEvent.emit(trade)
+            return trade
+
+        trade = Trade(contract=sim.contract, order=order,
+                      orderStatus=OrderStatus(orderId=order.orderId,
+                                              status='PendingSubmit',
+                                              remaining=order.totalQuantity,
+                                              parentId=order.parentId),
+                      fills=[], log=[])
+        self.trades[order.orderId] = trade
+        self.log_trade(trade, 'PendingSubmit')
+        self.newOrderEvent.emit(trade)
+        if not order.transmit:
+            self.held.append(trade)
+            return trade
+
+        # Transmitting an order also transmits the orders held before it
+        transmitted = self.held + [trade]
+        self.held = []
+        util.getLoop().call_later(self.ack_delay, self.acknowledge,
+                                  transmitted)
+        return trade
+
+    def acknowledge(self, trades):
+        """TWS accepts transmitted orders"""
+        for trade in trades:
+            if trade.orderStatus.status != 'PendingSubmit':
+                continue
+            waiting = trade.order.conditions or trade.order.parentId
+            self.set_status(trade, 'PreSubmitted' if waiting else 'Submitted')
+            self.openOrderEvent.emit(trade)
+            self.working.append(trade)
+            if is_price_condition(trade.order):
+                self.watch(trade)
+            else:
+                self.active.append(trade)
+        self.match()
+        self.updateEvent.emit()
+
+    def cancelOrder(self, order):
+        """Cancels an order and its child orders"""
+        trade = self.trades.get(order.orderId)
+        if trade is None or trade.isDone():
+            return trade
+        self.set_status(trade, 'Cancelled')
+        trade.cancelledEvent.emit(trade)
+        if trade in self.working:
+            self.working.remove(trade)
+        if trade in self.active:
+            self.active.remove(trade)
+        if trade in self.held:
+            self.held.remove(trade)
+        for child in list(self.working + self.held):
+            if child.order.parentId == order.orderId:
+                self.cancelOrder(child.order)
+        self.updateEvent.emit()
+        return trade
+
+    def set_status(self, trade, status):
+        """Updates a trade's status and emits the status events"""
+        trade.orderStatus.status = status
+        self.log_trade(trade, status)
+        self.orderStatusEvent.emit(trade)
+        trade.statusEvent.emit(trade)
+
+    def log_trade(self, trade, status, message=''):
+        """Adds an entry to a trade's log"""
+        when = datetime.datetime.fromtimestamp(self.now or 0, pytz.utc)
+        trade.log.append(TradeLogEntry(when, status, message))
+
+    def watch(self, trade):
+        """Puts an order's price condition in its ladder"""
+        condition = trade.order.conditions[0]
+        sim = self.contracts.get(condition.conId)
+        if sim is not None and sim.quote is not None \
+                and crossed(condition.price, condition.isMore, sim.quote[2]):
+            self.trigger(trade)
+        else:
+            self.ladders.setdefault(condition.conId, PriceLadder()).add(
+                condition.price, condition.isMore, trade.order.orderId)
+
+    def trigger(self, trade):
+        """Marks a working order's conditions as met"""
+        if trade.isDone() or trade in self.active:
+            return
+        self.triggered.add(trade.order.orderId)
+        self.active.append(trade)
+
+    def is_triggered(self, order):
+        """True if all (or, for 'o' conjunctions, any) conditions are met"""
+        results = []
+        for condition in order.conditions:
+            sim = self.contracts.get(condition.conId)
+            if sim is None or sim.quote is None:
+                results.append(False)
+                continue
+            mid = sim.quote[2]
+            results.append(mid >= condition.price if condition.isMore
+                           else mid <= condition.price)
+        if any(c.conjunction == 'o' for c in order.conditions):
+            return any(results)
+        return all(results)
+
+    def fill_price(self, trade):
+        """Returns the price an active order fills at now, or None"""
+        quote = self.lookup(trade.contract).quote
+        if quote is None:
+            return None
+        order = trade.order
+        buy = order.action == 'BUY'
+        price = quote[1] if buy else quote[0]
+        if order.orderType == 'MKT':
+            return price
+        if order.orderType == 'LMT':
+            crossed = price <= order.lmtPrice if buy \
+                else price >= order.lmtPrice
+        elif order.orderType == 'STP':
+            crossed = price >= order.auxPrice if buy \
+                else price <= order.auxPrice
+        else:
+            return None
+        return price if crossed else None
+
+    def match(self):
+        """Triggers and fills working orders at the current quotes"""
+        for trade in list(self.active):
+            if trade.isDone():
+                continue
+            order = trade.order
+            parent = self.trades.get(order.parentId)
+            if order.parentId and parent is not None \
+                    and parent.orderStatus.status != 'Filled':
+                continue
+            if order.conditions and order.orderId not in self.triggered:
+                if not self.is_triggered(order):
+                    continue
+                self.triggered.add(order.orderId)
+            if trade.orderStatus.status == 'PreSubmitted':
+                self.set_status(trade, 'Submitted')
+            price = self.fill_price(trade)
+            if price is not None:
+                self.fill(trade, price)
+
+    def fill(self, trade, price):
+        """Fills the rest of a trade at price"""
+        order = trade.order
+        contract = trade.contract
+        status = trade.orderStatus
+        shares = order.totalQuantity - status.filled
+        when = datetime.datetime.fromtimestamp(self.now, pytz.utc)
+        exec_id = '{:08x}.{:06d}.01.01'.format(order.orderId,
+                                               next(self.exec_ids))
+        execution = Execution(
+            execId=exec_id, time=when, acctNumber=self.account,
+            exchange=contract.exchange, side='BOT' if order.action == 'BUY'
+            else 'SLD', shares=shares, price=price, permId=order.permId,
+            clientId=order.clientId, orderId=order.orderId,
+            cumQty=order.totalQuantity, avgPrice=price,
+            orderRef=order.orderRef)
+        report = CommissionReport(execId=exec_id,
+                                  commission=abs(shares * price)
+                                  * self.commission,
+                                  currency=contract.currency)
+        fill = Fill(contract, execution, report, when)
+        trade.fills.append(fill)
+        self.fill_list.append(fill)
+        status.filled = order.totalQuantity
+        status.remaining = 0
+        status.avgFillPrice = price
+        status.lastFillPrice = price
+        self.working.remove(trade)
+        self.active.remove(trade)
+        self.set_status(trade, 'Filled')
+
+        self.execDetailsEvent.emit(trade, fill)
+        trade.fillEvent.emit(trade, fill)
+        self.commissionReportEvent.emit(trade, fill, report)
+        trade.filledEvent.emit(trade)
+        signed = shares if order.action == 'BUY' else -shares
+        self.update_position(contract, signed, price)
+        self.update_cash(contract, signed, price, report.commission)
+        self.cancel_oca(trade)
+
+    def cancel_oca(self, trade):
+        """Applies a filled order's OCA group to the rest of the group"""
+        group = trade.order.ocaGroup
+        if not group:
+            return
+        for other in list(self.working + self.held):
+            if other.order.ocaGroup != group or other is trade:
+                continue
+            if other.order.ocaType in (2, 3):
+                # Reduce the others' quantity, without overfilling
+                # (type 1 cancels them)
+                other.order.totalQuantity = max(
+                    0, other.order.totalQuantity - trade.order.totalQuantity)
+                if other.order.totalQuantity > 0:
+                    continue
+            self.cancelOrder(other.order)
+
+    def openTrades(self):
+        """Returns the trades not yet done"""
+        return [t for t in self.trades.values() if not t.isDone()]
+
+    def reqOpenOrders(self):
+        """Returns the orders not yet done"""
+        return [t.order for t in self.openTrades()]
+
+    def reqAutoOpenOrders(self, autoBind=True):
+        """Nothing to bind in the simulator"""
+
+    def reqExecutions(self, execFilter=None):
+        """Returns all fills"""
+        return list(self.fill_list)
+
+    def fills(self):
+        """Returns all fills"""
+        return list(self.fill_list)
+
+    #####################################################
+    # Account
+
+    def managedAccounts(self):
+        """Returns the simulated account"""
+        return [self.account]
+
+    def positions(self, account=''):
+        """Returns the open positions"""
+        return [Position(self.account, c, q, cost)
+                for c, q, cost in self.position_map.values()]
+
+    def update_position(self, contract, shares, price):
+        """Applies a fill to its position"""
+        contract, quantity, cost = self.position_map.get(
+            contract.conId, [contract, 0.0, 0.0])
+        new_quantity = quantity + shares
+        if quantity == 0 or quantity * new_quantity < 0:
+            cost = price
+        elif abs(new_quantity) > abs(quantity):
+            cost = (cost * quantity + price * shares) / new_quantity
+        if new_quantity == 0:
+            cost = 0.0
+        self.position_map[contract.conId] = [contract, new_quantity, cost]
+        self.positionEvent.emit(Position(self.account, contract,
+                                         new_quantity, cost))
+
+    def update_cash(self, contract, shares, price, commission):
+        """Applies a fill to the cash balances"""
+        currencies = [contract.currency]
+        self.cash[contract.currency] = self.cash.get(contract.currency, 0.0) \
+            - shares * price - commission
+        if contract.secType == 'CASH':
+            self.cash[contract.symbol] = self.cash.get(contract.symbol, 0.0) \
+                + shares
+            currencies.append(contract.symbol)
+        for value in self.account_values(currencies):
+            self.accountValueEvent.emit(value)
+
+    def rate(self, currency):
+        """Returns units of base currency per unit of currency, or NaN"""
+        if currency == self.base_currency:
+            return 1.0
+        for sim in self.contracts.values():
+            c = sim.contract
+            if sim.quote is None or c.secType != 'CASH':
+                continue
+            if c.symbol == currency and c.currency == self.base_currency:
+                return sim.quote[2]
+            if c.symbol == self.base_currency and c.currency == currency:
+                return 1.0 / sim.quote[2]
+        return float('nan')
+
+    def account_values(self, currencies=None):
+        """Returns CashBalance of currencies, and the base totals"""
+        if currencies is None:
+            currencies = list(self.cash)
+        total = sum(v * self.rate(c) for c, v in self.cash.items()
+                    if not math.isnan(self.rate(c)))
+        values = [AccountValue(self.account, 'CashBalance',
+                               str(self.cash[c]), c, '') for c in currencies]
+        values += [AccountValue(self.account, 'CashBalance', str(total),
+                                'BASE', ''),
+                   AccountValue(self.account, 'AvailableFunds', str(total),
+                                self.base_currency, ''),
+                   AccountValue(self.account, 'NetLiquidation', str(total),
+                                self.base_currency, '')]
+        return values
+
+    def accountValues(self, account=''):
+        """Returns the account values"""
+        return self.account_values()
@@ -0,0 +1,177 @@
+#####################################################
+# Declarative indicator pipeline.
+#
+# Indicators are built from nodes. Each node names the nodes (or bar
+# fields: high, low, close) it is calculated from, and has a vectorized
+# form for whole series and a streaming form for one bar at a time.
+# A pipeline is asked only for the outputs its caller reads; it resolves
+# their dependency graph and calculates each node once per bar, so shared
+# nodes (such as the HighLow behind both HH and LL) are calculated once.
+# The calculations themselves are those of indicators.py: its streaming
+# indicators and their vectorized versions, whose values match.
+import pandas as pd
+from indicators import (ATR, RSI, HighLow, average_true_range,
+                        higher_highs_lower_lows, relative_strength_index)
+
+BAR_FIELDS = ['open', 'high', 'low', 'close']
+
+
+#####################################################
+class Node(object):
+    """
+    One calculation in the graph: a vectorized function of its input
+    arrays, and a factory for its streaming state
+    """
+
+    def __init__(self, name, inputs, batch, stream):
+        """Initialize node"""
+        self.name = name
+        self.inputs = inputs
+        self.batch = batch
+        self.stream = stream
+
+
+#####################################################
+class Formula(object):
+    """
+    Streaming form of a stateless node
+    """
+
+    def __init__(self, func):
+        """Initialize with a function of the node's inputs"""
+        self.update = self.peek = func
+
+
+#####################################################
+class Output(object):
+    """
+    Streaming form of a node that is one value of a streaming indicator
+    """
+
+    def __init__(self, indicator, name):
+        """Initialize with an indicators.py indicator and its value name"""
+        self.indicator = indicator
+        self.name = name
+
+    def update(self, high, low, close):
+        """Commits a bar and returns the value"""
+        return self.indicator.update(high, low, close)[self.name]
+
+    def peek(self, high, low, close):
+        """Returns the value for a bar without committing it"""
+        return self.indicator.peek(high, low, close)[self.name]
+
+
+#####################################################
+def indicator_nodes(rsi_length=None, rsi_alpha='Wilders', atr_length=None,
+                    atr_mamode='Simple', hl_length=None):
+    """
+    Returns the graph of nodes for the configured indicators:
+    RSI (rsi_length), atr (atr_length) and HH/LL (hl_length)
+    """
+    nodes = []
+
+    if rsi_length is not None:
+        nodes.append(
+            Node('RSI', ['high', 'low', 'close'],
+                 lambda h, l, c: relative_strength_index(c, rsi_length,
+                                                         rsi_alpha),
+                 lambda: Output(RSI(rsi_length, rsi_alpha), 'RSI')))
+
+    if atr_length is not None:
+        nodes.append(
+            Node('atr', ['high', 'low', 'close'],
+                 lambda h, l, c: average_true_range(h, l, c, atr_length,
+                                                    atr_mamode),
+                 lambda: Output(ATR(atr_length, atr_mamode), 'atr')))
+
+    if hl_length is not None:
+        # HH and LL share one HighLow
+        nodes += [
+            Node('high_low', ['high', 'low', 'close'],
+                 lambda h, l, c: dict(zip(['HH', 'LL'],
+                                          higher_highs_lower_lows(
+                                              c, hl_length))),
+                 lambda: HighLow(hl_length)),
+            Node('HH', ['high_low'], lambda hl: hl['HH'],
+                 lambda: Formula(lambda hl: hl['HH'])),
+            Node('LL', ['high_low'], lambda hl: hl['LL'],
+                 lambda: Formula(lambda hl: hl['LL'])),
+        ]
+
+    return {node.name: node for node in nodes}
+
+
+#####################################################
+class IndicatorPipeline(object):
+    """
+    The nodes needed for a set of outputs, in dependency order
+    """
+
+    def __init__(self, nodes, outputs):
+        """Resolve the nodes outputs depend on"""
+        self.outputs = list(outputs)
+        self.order = []
+        seen = set(BAR_FIELDS)
+
+        def visit(name, path):
+            if name in seen:
+                return
+            if name not in nodes:
+                raise ValueError('Unknown indicator: {}'.format(name))
+            if name in path:
+                raise ValueError('Indicator cycle at {}'.format(name))
+            for dependency in nodes[name].inputs:
+                visit(dependency, path + [name])
+            seen.add(name)
+            self.order.append(nodes[name])
+
+        for name in self.outputs:
+            visit(name, [])
+
+    def compute(self, df):
+        """Returns the outputs over all of df's bars as a DataFrame"""
+        values = {f: df[f].values.astype(float) for f in BAR_FIELDS
+                  if f in df.columns}
+        for node in self.order:
+            values[node.name] = node.batch(*[values[i] for i in node.inputs])
+        return pd.DataFrame({name: values[name] for name in self.outputs},
+                            index=df.index)
+
+    def engine(self):
+        """Returns a streaming engine for the pipeline"""
+        return PipelineEngine(self)
+
+
+#####################################################
+class PipelineEngine(object):
+    """
+    Streaming state of a pipeline, fed one bar at a time
+    (the same interface as indicators.IndicatorEngine)
+    """
+
+    def __init__(self, pipeline):
+        """Initialize each node's streaming state"""
+        self.outputs = pipeline.outputs
+        self.streams = [(node, node.stream()) for node in pipeline.order]
+        self.last_date = None
+
+    def _run(self, high, low, close, commit):
+        """Returns the outputs for a bar, committing it if commit"""
+        values = {'high': high, 'low': low, 'close': close}
+        for node, stream in self.streams:
+            args = [values[i] for i in node.inputs]
+            values[node.name] = stream.update(*args) if commit \
+                else stream.peek(*args)
+        return {name: values[name] for name in self.outputs}
+
+    def update(self, high, low, close, date=None):
+        """Commits a completed bar and returns the output values"""
+        values = self._run(high, low, close, commit=True)
+        if date is not None:
+            self.last_date = date
+        return values
+
+    def peek(self, high, low, close):
+        """Returns the output values for a bar that is still forming"""
+        return self._run(high, low, close, commit=False)
@@ -0,0 +1,415 @@
+#####################################################
+# Incremental (streaming) indicators.
+#
+# Each indicator is fed one bar at a time and keeps just enough state to
+# produce its next value in O(1) (amortized for the rolling max/min).
+# update() commits a bar to the indicator state, peek() returns the values
+# a bar would produce without committing it (used for a bar that is still
+# forming). Values match these pandas/pandas_ta calculations:
+#   ATR 'Wilders' - pandas_ta.atr (rma: ewm(alpha=1/n, min_periods=n))
+#   ATR 'Simple'  - rolling mean of true range, H-L for the first bar
+#   RSI           - ewm of close-to-close gains and losses
+#   Donchian      - pandas_ta.donchian (rolling min/max)
+#   HighLow       - runs of rising/falling closes
+# Whole-series (vectorized) versions are at the end, for calculating
+# indicators over history in one pass; indicator_pipeline.py builds
+# test2.py's indicators from both.
+from collections import deque
+import math
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import pandas as pd
+
+NAN = float('nan')
+
+
+#####################################################
+class EWMean(object):
+    """
+    Exponentially weighted mean, identical to pandas ewm(adjust=True).mean()
+    """
+
+    def __init__(self, alpha, min_periods=0):
+        """Initialize state"""
+        self.decay = 1.0 - alpha
+        self.min_periods = min_periods
+        self.num = 0.0
+        self.den = 0.0
+        self.count = 0
+
+    def _next(self, value):
+        """Returns the (num, den, count) state after value"""
+        if math.isnan(value):
+            # Leading NaNs are skipped, as pandas does
+            return self.num, self.den, self.count
+        return (self.num * self.decay + value,
+                self.den * self.decay + 1.0,
+                self.count + 1)
+
+    def _value(self, num, den, count):
+        """Returns the mean for a given state"""
+        if count == 0 or count < self.min_periods:
+            return NAN
+        return num / den
+
+    def update(self, value):
+        """Adds value and returns the new mean"""
+        self.num, self.den, self.count = self._next(value)
+        return self._value(self.num, self.den, self.count)
+
+    def peek(self, value):
+        """Returns the mean if value were added"""
+        return self._value(*self._next(value))
+
+
+#####################################################
+class RollingMean(object):
+    """
+    Simple moving average over a fixed window, as pandas rolling().mean()
+    """
+
+    def __init__(self, length):
+        """Initialize state"""
+        self.length = length
+        self.window = deque()
+        self.total = 0.0
+
+    def _total(self, value):
+        """Returns the window total after value"""
+        total = self.total + value
+        if len(self.window) == self.length:
+            total -= self.window[0]
+        return total
+
+    def update(self, value):
+        """Adds value and returns the new mean"""
+        self.total = self._total(value)
+        self.window.append(value)
+        if len(self.window) > self.length:
+            self.window.popleft()
+        if len(self.window) < self.length:
+            return NAN
+        return self.total / self.length
+
+    def peek(self, value):
+        """Returns the mean if value were added"""
+        if len(self.window) + 1 < self.length:
+            return NAN
+        return self._total(value) / self.length
+
+
+#####################################################
+class RollingExtreme(object):
+    """
+    Rolling max (or min) over a fixed window using a monotonic deque.
+    Each value is pushed and popped at most once: O(1) amortized.
+    """
+
+    def __init__(self, length, is_max=True):
+        """Initialize state"""
+        self.length = length
+        self.is_max = is_max
+        self.index = -1
+        self.window = deque()  # (index, value), monotonic in value
+
+    def _dominates(self, a, b):
+        """True if value a makes value b redundant"""
+        return a >= b if self.is_max else a <= b
+
+    def update(self, value):
+        """Adds value and returns the new window extreme"""
+        self.index += 1
+        while self.window and self._dominates(value, self.window[-1][1]):
+            self.window.pop()
+        self.window.append((self.index, value))
+        if self.window[0][0] <= self.index - self.length:
+            self.window.popleft()
+        if self.index + 1 < self.length:
+            return NAN
+        return self.window[0][1]
+
+    def peek(self, value):
+        """Returns the window extreme if value were added"""
+        index = self.index + 1
+        if index + 1 < self.length:
+            return NAN
+        for i, v in self.window:
+            if i > index - self.length:
+                return v if self._dominates(v, value) else value
+        return value
+
+
+#####################################################
+class TrueRange(object):
+    """
+    True range: max(H-L, |H-prev C|, |L-prev C|).
+    first_bar_range=False leaves the first bar NaN (pandas_ta), True uses
+    H-L for the first bar (test2.py).
+    """
+
+    def __init__(self, first_bar_range=False):
+        """Initialize state"""
+        self.first_bar_range = first_bar_range
+        self.prev_close = None
+
+    def peek(self, high, low, close):
+        """Returns the true range of a bar"""
+        if self.prev_close is None:
+            return high - low if self.first_bar_range else NAN
+        return max(high - low,
+                   abs(high - self.prev_close),
+                   abs(low - self.prev_close))
+
+    def update(self, high, low, close):
+        """Returns the true range of a bar and stores its close"""
+        value = self.peek(high, low, close)
+        self.prev_close = close
+        return value
+
+
+#####################################################
+class ATR(object):
+    """
+    Average true range, 'Wilders' (rma) or 'Simple' (rolling mean)
+    """
+
+    def __init__(self, length, mamode='Wilders', name='atr'):
+        """Initialize state"""
+        valid_mamodes = ['Wilders', 'Simple']
+        if mamode not in valid_mamodes:
+            raise ValueError('Invalid ATR mamode ({}). Must be {}'.format(
+                mamode, valid_mamodes))
+        self.name = name
+        if mamode == 'Wilders':
+            self.tr = TrueRange(first_bar_range=False)
+            self.mean = EWMean(1.0 / length, min_periods=length)
+        else:
+            self.tr = TrueRange(first_bar_range=True)
+            self.mean = RollingMean(length)
+
+    def update(self, high, low, close):
+        """Commits bar and returns {name: value}"""
+        return {self.name: self.mean.update(self.tr.update(high, low, close))}
+
+    def peek(self, high, low, close):
+        """Returns {name: value} for bar without committing it"""
+        return {self.name: self.mean.peek(self.tr.peek(high, low, close))}
+
+
+#####################################################
+class RSI(object):
+    """
+    Relative strength index, 'Wilders' (alpha=1/n) or 'Standard'
+    (alpha=2/(n+1)) smoothing
+    """
+
+    def __init__(self, length, alpha='Wilders', name='RSI'):
+        """Initialize state"""
+        valid_alpha_list = ['Wilders', 'Standard']
+        if alpha not in valid_alpha_list:
+            raise ValueError('Invalid RSI alpha input ({}). Must be {}'.format(
+                alpha, valid_alpha_list))
+        if alpha == 'Wilders':
+            alpha = 1.0 / length
+        else:
+            alpha = 2.0 / (length + 1)
+        self.name = name
+        self.prev_close = None
+        self.avg_gain = EWMean(alpha)
+        self.avg_loss = EWMean(alpha)
+
+    def _split(self, close):
+        """Returns (gain, loss) for a close"""
+        if self.prev_close is None:
+            return NAN, NAN
+        delta = close - self.prev_close
+        return max(delta, 0.0), min(delta, 0.0)
+
+    @staticmethod
+    def _rsi(avg_gain, avg_loss):
+        """Returns RSI from the average gain and loss"""
+        if math.isnan(avg_gain) or math.isnan(avg_loss):
+            return NAN
+        if avg_loss == 0:
+            return 100.0 if avg_gain > 0 else NAN
+        return 100.0 - (100.0 / (1 + abs(avg_gain / avg_loss)))
+
+    def update(self, high, low, close):
+        """Commits bar and returns {name: value}"""
+        gain, loss = self._split(close)
+        self.prev_close = close
+        return {self.name: self._rsi(self.avg_gain.update(gain),
+                                     self.avg_loss.update(loss))}
+
+    def peek(self, high, low, close):
+        """Returns {name: value} for bar without committing it"""
+        gain, loss = self._split(close)
+        return {self.name: self._rsi(self.avg_gain.peek(gain),
+                                     self.avg_loss.peek(loss))}
+
+
+#####################################################
+class Donchian(object):
+    """
+    Donchian channel, producing <name>l, <name>m and <name>u
+    """
+
+    def __init__(self, length, name='dc'):
+        """Initialize state"""
+        self.name = name
+        self.upper = RollingExtreme(length, is_max=True)
+        self.lower = RollingExtreme(length, is_max=False)
+
+    def _values(self, lower, upper):
+        """Returns the channel values as a dict"""
+        return {self.name + 'l': lower,
+                self.name + 'm': 0.5 * (lower + upper),
+                self.name + 'u': upper}
+
+    def update(self, high, low, close):
+        """Commits bar and returns the channel values"""
+        return self._values(self.lower.update(low), self.upper.update(high))
+
+    def peek(self, high, low, close):
+        """Returns the channel values for bar without committing it"""
+        return self._values(self.lower.peek(low), self.upper.peek(high))
+
+
+#####################################################
+class HighLow(object):
+    """
+    Higher highs / lower lows: HH when each of the last length closes is
+    at or above the close before it, LL when each is at or below it
+    """
+
+    def __init__(self, length):
+        """Initialize state"""
+        self.length = length
+        self.prev_close = None
+        self.rising = 0    # closes in the current run of rises
+        self.falling = 0   # closes in the current run of falls
+
+    def _runs(self, close):
+        """Returns the rising and falling runs after close"""
+        if self.prev_close is None:
+            return 0, 0
+        rising = self.rising + 1 if close >= self.prev_close else 0
+        falling = self.falling + 1 if close <= self.prev_close else 0
+        return rising, falling
+
+    def _values(self, rising, falling):
+        """Returns HH and LL as a dict"""
+        return {'HH': rising >= self.length - 1,
+                'LL': falling >= self.length - 1}
+
+    def update(self, high, low, close):
+        """Commits bar and returns {'HH': bool, 'LL': bool}"""
+        self.rising, self.falling = self._runs(close)
+        self.prev_close = close
+        return self._values(self.rising, self.falling)
+
+    def peek(self, high, low, close):
+        """Returns HH and LL for bar without committing it"""
+        return self._values(*self._runs(close))
+
+
+#####################################################
+class IndicatorEngine(object):
+    """
+    Feeds bars one at a time through a set of streaming indicators
+    """
+
+    def __init__(self, *indicators):
+        """Initialize engine with indicator objects"""
+        self.indicators = list(indicators)
+        self.last_date = None
+
+    def update(self, high, low, close, date=None):
+        """Commits a completed bar and returns all indicator values"""
+        values = {}
+        for indicator in self.indicators:
+            values.update(indicator.update(high, low, close))
+        if date is not None:
+            self.last_date = date
+        return values
+
+    def peek(self, high, low, close):
+        """Returns all indicator values for a bar that is still forming"""
+        values = {}
+        for indicator in self.indicators:
+            values.update(indicator.peek(high, low, close))
+        return values
+
+
+#####################################################
+def turtle_engine(atr_length=20, long_length=55, short_length=20):
+    """Returns an engine producing atr, long_dc* and short_dc* values"""
+    return IndicatorEngine(ATR(atr_length, mamode='Wilders', name='atr'),
+                           Donchian(long_length, name='long_dc'),
+                           Donchian(short_length, name='short_dc'))
+
+
+#####################################################
+# Vectorized indicators over whole series
+#####################################################
+def true_range(high, low, close):
+    """
+    True range: max(H-L, abs(H-prev_close), abs(L-prev_close)).
+    The first bar has no previous close, so its true range is H-L.
+    """
+    prev_close = np.empty_like(close)
+    prev_close[:1] = np.nan
+    prev_close[1:] = close[:-1]
+    # fmax skips the missing previous close of the first bar
+    return np.fmax(high - low, np.fmax(np.abs(high - prev_close),
+                                       np.abs(low - prev_close)))
+
+
+#####################################################
+def average_true_range(high, low, close, length, mamode='Simple'):
+    """
+    ATR of high/low/close arrays, as ATR(length, mamode) would stream it:
+    'Simple' is a rolling mean, 'Wilders' is pandas_ta.atr (rma).
+    """
+    tr = true_range(np.asarray(high, dtype=float),
+                    np.asarray(low, dtype=float),
+                    np.asarray(close, dtype=float))
+    if mamode == 'Wilders':
+        # pandas_ta leaves the first bar's true range undefined
+        tr[:1] = np.nan
+        atr = pd.Series(tr).ewm(alpha=1.0 / length, min_periods=length).mean()
+    else:
+        atr = pd.Series(tr).rolling(length).mean()
+    return atr.values
+
+
+#####################################################
+def relative_strength_index(close, length, alpha='Wilders'):
+    """RSI of a close array, as RSI(length, alpha) would stream it"""
+    alpha = 1.0 / length if alpha == 'Wilders' else 2.0 / (length + 1)
+    delta = pd.Series(np.asarray(close, dtype=float)).diff()
+    avg_gain = delta.clip(lower=0).ewm(alpha=alpha).mean().values
+    avg_loss = delta.clip(upper=0).ewm(alpha=alpha).mean().values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 100.0 - (100.0 / (1 + np.abs(avg_gain / avg_loss)))
+
+
+#####################################################
+def higher_highs_lower_lows(close, length):
+    """
+    HH/LL arrays for close, as HighLow(length) would stream them.
+    A bar is compared with the length - 1 close-to-close moves ending at
+    it, so the first length - 1 bars are False.
+    """
+    close = np.asarray(close, dtype=float)
+    if length < 2:
+        # No moves to compare
+        return np.ones(len(close), dtype=bool), np.ones(len(close), dtype=bool)
+    hh = np.zeros(len(close), dtype=bool)
+    ll = np.zeros(len(close), dtype=bool)
+    if len(close) < length:
+        return hh, ll
+    moves = np.diff(close)
+    hh[length - 1:] = sliding_window_view(moves >= 0, length - 1).all(axis=1)
+    ll[length - 1:] = sliding_window_view(moves <= 0, length - 1).all(axis=1)
+    return hh, ll
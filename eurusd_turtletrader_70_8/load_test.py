@@ -0,0 +1,112 @@
+#####################################################
+# Load test of whipsaw_0.1.py against the TWS simulator.
+#
+# Builds 200 days of synthetic minute ticks as history for GBPJPY and
+# EURUSD (and USDJPY, for the JPY conversion rate), then replays 1 second
+# ticks at a speed multiple of real time while running the strategy's
+# trading cycle every CYCLE_MINUTES simulated minutes. Reports cycle
+# times, order acknowledgement latency, and orders placed and filled.
+# Run with an optional speed and cycle count:
+#   python load_test.py 100 20
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from ib_insync import Forex
+from bar_store import BarStore
+from ib_simulator import SimulatedIB, synthetic_ticks
+
+# The replay starts now, as the strategy's own clock is real time
+START = float(int(time.time()))
+HISTORY_DAYS = 200
+CYCLE_MINUTES = 5
+PAIRS = [('GBPJPY', 'GBP', 'JPY', 160.0, 0.005),
+         ('EURUSD', 'EUR', 'USD', 1.07, 0.00005),
+         ('USDJPY', 'USD', 'JPY', 134.0, 0.005)]
+
+
+#####################################################
+def load_strategy():
+    """Imports whipsaw_0.1.py"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'whipsaw_0.1.py')
+    spec = importlib.util.spec_from_file_location('whipsaw', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+#####################################################
+def simulated_ib(speed, cycles):
+    """Returns a SimulatedIB with history and enough ticks for cycles"""
+    ib = SimulatedIB(start=START, speed=speed, cash={'USD': 100000.0})
+    end = START + (cycles + 1) * CYCLE_MINUTES * 60
+    for seed, (pair, symbol, currency, price, min_tick) in enumerate(PAIRS):
+        history = synthetic_ticks(price, START - HISTORY_DAYS * 86400, START,
+                                  interval=60.0, seed=seed)
+        last = (history['bid'].iloc[-1] + history['ask'].iloc[-1]) / 2.0
+        live = synthetic_ticks(last, START, end, interval=1.0, seed=seed + 10)
+        ib.add_contract(Forex(pair, symbol=symbol, currency=currency),
+                        pd.concat([history, live], ignore_index=True),
+                        min_tick=min_tick)
+    return ib
+
+
+#####################################################
+if __name__ == '__main__':
+    speed = float(sys.argv[1]) if len(sys.argv) > 1 else 100.0
+    cycles = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    whipsaw = load_strategy()
+    # Keep the journal of simulated trading out of the real one
+    output = tempfile.mkdtemp(prefix='load_test_')
+    whipsaw.EVENT_JOURNAL = os.path.join(output, 'events.ndjson')
+
+    class LoadTestStrategy(whipsaw.IBAlgoStrategy):
+        """Strategy that also keeps its acknowledgement latencies"""
+
+        def __init__(self, ib):
+            """Initialize strategy"""
+            self.ack_latencies = []
+            whipsaw.IBAlgoStrategy.__init__(self, ib)
+
+        def log_acknowledgements(self, placed):
+            """Keeps, then logs, acknowledgement latencies"""
+            self.ack_latencies += [g.latency for g in placed
+                                   if g.latency is not None]
+            whipsaw.IBAlgoStrategy.log_acknowledgements(self, placed)
+
+    ib = simulated_ib(speed, cycles).connect()
+    algo = LoadTestStrategy(ib)
+    # Keep synthetic bars out of the real bar store
+    algo.bar_store = BarStore(ib, root=os.path.join(output, 'bar_store'))
+    for pair, symbol, currency, price, min_tick in PAIRS[:2]:
+        algo.add_instrument('Forex', ticker=pair, symbol=symbol,
+                            currency=currency)
+
+    cycle_times = []
+    start = time.perf_counter()
+    for cycle in range(cycles):
+        cycle_start = time.perf_counter()
+        algo.run()
+        cycle_times.append(time.perf_counter() - cycle_start)
+        ib.sleep(max(0.0, CYCLE_MINUTES * 60 / speed
+                     - cycle_times[-1]))
+    elapsed = time.perf_counter() - start
+
+    cycle_ms = 1000 * np.array(cycle_times)
+    ack_ms = 1000 * np.array(algo.ack_latencies or [np.nan])
+    print()
+    print('Speed {:g}x: {} ticks, {:.0f} simulated s in {:.1f} s'.format(
+        speed, ib.tick_count, ib.time() - START, elapsed))
+    print('Cycles: {} mean {:.1f}ms, max {:.1f}ms'.format(
+        cycles, cycle_ms.mean(), cycle_ms.max()))
+    print('Acknowledgements: {} mean {:.2f}ms, max {:.2f}ms'.format(
+        len(algo.ack_latencies), np.nanmean(ack_ms), np.nanmax(ack_ms)))
+    print('Orders: {} placed, {} filled, {} open'.format(
+        len(ib.trades), len(ib.fills()), len(ib.openTrades())))
+    algo.journal.close()
+    print('Journal: {} events, {} dropped, in {}'.format(
+        algo.journal.written, algo.journal.dropped, algo.journal.path))
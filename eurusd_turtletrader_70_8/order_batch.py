@@ -0,0 +1,103 @@
+#####################################################
+# Batched order submission.
+#
+# Places whole bracket/OCA groups back to back, then waits on TWS
+# acknowledgements instead of sleeping after every placeOrder.
+# Within a group, each parent/child family transmits only with its last
+# order, so TWS receives the whole bracket at once. Orders without a
+# parent or children in the group are transmitted on their own.
+import asyncio
+import time
+
+# Statuses meaning TWS has not yet acknowledged the order
+UNACKNOWLEDGED_STATES = {'PendingSubmit', 'ApiPending'}
+
+
+#####################################################
+def sequence_transmit(orders):
+    """Sets transmit so each family in orders is sent by its last order"""
+    by_id = {o.orderId: o for o in orders}
+
+    def root(order):
+        while order.parentId in by_id and order.parentId != order.orderId:
+            order = by_id[order.parentId]
+        return order.orderId
+
+    last = {}
+    for o in orders:
+        last[root(o)] = o
+    for o in orders:
+        o.transmit = last[root(o)] is o
+    return orders
+
+
+#####################################################
+def is_acknowledged(trade):
+    """True once TWS has reported a status for the trade"""
+    return trade.orderStatus.status not in UNACKNOWLEDGED_STATES
+
+
+#####################################################
+class OrderGroup(object):
+    """
+    A placed group of orders and its acknowledgement latency
+    """
+
+    def __init__(self, trades, start):
+        """Initialize group"""
+        self.trades = trades
+        self.start = start
+        self.latency = None
+        # Only transmitted orders are acknowledged by TWS
+        self.watch = [t for t in trades if t.order.transmit]
+
+    def check(self):
+        """Records latency once every transmitted order is acknowledged"""
+        if self.latency is None and all(is_acknowledged(t)
+                                        for t in self.watch):
+            self.latency = time.perf_counter() - self.start
+        return self.latency is not None
+
+
+#####################################################
+def place_groups(ib, contract, groups):
+    """Places groups of orders back to back, returns OrderGroups"""
+    placed = []
+    for orders in groups:
+        sequence_transmit(orders)
+        start = time.perf_counter()
+        trades = [ib.placeOrder(contract, o) for o in orders]
+        placed.append(OrderGroup(trades, start))
+    return placed
+
+
+#####################################################
+def submit_order_groups(ib, contract, groups, timeout=10.0):
+    """
+    Places groups of orders and waits until TWS acknowledges them
+    (or timeout seconds pass). Returns the OrderGroups, whose latency is
+    None if a group was not acknowledged in time.
+    """
+    placed = place_groups(ib, contract, groups)
+    deadline = time.time() + timeout
+    while not all([g.check() for g in placed]):
+        remaining = deadline - time.time()
+        if remaining <= 0 or not ib.waitOnUpdate(timeout=remaining):
+            break
+    return placed
+
+
+#####################################################
+async def submit_order_groups_async(ib, contract, groups, timeout=10.0):
+    """As submit_order_groups(), without blocking the event loop"""
+    placed = place_groups(ib, contract, groups)
+    deadline = time.time() + timeout
+    while not all([g.check() for g in placed]):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        try:
+            await asyncio.wait_for(ib.updateEvent, remaining)
+        except asyncio.TimeoutError:
+            break
+    return placed
@@ -0,0 +1,74 @@
+#####################################################
+# Event-driven order and execution book.
+#
+# Mirrors ib.openTrades() and ib.reqExecutions() in memory, kept current
+# from ib_insync's order and execution events, so lookups by localSymbol
+# or orderRef need no sleep and no broker round trip. A symbol's fills
+# are dropped when its position goes flat, so they only ever describe
+# the position held now.
+from ib_insync import OrderStatus
+
+
+#####################################################
+class OrderBook(object):
+    """
+    Open trades and fills indexed by localSymbol and orderRef
+    """
+
+    def __init__(self, ib):
+        """Initialize book from the current session and subscribe"""
+        self.ib = ib
+        # localSymbol -> {id(trade): trade}, for trades not yet done
+        self.trades_by_symbol = {}
+        # orderRef -> {id(trade): trade}, for trades not yet done
+        self.trades_by_ref = {}
+        # localSymbol -> {execId: fill}
+        self.fills_by_symbol = {}
+
+        ib.newOrderEvent += self.on_trade
+        ib.openOrderEvent += self.on_trade
+        ib.orderStatusEvent += self.on_trade
+        ib.execDetailsEvent += self.on_fill
+
+        for trade in ib.openTrades():
+            self.on_trade(trade)
+        for fill in ib.reqExecutions():
+            self.add_fill(fill)
+
+    def on_trade(self, trade):
+        """Adds, updates or removes a trade on any order event"""
+        key = id(trade)
+        symbol = trade.contract.localSymbol
+        ref = trade.order.orderRef
+        if trade.orderStatus.status in OrderStatus.DoneStates:
+            self.trades_by_symbol.get(symbol, {}).pop(key, None)
+            self.trades_by_ref.get(ref, {}).pop(key, None)
+        else:
+            self.trades_by_symbol.setdefault(symbol, {})[key] = trade
+            self.trades_by_ref.setdefault(ref, {})[key] = trade
+
+    def on_fill(self, trade, fill):
+        """Records a new execution"""
+        self.add_fill(fill)
+        self.on_trade(trade)
+
+    def add_fill(self, fill):
+        """Records a fill, ignoring executions already seen"""
+        fills = self.fills_by_symbol.setdefault(fill.contract.localSymbol, {})
+        fills[fill.execution.execId] = fill
+
+    def clear_fills(self, local_symbol):
+        """Forgets the fills of a localSymbol, once its position is closed"""
+        self.fills_by_symbol.pop(local_symbol, None)
+
+    def get_open_trades(self, local_symbol):
+        """Returns trades not yet done for a localSymbol"""
+        return list(self.trades_by_symbol.get(local_symbol, {}).values())
+
+    def get_trades_by_ref(self, order_ref):
+        """Returns trades not yet done for an orderRef"""
+        return list(self.trades_by_ref.get(order_ref, {}).values())
+
+    def get_fills(self, local_symbol):
+        """Returns the fills of a localSymbol's current position"""
+        return list(self.fills_by_symbol.get(local_symbol, {}).values())
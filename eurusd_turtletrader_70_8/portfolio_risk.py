@@ -0,0 +1,210 @@
+#####################################################
+# Portfolio risk limits across all turtle units.
+#
+# The original Turtle limits on units (one unit = one pyramid entry):
+#   per market                        4
+#   per closely correlated group      6   (|correlation| >= 0.7)
+#   per loosely correlated group     10   (|correlation| >= 0.3)
+#   per direction (long or short)    12
+#   in total                         24
+# Correlations are of daily close-to-close returns over a rolling
+# window, kept as running sums that each new daily bar updates in
+# O(markets^2). A long unit in one market counts as a short unit in a
+# negatively correlated market, so EURUSD long and USDJPY long add up.
+# Group and direction exposures are kept current as units change, so
+# checking a proposed unit is O(1).
+import collections
+import math
+
+MAX_UNITS_MARKET = 4
+MAX_UNITS_CLOSE = 6
+MAX_UNITS_LOOSE = 10
+MAX_UNITS_DIRECTION = 12
+MAX_UNITS_TOTAL = 24
+
+
+#####################################################
+class RollingCorrelation(object):
+    """
+    Correlation matrix of daily returns over the last window bars
+    """
+
+    def __init__(self, window=60):
+        """Initialize empty matrix"""
+        self.window = window
+        self.keys = []
+        self.last = {}        # key -> (date, close) of its latest bar
+        self.returns = {}     # key -> {date: return} of recent bars
+        self.rows = collections.deque()  # committed {key: return} rows
+        self.last_date = None
+        self.sum = {}         # key -> sum of returns
+        self.sum_sq = {}      # key -> sum of squared returns
+        self.sum_xy = {}      # (key, key) -> sum of products
+
+    def add_key(self, key):
+        """Starts tracking a market, rebuilding the sums"""
+        if key in self.keys:
+            return
+        self.keys.append(key)
+        self.returns[key] = {}
+        self.sum = {k: 0.0 for k in self.keys}
+        self.sum_sq = {k: 0.0 for k in self.keys}
+        self.sum_xy = {(a, b): 0.0 for a in self.keys for b in self.keys}
+        self.rows.clear()
+        self.last_date = None
+        # Dates every market has a return for, as the window's rows
+        dates = set(self.returns[self.keys[0]])
+        for k in self.keys[1:]:
+            dates &= set(self.returns[k])
+        for date in sorted(dates)[-self.window:]:
+            self.commit(date)
+
+    def add_bar(self, key, date, close):
+        """
+        Adds a market's completed daily bar. Returns True if this
+        completed a row of returns for all markets.
+        """
+        self.add_key(key)
+        last = self.last.get(key)
+        if last is not None and date <= last[0]:
+            return False
+        self.last[key] = (date, close)
+        if last is None or last[1] <= 0:
+            return False
+        returns = self.returns[key]
+        returns[date] = math.log(close / last[1])
+        if len(returns) > 2 * self.window:
+            del returns[next(iter(returns))]
+        if (self.last_date is not None and date <= self.last_date) or \
+                any(date not in self.returns[k] for k in self.keys):
+            return False
+        self.commit(date)
+        return True
+
+    def commit(self, date):
+        """Adds the returns of date, dropping the oldest row if full"""
+        row = {k: self.returns[k][date] for k in self.keys}
+        self.last_date = date
+        self.rows.append(row)
+        self.accumulate(row, 1.0)
+        if len(self.rows) > self.window:
+            self.accumulate(self.rows.popleft(), -1.0)
+
+    def accumulate(self, row, sign):
+        """Adds (sign 1) or removes (sign -1) a row from the sums"""
+        for a in self.keys:
+            x = row[a]
+            self.sum[a] += sign * x
+            self.sum_sq[a] += sign * x * x
+            for b in self.keys:
+                self.sum_xy[(a, b)] += sign * x * row[b]
+
+    def correlation(self, a, b):
+        """Returns the correlation of a and b (0 until there are 2 rows)"""
+        if a == b:
+            return 1.0
+        n = len(self.rows)
+        if n < 2:
+            return 0.0
+        cov = self.sum_xy[(a, b)] - self.sum[a] * self.sum[b] / n
+        var_a = self.sum_sq[a] - self.sum[a] ** 2 / n
+        var_b = self.sum_sq[b] - self.sum[b] ** 2 / n
+        if var_a <= 0 or var_b <= 0:
+            return 0.0
+        return max(-1.0, min(1.0, cov / math.sqrt(var_a * var_b)))
+
+
+#####################################################
+class PortfolioRisk(object):
+    """
+    Units held in each market, checked against the Turtle limits
+    """
+
+    def __init__(self, window=60, close=0.7, loose=0.3):
+        """Initialize with correlation window and group thresholds"""
+        self.correlations = RollingCorrelation(window)
+        self.close = close
+        self.loose = loose
+        self.units = {}        # key -> signed units held
+        self.neighbours = {}   # key -> {'close'/'loose': [(key, sign)]}
+        self.exposure = {}     # key -> {'close'/'loose': signed units}
+        self.direction = {1: 0, -1: 0}
+        self.limits = {'market': MAX_UNITS_MARKET,
+                       'close': MAX_UNITS_CLOSE,
+                       'loose': MAX_UNITS_LOOSE,
+                       'direction': MAX_UNITS_DIRECTION,
+                       'total': MAX_UNITS_TOTAL}
+
+    def add_market(self, key):
+        """Starts tracking a market with no units"""
+        if key not in self.units:
+            self.units[key] = 0
+            self.correlations.add_key(key)
+            self.regroup()
+
+    def add_bars(self, key, dates, closes):
+        """Adds a market's completed daily bars, regrouping on new rows"""
+        self.add_market(key)
+        committed = False
+        for date, close in zip(dates, closes):
+            committed |= self.correlations.add_bar(key, date, close)
+        if committed:
+            self.regroup()
+
+    def regroup(self):
+        """Rebuilds correlated groups and their exposures"""
+        keys = list(self.units)
+        for a in keys:
+            groups = {'close': [], 'loose': []}
+            for b in keys:
+                rho = self.correlations.correlation(a, b)
+                sign = 1 if rho >= 0 else -1
+                if abs(rho) >= self.close:
+                    groups['close'].append((b, sign))
+                if abs(rho) >= self.loose:
+                    groups['loose'].append((b, sign))
+            self.neighbours[a] = groups
+        for a in keys:
+            self.exposure[a] = {
+                group: sum(sign * self.units[b]
+                           for b, sign in self.neighbours[a][group])
+                for group in ('close', 'loose')}
+
+    def set_units(self, key, units):
+        """Sets the signed units held in a market"""
+        self.add_market(key)
+        delta = units - self.units[key]
+        if delta == 0:
+            return
+        old = self.units[key]
+        self.units[key] = units
+        for side in (1, -1):
+            self.direction[side] += max(0, side * units) - max(0, side * old)
+        # A market is its own neighbour, so exposures stay symmetric
+        for group in ('close', 'loose'):
+            for b, sign in self.neighbours[key][group]:
+                self.exposure[b][group] += sign * delta
+
+    def headroom(self, key, direction):
+        """
+        Returns how many more units may be added to key in direction
+        (1 long, -1 short), and the limit that binds
+        """
+        self.add_market(key)
+        held = direction * self.units[key]
+        room = {
+            'market': self.limits['market'] - held,
+            'close': self.limits['close']
+            - direction * self.exposure[key]['close'],
+            'loose': self.limits['loose']
+            - direction * self.exposure[key]['loose'],
+            'direction': self.limits['direction'] - self.direction[direction],
+            'total': self.limits['total'] - self.direction[1]
+            - self.direction[-1],
+        }
+        limit = min(room, key=room.get)
+        return max(0, room[limit]), limit
+
+    def can_add(self, key, direction, count=1):
+        """True if count more units may be added to key in direction"""
+        return self.headroom(key, direction)[0] >= count
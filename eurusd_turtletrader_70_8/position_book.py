@@ -0,0 +1,159 @@
+#####################################################
+# Position book keyed by conId.
+#
+# Signed quantity and average price of every position, seeded from
+# ib.positions() and kept current from positionEvent. Fills from
+# execDetailsEvent are applied straight away, so the book reflects an
+# execution before TWS sends the updated position. TWS may send the two
+# in either order, so a FillReconciler keeps fills apart from reported
+# positions: a reported change explains the fills it includes, and a
+# fill a reported change already included is not applied again.
+# Average prices are per unit (TWS avgCost divided by the contract
+# multiplier), for every security type including Forex.
+from eventkit import Event
+
+# Quantities closer than this are equal
+EPSILON = 1e-9
+
+
+#####################################################
+def multiplier(contract):
+    """Returns a contract's price multiplier (1 when it has none)"""
+    try:
+        return float(contract.multiplier) or 1.0
+    except (TypeError, ValueError):
+        return 1.0
+
+
+#####################################################
+class FillReconciler(object):
+    """
+    Quantities by key: the last reported quantity, plus the fills since
+    that the reports do not yet include
+    """
+
+    def __init__(self):
+        """Initialize with nothing reported"""
+        self.reported = {}  # key -> last reported quantity
+        self.pending = {}   # key -> [shares of fills not yet reported]
+        self.credits = {}   # key -> reported change not yet seen as fills
+        self.exec_ids = set()
+
+    def seed(self, key, quantity):
+        """Sets a starting quantity, which no fills explain"""
+        self.reported[key] = quantity
+        self.pending[key] = []
+        self.credits[key] = 0.0
+
+    def report(self, key, quantity):
+        """
+        Applies a reported quantity. Its change explains the oldest
+        pending fills it adds up to, or else all of them, with the rest
+        of the change credited to fills still to come.
+        """
+        change = quantity - self.reported.get(key, 0.0)
+        self.reported[key] = quantity
+        pending = self.pending.setdefault(key, [])
+        total = 0.0
+        for count, shares in enumerate(pending, 1):
+            total += shares
+            if abs(total - change) < EPSILON:
+                del pending[:count]
+                return self.quantity(key)
+        self.credits[key] = self.credits.get(key, 0.0) + change - sum(pending)
+        del pending[:]
+        if abs(self.credits[key]) < EPSILON:
+            self.credits[key] = 0.0
+        return self.quantity(key)
+
+    def fill(self, key, exec_id, shares):
+        """
+        Applies a fill of signed shares, unless a report already
+        included it. Returns False if the execution was seen before.
+        """
+        if exec_id in self.exec_ids:
+            return False
+        self.exec_ids.add(exec_id)
+        credit = self.credits.get(key, 0.0)
+        if credit * shares > 0 and abs(shares) <= abs(credit) + EPSILON:
+            self.credits[key] = credit - shares
+        else:
+            self.pending.setdefault(key, []).append(shares)
+        return True
+
+    def quantity(self, key):
+        """Returns the reported quantity plus the fills not yet reported"""
+        return self.reported.get(key, 0.0) + sum(self.pending.get(key, []))
+
+
+#####################################################
+class PositionBook(object):
+    """
+    Positions by conId with O(1) quantity and average price lookups.
+    updateEvent emits (contract, quantity, avg_price) on each change.
+    """
+
+    def __init__(self, ib):
+        """Initialize book from current positions and subscribe"""
+        self.ib = ib
+        self.quantities = {}  # conId -> signed quantity
+        self.avg_prices = {}  # conId -> average price per unit
+        self.reconciler = FillReconciler()
+        self.updateEvent = Event('updateEvent')
+        ib.positionEvent += self.on_position
+        ib.execDetailsEvent += self.on_fill
+        for position in ib.positions():
+            self.reconciler.seed(position.contract.conId,
+                                 float(position.position))
+            self.on_position(position)
+
+    def set(self, contract, quantity, avg_price):
+        """Stores a position and emits updateEvent"""
+        self.quantities[contract.conId] = quantity
+        self.avg_prices[contract.conId] = avg_price
+        self.updateEvent.emit(contract, quantity, avg_price)
+
+    def on_position(self, position):
+        """Stores a position reported by TWS"""
+        contract = position.contract
+        quantity = self.reconciler.report(contract.conId,
+                                          float(position.position))
+        avg_price = float(position.avgCost) / multiplier(contract)
+        if quantity != float(position.position):
+            # Fills not yet reported are still in the estimate
+            avg_price = self.get_avg_price(contract) or avg_price
+        self.set(contract, quantity, avg_price)
+
+    def on_fill(self, trade, fill):
+        """Applies an execution to its position"""
+        execution = fill.execution
+        contract = fill.contract
+        shares = float(execution.shares)
+        if execution.side != 'BOT':
+            shares = -shares
+        price = float(execution.price)
+
+        quantity = self.get_quantity(contract)
+        avg_price = self.get_avg_price(contract)
+        self.reconciler.fill(contract.conId, execution.execId, shares)
+        new_quantity = self.reconciler.quantity(contract.conId)
+        if new_quantity == quantity:
+            # A duplicate, or already in the reported position
+            return
+        if quantity == 0 or quantity * new_quantity < 0:
+            # New position, or reversed through flat
+            avg_price = price
+        elif abs(new_quantity) > abs(quantity):
+            # Added to the position
+            avg_price = (avg_price * quantity + price * shares) / new_quantity
+        if new_quantity == 0:
+            avg_price = 0.0
+        self.set(contract, new_quantity, avg_price)
+
+    def get_quantity(self, contract):
+        """Returns the signed quantity held of contract"""
+        return self.quantities.get(contract.conId, 0.0)
+
+    def get_avg_price(self, contract):
+        """Returns the average price per unit of contract's position"""
+        return self.avg_prices.get(contract.conId, 0.0)
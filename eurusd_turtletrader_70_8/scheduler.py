@@ -0,0 +1,132 @@
+#####################################################
+# Timer-wheel scheduler.
+#
+# Timers are hashed by their due tick into a fixed ring of slots, so
+# scheduling and cancelling are O(1). advance() fires every timer due up
+# to now. next_due() gives the time of the earliest timer, so a caller
+# can sleep exactly until something is due instead of polling.
+# Periodic timers (bar closes) are aligned to multiples of their period
+# from an offset, and are rescheduled each time they fire.
+import math
+import time
+
+
+#####################################################
+class Timer(object):
+    """
+    A scheduled callback
+    """
+    __slots__ = ('when', 'tick', 'callback', 'args', 'period', 'name',
+                 'cancelled')
+
+    def __init__(self, when, tick, callback, args, period, name):
+        """Initialize timer"""
+        self.when = when
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.period = period
+        self.name = name
+        self.cancelled = False
+
+
+#####################################################
+class TimerWheel(object):
+    """
+    Hashed timer wheel with resolution-second ticks
+    """
+
+    def __init__(self, resolution=1.0, slots=3600, clock=time.time):
+        """Initialize an empty wheel, starting at the clock's time"""
+        self.resolution = resolution
+        self.slots = [[] for _ in range(slots)]
+        self.clock = clock
+        # Last tick fully processed
+        self.current = self.to_tick(clock()) - 1
+        self.count = 0
+
+    def to_tick(self, when):
+        """Returns the tick a time falls in"""
+        return int(math.floor(when / self.resolution))
+
+    def add(self, timer):
+        """Puts a timer in its slot"""
+        # Timers already due fire on the next advance()
+        timer.tick = max(self.to_tick(timer.when), self.current + 1)
+        self.slots[timer.tick % len(self.slots)].append(timer)
+        self.count += 1
+        return timer
+
+    def schedule(self, when, callback, *args, name=None):
+        """Calls callback(*args) at time when. Returns the Timer."""
+        return self.add(Timer(when, 0, callback, args, None, name))
+
+    def schedule_every(self, period, callback, *args, offset=0.0,
+                       name=None):
+        """
+        Calls callback(*args) at every offset + n * period seconds
+        (e.g. every bar close). Returns the Timer.
+        """
+        now = self.clock()
+        when = offset + (math.floor((now - offset) / period) + 1) * period
+        return self.add(Timer(when, 0, callback, args, period, name))
+
+    def cancel(self, timer):
+        """Stops a timer from firing"""
+        timer.cancelled = True
+
+    def next_due(self):
+        """Returns the time of the earliest pending timer, or None"""
+        size = len(self.slots)
+        for tick in range(self.current + 1, self.current + size + 1):
+            due = [t.when for t in self.slots[tick % size]
+                   if t.tick == tick and not t.cancelled]
+            if due:
+                return min(due)
+        # Nothing within one turn of the wheel
+        pending = [t.when for slot in self.slots for t in slot
+                   if not t.cancelled]
+        return min(pending) if pending else None
+
+    def advance(self, now=None):
+        """Fires every timer due up to now. Returns the number fired."""
+        if now is None:
+            now = self.clock()
+        target = self.to_tick(now)
+        size = len(self.slots)
+        # After a full turn every slot has been visited
+        first = max(self.current + 1, target - size + 1)
+        fired = 0
+        for tick in range(first, target + 1):
+            slot = self.slots[tick % size]
+            due = [t for t in slot if t.tick <= target]
+            if not due:
+                continue
+            slot[:] = [t for t in slot if t.tick > target]
+            self.count -= len(due)
+            due.sort(key=lambda t: t.when)
+            for timer in due:
+                if timer.cancelled:
+                    continue
+                if timer.when > now:
+                    # Due later within this tick
+                    self.slots[timer.tick % size].append(timer)
+                    self.count += 1
+                    continue
+                fired += 1
+                timer.callback(*timer.args)
+                if timer.period is not None and not timer.cancelled:
+                    timer.when += timer.period
+                    while timer.when <= now:
+                        timer.when += timer.period
+                    self.add(timer)
+        # The current tick is revisited, for timers due later within it
+        self.current = max(self.current, target - 1)
+        return fired
+
+    def seconds_until_due(self, default=None):
+        """Returns seconds until the next timer (0 if overdue)"""
+        due = self.next_due()
+        if due is None:
+            return default
+        return max(0.0, due - self.clock())
@@ -0,0 +1,210 @@
+#####################################################
+# Trading session calendar.
+#
+# Sessions of each contract are parsed from its contract details'
+# liquidHours (or tradingHours) in the exchange's timeZoneId, and kept as
+# sorted lists of start and end timestamps. Sessions that run into each
+# other are merged, and CLOSED days (weekends, holidays) are simply gaps,
+# so FX's Sunday open and overnight sessions need no special handling.
+# Calendars are saved to a JSON file and reused across restarts until
+# they no longer cover the days ahead; lookups are bisections. A calendar
+# that still falls short after a refresh (e.g. holidays ahead) is not
+# requested again within the refresh interval.
+#   liquidHours: 20230116:1715-20230117:1700;20230121:CLOSED;...
+#   older TWS:   20090507:0930-1600;20090508:CLOSED;...
+import bisect
+import datetime
+import json
+import os
+import time
+import pytz
+
+# Abbreviated timeZoneIds some TWS versions send
+TIMEZONE_IDS = {'EST': 'US/Eastern',
+                'CST': 'US/Central',
+                'MST': 'US/Mountain',
+                'PST': 'US/Pacific',
+                'GMT': 'Europe/London',
+                'JST': 'Asia/Tokyo',
+                'HKT': 'Asia/Hong_Kong'}
+
+
+#####################################################
+def exchange_timezone(timezone_id):
+    """Returns the pytz timezone of a contract details' timeZoneId"""
+    # e.g. 'US/Eastern', 'EST5EDT' or 'EST (Eastern Standard Time)'
+    name = (timezone_id or 'UTC').split(' ')[0]
+    name = TIMEZONE_IDS.get(name, name)
+    try:
+        return pytz.timezone(name)
+    except pytz.UnknownTimeZoneError:
+        return pytz.utc
+
+
+#####################################################
+def parse_hours(hours, timezone):
+    """Returns sorted, merged (start, end) timestamps of an hours string"""
+    def timestamp(day, hhmm):
+        local = datetime.datetime.strptime(day + hhmm, '%Y%m%d%H%M')
+        return timezone.localize(local).timestamp()
+
+    sessions = []
+    for item in hours.split(';'):
+        if not item or item.endswith('CLOSED'):
+            continue
+        start, end = item.split('-')
+        start_day, start_hhmm = start.split(':')
+        if ':' in end:
+            end_day, end_hhmm = end.split(':')
+        else:
+            end_day, end_hhmm = start_day, end
+        sessions.append((timestamp(start_day, start_hhmm),
+                         timestamp(end_day, end_hhmm)))
+
+    sessions.sort()
+    merged = []
+    for start, end in sessions:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+#####################################################
+class Sessions(object):
+    """
+    Sorted trading sessions of one contract
+    """
+
+    def __init__(self, starts, ends, timezone, updated):
+        """Initialize sessions"""
+        self.starts = starts
+        self.ends = ends
+        self.timezone = timezone
+        self.updated = updated
+
+    def find(self, when):
+        """Returns the index of the session open at when, or None"""
+        i = bisect.bisect_right(self.starts, when) - 1
+        if i >= 0 and when < self.ends[i]:
+            return i
+        return None
+
+    def is_open(self, when):
+        """True if the market is open at when"""
+        return self.find(when) is not None
+
+    def current_or_next(self, when):
+        """Returns the (start, end) open at or next after when, or None"""
+        i = self.find(when)
+        if i is None:
+            i = bisect.bisect_right(self.starts, when)
+            if i == len(self.starts):
+                return None
+        return self.starts[i], self.ends[i]
+
+    def covers(self, when):
+        """True if the sessions are known past when"""
+        return len(self.ends) > 0 and self.ends[-1] > when
+
+
+#####################################################
+class SessionCalendar(object):
+    """
+    Trading sessions by conId, from TWS contract details, cached in
+    memory and in a JSON file
+    """
+
+    def __init__(self, ib, path='sessions.json', use_rth=True,
+                 lookahead=datetime.timedelta(days=1),
+                 refresh_interval=datetime.timedelta(hours=1)):
+        """
+        Initialize calendar. Sessions are requested again once they end
+        within lookahead of now, at most once per refresh_interval.
+        """
+        self.ib = ib
+        self.path = path
+        self.field = 'liquidHours' if use_rth else 'tradingHours'
+        self.lookahead = lookahead.total_seconds()
+        self.refresh_interval = refresh_interval.total_seconds()
+        self.sessions = {}  # conId -> Sessions
+        self.load()
+
+    def load(self):
+        """Reads saved calendars"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            saved = json.load(f)
+        for con_id, item in saved.get(self.field, {}).items():
+            self.sessions[int(con_id)] = Sessions(
+                item['starts'], item['ends'],
+                exchange_timezone(item['timezone']), item['updated'])
+
+    def save(self):
+        """Writes all calendars, keeping those of the other hours field"""
+        saved = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                saved = json.load(f)
+        saved[self.field] = {
+            str(con_id): {'starts': s.starts, 'ends': s.ends,
+                          'timezone': s.timezone.zone, 'updated': s.updated}
+            for con_id, s in self.sessions.items()}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(saved, f)
+        os.replace(tmp, self.path)
+
+    def refresh(self, contract):
+        """Requests contract's sessions from TWS and saves them"""
+        details = self.ib.reqContractDetails(contract)
+        if not details:
+            # Keep what is known, and wait before asking again
+            sessions = self.sessions.get(contract.conId) or \
+                Sessions([], [], pytz.utc, 0.0)
+            sessions.updated = time.time()
+            self.sessions[contract.conId] = sessions
+            return sessions
+        details = details[0]
+        timezone = exchange_timezone(details.timeZoneId)
+        merged = parse_hours(getattr(details, self.field), timezone)
+        sessions = Sessions([s for s, e in merged], [e for s, e in merged],
+                            timezone, time.time())
+        self.sessions[contract.conId] = sessions
+        self.save()
+        return sessions
+
+    def get(self, contract, when=None):
+        """Returns contract's Sessions, requesting them only when needed"""
+        if when is None:
+            when = time.time()
+        sessions = self.sessions.get(contract.conId)
+        if sessions is None or (
+                not sessions.covers(when + self.lookahead)
+                and time.time() - sessions.updated >= self.refresh_interval):
+            sessions = self.refresh(contract)
+        return sessions
+
+    def is_open(self, contract, when=None):
+        """True if contract's market is open (now by default)"""
+        if when is None:
+            when = time.time()
+        return self.get(contract, when).is_open(when)
+
+    def session(self, contract, when=None):
+        """Returns the (start, end) of contract's current or next session"""
+        if when is None:
+            when = time.time()
+        return self.get(contract, when).current_or_next(when)
+
+    def minutes_to_close(self, contract, when=None):
+        """Minutes until contract's session closes, or None if closed"""
+        if when is None:
+            when = time.time()
+        sessions = self.get(contract, when)
+        i = sessions.find(when)
+        if i is None:
+            return None
+        return (sessions.ends[i] - when) / 60.0
@@ -0,0 +1,112 @@
+#####################################################
+# Parallel parameter sweep for the whipsaw turtle backtest.
+#
+# Fans a grid of (long length, short length, ATR length, stop multiplier,
+# max units) out over a process pool. The OHLC bars are copied once into
+# a shared memory block, and each worker maps it instead of receiving
+# pickled arrays with every task. Results come back as a table ranked by
+# one of the backtest summary statistics.
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import itertools
+import os
+import sys
+import numpy as np
+from backtest import backtest
+
+PARAMETERS = ['long_length', 'short_length', 'atr_length',
+              'stop_multiplier', 'max_units']
+
+# Worker state, set by attach_bars() in each worker process
+_shm = None
+_bars = None
+
+
+#####################################################
+def attach_bars(name, shape):
+    """Maps the shared OHLC block in a worker process"""
+    global _shm, _bars
+    _shm = shared_memory.SharedMemory(name=name)
+    _bars = np.ndarray(shape, dtype=np.float64, buffer=_shm.buf)
+
+
+#####################################################
+def run_params(params):
+    """Backtests one parameter set on the shared bars"""
+    result = backtest(_bars[0], _bars[1], _bars[2], _bars[3], **params)
+    row = dict(params)
+    row.update(result.summary())
+    return row
+
+
+#####################################################
+def parameter_grid(long_lengths=(55, 70), short_lengths=(8, 20),
+                   atr_lengths=(20,), stop_multipliers=(0.5,),
+                   max_units=(4,)):
+    """Returns every combination of the given values as dicts"""
+    grid = []
+    for values in itertools.product(long_lengths, short_lengths,
+                                    atr_lengths, stop_multipliers,
+                                    max_units):
+        params = dict(zip(PARAMETERS, values))
+        if params['short_length'] < params['long_length']:
+            grid.append(params)
+    return grid
+
+
+#####################################################
+def sweep(open_, high, low, close, grid, rank_by='sharpe', workers=None):
+    """
+    Backtests every parameter set in grid across a process pool.
+    Returns result rows sorted best first by rank_by.
+    """
+    bars = np.vstack([np.asarray(a, dtype=np.float64)
+                      for a in (open_, high, low, close)])
+    shm = shared_memory.SharedMemory(create=True, size=bars.nbytes)
+    try:
+        shared = np.ndarray(bars.shape, dtype=np.float64, buffer=shm.buf)
+        shared[:] = bars
+        workers = workers or os.cpu_count()
+        chunksize = max(1, len(grid) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=attach_bars,
+                                 initargs=(shm.name, bars.shape)) as pool:
+            rows = list(pool.map(run_params, grid, chunksize=chunksize))
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+    rows.sort(key=lambda row: row[rank_by], reverse=True)
+    return rows
+
+
+#####################################################
+def format_table(rows, limit=20):
+    """Returns the top result rows as a text table"""
+    if not rows:
+        return ''
+    columns = list(rows[0].keys())
+    lines = ['  '.join('{:>15}'.format(c) for c in columns)]
+    for row in rows[:limit]:
+        lines.append('  '.join(
+            '{:>15.4f}'.format(row[c]) if isinstance(row[c], float)
+            else '{:>15}'.format(row[c]) for c in columns))
+    return '\n'.join(lines)
+
+
+#####################################################
+# MAIN PROGRAMME:
+if __name__ == '__main__':
+    # Sweep a bar store series, e.g.
+    #   python sweep.py bar_store/12087792_1day_MIDPOINT_RTH
+    from bar_store import BarStore
+    columns = BarStore(None).read(sys.argv[1])
+    grid = parameter_grid(long_lengths=range(40, 101, 5),
+                          short_lengths=range(5, 31, 1),
+                          atr_lengths=(10, 14, 20, 30),
+                          stop_multipliers=(0.5, 1.0, 1.5, 2.0),
+                          max_units=(1, 2, 3, 4))
+    rows = sweep(columns['open'], columns['high'],
+                 columns['low'], columns['close'], grid)
+    print('{} parameter sets'.format(len(rows)))
+    print(format_table(rows))
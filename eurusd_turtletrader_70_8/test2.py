@@ -1,21 +1,41 @@
 ###############################################################################
 # Import required libraries
-import calendar
+import asyncio
 import datetime
 from ib_insync import *
 from ibapi import *
-import logging
 import numpy as np
 import pandas as pd
 import pytz
 import sys
 import time
+from bar_aggregator import BarAggregator
+from bar_frame import BarFrame
+from bar_store import BarStore
+from event_journal import EventJournal
+from position_book import PositionBook
+from ticker_pool import TickerPool
+from scheduler import TimerWheel
+from session_calendar import SessionCalendar
+from trailing_stops import TrailingStopEngine
+from indicator_pipeline import IndicatorPipeline, indicator_nodes
 
 ###############################################################################
 # Required variables for the algo
 # Set to True when using Spyder
 USING_NOTEBOOK = False
 
+# Journal of decisions, orders, fills, indicators and log messages
+EVENT_JOURNAL = 'IBAlgoStrategy.ndjson'
+
+# Set to True to build intraday bars from streamed 5 second bars instead
+# of requesting history at every bar boundary
+STREAMING_BARS = True
+# Seconds after a bar's close to request it from history
+BAR_CLOSE_DELAY = 2
+# Minutes before the close to exit all positions
+EOD_EXIT_MINUTES = 30
+
 # Set timezone for your TWS setup
 TWS_TIMEZONE = pytz.timezone('Asia/Shanghai')
 
@@ -45,29 +65,35 @@ QTY_DICT = {}
 PNL = {}
 DELTA = 1000
 
+# Indicators each signal reads from the signal bar (the first bar added).
+# Only these are calculated, and only for that bar.
+SIGNAL_INDICATORS = {
+    'long_entry_signal': ['RSI', 'HH'],
+    'long_exit_signal': ['RSI'],
+    'short_entry_signal': ['RSI', 'LL'],
+    'short_exit_signal': ['RSI'],
+}
+
 
 ###############################################################################
 class IBAlgoStrategy(object):
     """
     Algorithmic Strategy for Interactive Brokers.
     """
-    def __init__(self):
+    def __init__(self, ib=None):
         """Initialize algo"""
-        # Setup logger
-        # https://docs.python.org/3.6/library/logging.html#
-        # logging levels: CRITICAL, ERROR, WARNING, INFO, DEBUG, NOTSET
-        self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(logging.INFO)
-        self.handler = logging.FileHandler('IBAlgoStrategy.log')
-        self.handler.setLevel(logging.INFO)
-        self.formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        self.handler.setFormatter(self.formatter)
-        self.logger.addHandler(self.handler)
-        self.logger.info('Starting log at {}'.format(datetime.datetime.now()))
-
-        # Create IB connection
-        self.ib = self.connect()
+        # Setup event journal, written (and echoed to the console) by a
+        # background thread
+        self.journal = EventJournal(EVENT_JOURNAL, echo=not USING_NOTEBOOK)
+        self.journal.log('Starting log at {}'.format(datetime.datetime.now()))
+
+        # Create IB connection, unless given an IB (e.g. a SimulatedIB)
+        self.ib = ib if ib is not None else self.connect()
+        self.ib.execDetailsEvent += self.on_fill
+        # Create local store of historical bars, topped up from TWS
+        self.bar_store = BarStore(self.ib, timezone=TWS_TIMEZONE)
+        # Create calendar of trading sessions, cached across restarts
+        self.calendar = SessionCalendar(self.ib)
         # Create empty list of instruments, bars, and indicators to track
         self.instruments = []
         self.bars = []
@@ -76,34 +102,88 @@ class IBAlgoStrategy(object):
 
         # Create empty dictionary of DataFrames for instrument bars
         self.dfs = {}
-
-        # Create empty dictionary for trailing stop's enabled (for instruments)
-        self.trailing_stop_enabled = {}
-        # Create empty dictionary for best profit achived (for instruments)
-        self.trade_profit_high = {}
+        # Create empty dictionary of indicator pipelines by bar
+        self.pipelines = {}
+        # Create empty dictionary of streaming indicator engines
+        self.engines = {}
+        # Create empty dictionary of real-time bar aggregators
+        self.aggregators = {}
+        # Create pool of live quotes, one subscription per instrument
+        self.ticker_pool = TickerPool(self.ib)
+        self.ticker_pool.quoteEvent += self.on_quote
+        # Instruments with newly closed streamed bars, and the event that
+        # wakes the run loop for them
+        self.new_bar_instruments = []
+        self.new_data = Event('newData')
+
+        # Create stop loss / trailing stop engine, checked on every quote
+        self.trailing_stops = TrailingStopEngine(SL, PT, PCT)
+        # Create position book, feeding positions to the stop engine
+        self.positions = PositionBook(self.ib)
+        self.positions.updateEvent += self.on_position
+        for con_id, qty in self.positions.quantities.items():
+            self.trailing_stops.set_position(con_id, qty,
+                                             self.positions.avg_prices[con_id])
 
 
 ###############################################################################
     def run(self):
         """Run logic for live trading"""
-        # Get today's trading hours
+        # Get the current or next trading session
         self.get_trading_hours()
+        if self.session_open is None:
+            self.log('Algo not running today.')
+            return
+
+        # Schedule the session: open, EOD exit and close. Bar closes are
+        # scheduled once the market opens.
+        self.scheduler = TimerWheel()
+        self.eod_exit = False
+        self.market_closed = False
+        open_time = self.session_open
+        close_time = self.session_close
+        if time.time() < open_time:
+            self.log('Waiting until the market opens...')
+            self.scheduler.schedule(open_time, self.on_session_open,
+                                    name='session open')
+        else:
+            self.on_session_open()
+        self.scheduler.schedule(close_time - 60*EOD_EXIT_MINUTES,
+                                self.on_eod_exit, name='EOD exit')
+        self.scheduler.schedule(close_time, self.on_session_close,
+                                name='session close')
+
+        # Run loop during exhange hours, sleeping until a timer is due or
+        # a streamed bar closes
+        while not self.market_closed:
+            # Process signals for instruments with new streamed bars
+            while self.new_bar_instruments:
+                self.on_instrument_data(self.new_bar_instruments.pop(0))
+
+            # No new positions are held once the EOD exit has started
+            if self.eod_exit:
+                self.flatten_all()
+
+            # Fire due timers
+            self.scheduler.advance()
+            if self.market_closed:
+                break
 
-        # Wait until the markets open
-        #open_hr = int(self.exchange_open[:2])
-        #open_min = int(self.exchange_open[-2:])
-        #self.log('Waiting until the market opens ({}:{})...'.format(
-        #    open_hr, open_min))
-        #while True:
-        #    now = datetime.datetime.now(tz=pytz.timezone('US/Eastern'))
-        #    if ((now.minute >= open_min) and (now.hour >= open_hr)) or \
-        #       (now.hour >= open_hr+1):
-        #        break
-
-            # Sleep 5 seconds
-        #    self.ib.sleep(5)
-        
-        # Get rid of this if the above code is reimplemented ^^^^^^
+            # Sleep until the next timer
+            timeout = self.scheduler.seconds_until_due(default=60)
+            if STREAMING_BARS:
+                self.wait_for_data(timeout)
+            else:
+                self.ib.sleep(timeout)
+
+        if STREAMING_BARS:
+            self.stop_streaming()
+        self.log('Algo no longer running for the day.')
+
+
+###############################################################################
+    def on_session_open(self):
+        """Start trading: stream bars, or schedule their closes"""
         now = datetime.datetime.now(tz=pytz.timezone('US/Eastern'))
 
         # Exchange is now open
@@ -111,80 +191,72 @@ class IBAlgoStrategy(object):
         self.log('The market is now open {}'.format(now))
         self.start_time = time.time()
 
-        # Set time reference 9:30AM ET for today / 13:30 UTC time
+        # Set time reference 9:30AM ET for today
         # Used for determining when new bars are available
-        self.time_ref = calendar.timegm(time.strptime(
-                now.strftime('%Y-%m-%d') + ' 13:30:00', '%Y-%m-%d %H:%M:%S'))
-
-        # Run loop during exhange hours
-        while True:
-            # Get the time delta from the time reference
-            time_since_open = time.time() - self.time_ref
-
-            # Check for new intraday bars
-            if len(self.bars_minutes)>0:
-                for minutes in self.bars_minutes:
-                    if 60*minutes-(time_since_open%(60*minutes)) <= 5:
-                        # Time to update 'minutes' bar for all instruments
-                        if minutes == 1:
-                            bar = '1 min'
-                        elif minutes < 60:
-                            bar = str(minutes) + ' mins'
-                        elif minutes == 60:
-                            bar = '1 hour'
-                        else:
-                            hours =  minutes/60
-                            bar = str(hours) + ' hours'
-                        # Loop through all instruments and update bar dfs
-                        for instrument in self.instruments:
-                            # Get current df for instrument/bar
-                            df = self.dfs[instrument][bar]
-                            # Update instrument/bar df
-                            df = self.update_bar(df, instrument, bar)
-                            self.dfs[instrument][bar] = df
-                            self.log("Updated {}'s {} df".format(
-                                    instrument.symbol, bar))
-                        # Process signals (new bar)
-                        self.on_data()
-
-            # Perform other checks once per minute (60s)
-            if True:                                                            #5-(time_since_open%5) <= 5: #CONFIRM THIS IS CORRECT
-                # Loop through instruments                                      #if 60-(time_since_open%60) <= 5: (check every minute, 5s margin of error)
-                for instrument in self.instruments:                             #Replaced with Constant check.
-                    # Get current qty
-                    qty = self.get_quantity(instrument)
-                    # Check for trailing exit signal
-                    if qty != 0:
-                        if self.trailing_exit_signal(instrument, qty):
-                            # Go flat
-                            self.go_flat(instrument)
-
-            # Get current ET time
-            now = datetime.datetime.now(tz=pytz.timezone('US/Eastern'))
-
-            # Get number of minutes until the market close
-            close_str = now.strftime('%Y-%m-%d') + "T" \
-                        + self.exchange_close[:2] \
-                        + ":" + self.exchange_close[-2:] + ":00-04:00"
-            close_time = datetime.datetime.strptime(
-                ''.join(close_str.rsplit(':', 1)), '%Y-%m-%dT%H:%M:%S%z')
-            min_to_close = int((close_time-now).seconds/60)
-
-            #Exit for EOD!                                                      #ADDED EOD EXIT
-            if min_to_close <= 30:
-                if qty != 0:
-                    self.go_flat(instrument)
-
-
-            # Check for exchange closing time
-            if min_to_close <= 0:
-                self.log('The market is now closed: {}'.format(now))
-                break
+        self.time_ref = pytz.timezone('US/Eastern').localize(
+                datetime.datetime(now.year, now.month, now.day, 9, 30)
+                ).timestamp()
+
+        # Start streaming intraday bars
+        if STREAMING_BARS:
+            self.start_streaming()
+        # Or request each intraday bar from history when it closes
+        else:
+            for minutes in self.bars_minutes:
+                self.scheduler.schedule_every(
+                        60*minutes, self.on_bar_close, minutes,
+                        offset=self.time_ref + BAR_CLOSE_DELAY,
+                        name='{} min bar close'.format(minutes))
 
-            # Sleep
-            self.ib.sleep(5)
 
-        self.log('Algo no longer running for the day.')
+###############################################################################
+    def on_bar_close(self, minutes):
+        """Update the 'minutes' bar for all instruments and process signals"""
+        if minutes == 1:
+            bar = '1 min'
+        elif minutes < 60:
+            bar = str(minutes) + ' mins'
+        elif minutes == 60:
+            bar = '1 hour'
+        else:
+            hours =  minutes/60
+            bar = str(hours) + ' hours'
+        # Loop through all instruments and update bar dfs
+        for instrument in self.instruments:
+            # Get current df for instrument/bar
+            df = self.dfs[instrument][bar]
+            # Update instrument/bar df
+            df = self.update_bar(df, instrument, bar)
+            self.dfs[instrument][bar] = df
+            self.log("Updated {}'s {} df".format(
+                    instrument.symbol, bar))
+        # Process signals (new bar)
+        self.on_data()
+
+
+###############################################################################
+    def on_eod_exit(self):
+        """Exit for EOD: flatten all instruments before the close"""
+        self.log('Exiting positions {} minutes before the close'.format(
+                EOD_EXIT_MINUTES))
+        self.eod_exit = True
+        self.flatten_all()
+
+
+###############################################################################
+    def on_session_close(self):
+        """Stop the run loop at the exchange close"""
+        now = datetime.datetime.now(tz=pytz.timezone('US/Eastern'))
+        self.log('The market is now closed: {}'.format(now))
+        self.market_closed = True
+
+
+###############################################################################
+    def flatten_all(self):
+        """Go flat in every instrument with a position"""
+        for instrument in self.instruments:
+            if self.get_quantity(instrument) != 0:
+                self.go_flat(instrument)
 
 
 ###############################################################################
@@ -192,45 +264,50 @@ class IBAlgoStrategy(object):
         """Process signals for new bar"""
         # Loop through instruments
         for instrument in self.instruments:
+            self.on_instrument_data(instrument)
 
-            # Get current qty
-            qty = self.get_quantity(instrument)
-            self.log('Current qty for {}: {}'.format(instrument.symbol, qty))
-
-            # Process current long position
-            if qty > 0:
-                # Check for short entry signal
-                if self.short_entry_signal(instrument):
-                    # Reverse position and go short
-                    self.go_short(instrument)
-
-                # Check for long exit signal
-                elif self.long_exit_signal(instrument):
-                    # Go flat
-                    self.go_flat(instrument)
-
-            # Process current short position
-            elif qty < 0:
-                # Check for long entry signal
-                if self.long_entry_signal(instrument):
-                    # Reverse position and go long
-                    self.go_long(instrument)
-
-                # Check for short exit signal
-                elif self.short_exit_signal(instrument):
-                    # Go flat
-                    self.go_flat(instrument)
-
-            # Check for entry signal
-            else:
-                # Check for long entry signal
-                if self.long_entry_signal(instrument):
-                    # Go long
-                    self.go_long(instrument)
-                # Check for short entry signal
-                elif self.short_entry_signal(instrument):
-                    # Go short
-                    self.go_short(instrument)
+
+###############################################################################
+    def on_instrument_data(self, instrument):
+        """Process signals for an instrument's new bar"""
+        # Get current qty
+        qty = self.get_quantity(instrument)
+        self.log('Current qty for {}: {}'.format(instrument.symbol, qty))
+
+        # Process current long position
+        if qty > 0:
+            # Check for short entry signal
+            if self.short_entry_signal(instrument):
+                # Reverse position and go short
+                self.go_short(instrument)
+
+            # Check for long exit signal
+            elif self.long_exit_signal(instrument):
+                # Go flat
+                self.go_flat(instrument)
+
+        # Process current short position
+        elif qty < 0:
+            # Check for long entry signal
+            if self.long_entry_signal(instrument):
+                # Reverse position and go long
+                self.go_long(instrument)
+
+            # Check for short exit signal
+            elif self.short_exit_signal(instrument):
+                # Go flat
+                self.go_flat(instrument)
+
+        # Check for entry signal
+        else:
+            # Check for long entry signal
+            if self.long_entry_signal(instrument):
+                # Go long
+                self.go_long(instrument)
+            # Check for short entry signal
+            elif self.short_entry_signal(instrument):
+                # Go short
+                self.go_short(instrument)
 
 
 
@@ -335,97 +412,48 @@ class IBAlgoStrategy(object):
 
 
 ###############################################################################
-    def trailing_exit_signal(self, instrument, qty):
+    def trailing_exit_signal(self, instrument, mid):
         """
-        Check for trailing exit signal for the instrument.
+        Check for trailing exit signal for the instrument at price mid.
         Also checks for the initial stop loss exit signal for the instrument.
         Returns True or False.
         """
-        self.log('Checking for stop loss or trailing stop exit for {}'.format(
-                instrument.symbol))
-
-        # Get cost basis for instrument
-        cost_basis = self.get_cost_basis(instrument)
-        dollar_cost = cost_basis*qty
-
-        # Get latest prices for instrument
-        bid, ask, mid = self.get_price(instrument)
-        # Verify valid prices
-        if mid is None:
+        event = self.trailing_stops.evaluate(instrument.conId, mid)
+        if event is None:
             return False
-
-        # Calculate current dollar profit (Per Position basis, not contract)
-        if qty > 0:
-            # Long position
-            profit = (mid-cost_basis)*qty
-        elif qty < 0:
-            # Short position
-            profit = (cost_basis-mid)*qty
+        record = self.trailing_stops.records[instrument.conId]
+        profit = record.profit
 
         # Check if the stop loss is triggered
-        if profit <= -abs(SL):
+        if event == 'stop_loss':
             self.log('Stop loss exit triggered for {}, profit={}'.format(
                     instrument.symbol, profit))
             return True
 
         # Check if trailing stop should be enabled (PT reached)
-        if not self.trailing_stop_enabled[instrument]:
-            if profit >= PT:
-                # Set trailing stop to be enabled and save high profit
-                self.trailing_stop_enabled[instrument] = True
-                self.trade_profit_high[instrument] = 0
-                PNL[instrument] += profit                                       #Added PNL Increment
-                self.log('Trailing stop for {} enabled, profit={}'.format(
-                        instrument.symbol, profit))
+        if event == 'trail_enabled':
+            PNL[instrument] = PNL.get(instrument, 0) + profit                 #Added PNL Increment
+            self.log('Trailing stop for {} enabled, profit={}'.format(
+                    instrument.symbol, profit))
             # Always return False for exit signal if not previously turned on
             return False
 
-        # Trailing stop previously enabled, so check for exit signal
-        # Check for new profit high
-        if profit > self.trade_profit_high[instrument]:
-            # Update trade profit and return False for signal
-            self.trade_profit_high[instrument] = profit
-            return False
-
-        # Check for exit signal
-        exit_trigger = (1.0-PCT)*self.trade_profit_high[instrument]
-        if profit < exit_trigger:
-            PNL[instrument] += profit                                           #Added PNL Increment
-            self.log("Trailing exit triggered for {}: profit={}, "
-                     "high profit={}".format(
-                             instrument.symbol, profit,
-                             self.trade_profit_high[instrument]))
-            return True
-        return False
+        # Trailing exit triggered
+        PNL[instrument] = PNL.get(instrument, 0) + profit                     #Added PNL Increment
+        self.log("Trailing exit triggered for {}: profit={}, "
+                 "high profit={}".format(
+                         instrument.symbol, profit, record.profit_high))
+        return True
 
 
 ###############################################################################
     def get_price(self, instrument):
         """Get the current bid, ask, and mid price for an instrument"""
-        # Create IB object to request price info
-        ticker = self.ib.reqMktData(instrument, "", False, False)
-        # Wait 2 seconds
-        self.ib.sleep(2.0)
-        # Loop until getting bid and ask or 20s max
-        bid = None
-        ask = None
-        for i in range(100):
-            self.ib.sleep(0.2)
-            if ticker.bid is not None and ticker.ask is not None:
-                bid = float(ticker.bid)
-                ask = float(ticker.ask)
-                break
-
-        # Check for valid bid and ask
-        try:
-            mid = round((bid+ask)/2,2)
-        except:
+        # Latest quote from the instrument's streaming subscription
+        bid, ask, mid = self.ticker_pool.get_quote(instrument)
+        if mid is None:
             self.log('Error getting current bid/ask prices for {}'.format(
                     instrument))
-            return None, None, None
-
-        #self.log('{} current bid={}, ask={}, mid={}'.format(
-        #        instrument.symbol, bid, ask, mid))
         return bid, ask, mid
 
 
@@ -444,12 +472,13 @@ class IBAlgoStrategy(object):
         #order_qty = desired_qty-qty
         #TEMP CODE:
         order_qty = 5
+        self.journal.record('decision', symbol=instrument.symbol,
+                            action='long', qty=qty, order_qty=order_qty)
         # Place market order to go long
         self.market_order(instrument, 'BUY', abs(order_qty))
-        # Set trailing stop enabled to False for instrument
-        self.trailing_stop_enabled[instrument] = True
-        # Set trade profit high to date to be zero
-        self.trade_profit_high[instrument] = 0
+        # Set trailing stop enabled for instrument, with a trade profit
+        # high to date of zero
+        self.trailing_stops.reset(instrument.conId, enabled=True)
 
 
 ###############################################################################
@@ -467,12 +496,13 @@ class IBAlgoStrategy(object):
         # order_qty = desired_qty-qty
         # Temporary:
         order_qty = 5
+        self.journal.record('decision', symbol=instrument.symbol,
+                            action='short', qty=qty, order_qty=order_qty)
         # Place market order to go short
         self.market_order(instrument, 'SELL', abs(order_qty))
-        # Set trailing stop enabled to False for instrument
-        self.trailing_stop_enabled[instrument] = True
-        # Set trade profit high to date to be zero
-        self.trade_profit_high[instrument] = 0
+        # Set trailing stop enabled for instrument, with a trade profit
+        # high to date of zero
+        self.trailing_stops.reset(instrument.conId, enabled=True)
 
 
 ###############################################################################
@@ -488,6 +518,8 @@ class IBAlgoStrategy(object):
         else:
             self.log('{} already FLAT.'.format(instrument.symbol))
             return
+        self.journal.record('decision', symbol=instrument.symbol,
+                            action='flat', qty=qty, order_qty=-qty)
         # Place market order to go flat
         self.market_order(instrument, action, abs(qty))
 
@@ -518,77 +550,14 @@ class IBAlgoStrategy(object):
 ###############################################################################
     def get_quantity(self, instrument):
         """Returns the current quantity held for instrument"""
-        # Get instrument type
-        if str(type(instrument))[-7:-2] == 'Stock':
-            instrument_type = 'Stock'
-        elif str(type(instrument))[-7:-2] == 'Option':
-            instrument_type = 'Option'
-        elif str(type(instrument))[-7:-2] == 'Future':
-            instrument_type = 'Future'
-        elif str(type(instrument))[-7:-2] == 'Forex':
-            instrument_type = 'Forex'
-        else:
-            raise ValueError('Invalid instrument type ({}) for '
-                             'current_quantity'.format(type(instrument)))
-
-        # Loop through all current positions
-        for position in self.ib.positions():
-            # Verify position is for instrument
-            contract = position.contract
-            if instrument_type == 'Stock':
-                try:
-                    if contract.secType == 'STK' and \
-                        contract.localSymbol == instrument.symbol:
-                        return int(position.position)
-                except:
-                    continue
-            elif instrument_type == 'Option':
-                pass
-            elif instrument_type == 'Future':
-                pass
-            elif instrument_type == 'Forex':
-                try:
-                    if contract.secType == 'CASH' and \
-                        contract.localSymbol == instrument.symbol:
-                        return int(position.position)
-                except:
-                    continue
-        return 0
+        return int(self.positions.get_quantity(instrument))
 
 
 ###############################################################################
     def get_cost_basis(self, instrument):
         """Returns the current cost basis for an instrument's position"""
-        # Get instrument type
-        if str(type(instrument))[-7:-2] == 'Stock':
-            instrument_type = 'Stock'
-        elif str(type(instrument))[-7:-2] == 'Option':
-            instrument_type = 'Option'
-        elif str(type(instrument))[-7:-2] == 'Future':
-            instrument_type = 'Future'
-        elif str(type(instrument))[-7:-2] == 'Forex':
-            instrument_type = 'Forex'
-        else:
-            raise ValueError('Invalid instrument type ({}) for '
-                             'current_quantity'.format(type(instrument)))
-
-        # Loop through all current positions
-        for position in self.ib.positions():
-            # Verify position is for instrument
-            contract = position.contract
-            if instrument_type == 'Stock':
-                try:
-                    if contract.secType == 'STK' and \
-                        contract.localSymbol == instrument.symbol:
-                        return float(position.avgCost)
-                except:
-                    continue
-            elif instrument_type == 'Option':
-                pass
-            elif instrument_type == 'Future':
-                pass
-
-        return 0
+        # Average price per unit, for all instrument types (incl. Forex)
+        return self.positions.get_avg_price(instrument)
 
 
 ###############################################################################
@@ -605,7 +574,8 @@ class IBAlgoStrategy(object):
                 )
         self.log('{}ING {} units of {} at MARKET'.format(
                 action, qty, instrument.symbol))
-        self.ib.placeOrder(instrument, market_order)
+        trade = self.ib.placeOrder(instrument, market_order)
+        self.record_order(trade)
 
 
 ###############################################################################
@@ -623,7 +593,32 @@ class IBAlgoStrategy(object):
                 )
         self.log('{}ING {} units of {} at {} LIMIT'.format(
                 action, qty, instrument.symbol, limit_price))
-        self.ib.placeOrder(instrument, limit_order)
+        trade = self.ib.placeOrder(instrument, limit_order)
+        self.record_order(trade)
+
+
+###############################################################################
+    def record_order(self, trade):
+        """Journal an order as placed"""
+        order = trade.order
+        self.journal.record('order', symbol=trade.contract.symbol,
+                            order_id=order.orderId, action=order.action,
+                            order_type=order.orderType,
+                            qty=order.totalQuantity,
+                            limit=order.lmtPrice if order.orderType == 'LMT'
+                            else None,
+                            status=trade.orderStatus.status)
+
+
+###############################################################################
+    def on_fill(self, trade, fill):
+        """Journal each execution"""
+        execution = fill.execution
+        self.journal.record('fill', symbol=fill.contract.symbol,
+                            exec_id=execution.execId,
+                            order_id=execution.orderId, side=execution.side,
+                            shares=execution.shares, price=execution.price,
+                            exec_time=execution.time)
 
 
 ###############################################################################
@@ -646,50 +641,41 @@ class IBAlgoStrategy(object):
 
 ###############################################################################
     def log(self, msg=""):
-        """Add log to output file"""
-        self.logger.info(msg)
-        if not USING_NOTEBOOK:
-            print(msg)
+        """Add log to the event journal"""
+        self.journal.log(msg)
 
 
 ###############################################################################
     def get_trading_hours(self):
-        """Get today's trading hours for algo's instruments"""
+        """Get the current or next trading session for algo's instruments"""
         open_time = None
         close_time = None
 
-        # Get todays date in YYYYMMDD format
-        today = datetime.datetime.today().strftime('%Y%m%d')
-
         # Loop through instruments
         for instrument in self.instruments:
-            # Get contract details
-            contract_details = self.ib.reqContractDetails(instrument)[0]
-            # Get regular trading hours for today
-            trading_hours_list = contract_details.liquidHours.split(';')
-            for item in trading_hours_list:
-                if item[:8] == today:
-                    # Update open time
-                    if open_time is None:
-                        open_time = item.split('-')[0].split(':')[1]
-                    else:
-                        if item.split('-')[0].split(':')[1] < open_time:
-                            open_time = item.split('-')[0].split(':')[1]
-                    # Update close time
-                    if close_time is None:
-                        close_time = item.split('-')[1].split(':')[1]
-                    else:
-                        if item.split('-')[1].split(':')[1] > close_time:
-                            close_time = item.split('-')[1].split(':')[1]
-                    break
+            # Sessions are cached, and only requested from TWS when needed
+            session = self.calendar.session(instrument)
+            if session is None:
+                continue
+            # Update open time
+            if open_time is None or session[0] < open_time:
+                open_time = session[0]
+            # Update close time
+            if close_time is None or session[1] > close_time:
+                close_time = session[1]
 
         # Save earliest start time
-        self.exchange_open = open_time
+        self.session_open = open_time
         # Save latest end time
-        self.exchange_close = close_time
+        self.session_close = close_time
         self.log()
-        self.log("Today's exchange hours are {}-{}".format(
-                self.exchange_open, self.exchange_close))
+        if open_time is None:
+            self.log('No trading session found for the instruments')
+            return
+        eastern = pytz.timezone('US/Eastern')
+        self.log("Exchange hours are {}-{} ET".format(
+                datetime.datetime.fromtimestamp(open_time, tz=eastern),
+                datetime.datetime.fromtimestamp(close_time, tz=eastern)))
 
 
 ###############################################################################
@@ -727,9 +713,12 @@ class IBAlgoStrategy(object):
         # Append instrument to algo list
         self.ib.qualifyContracts(instrument)
         self.instruments.append(instrument)
+        # Start streaming quotes for instrument
+        self.ticker_pool.subscribe(instrument)
 
         # Create dictionary for instrument bars
         self.dfs[instrument] = {}
+        self.engines[instrument] = {}
 
 
 ###############################################################################
@@ -747,6 +736,7 @@ class IBAlgoStrategy(object):
         self.bars.append(bar)
 
         # Get bar minutes (when applicable)
+        bar_minutes = None
         if bar[-3:] == 'min' or bar[-4:] == 'mins':
             # min bar
             bar_minutes = int(bar.split(' ')[0])
@@ -757,34 +747,62 @@ class IBAlgoStrategy(object):
             bar_minutes = 60*int(bar.split(' ')[0])
             self.bars_minutes.append(bar_minutes)
 
+        # Bar frames hold the history plus a day of new bars
+        if bar_minutes is None:
+            day_bars = 1
+        else:
+            day_bars = 24*60 // bar_minutes
+
+        # Build the indicator pipeline for the bar
+        self.pipelines[bar] = self.get_pipeline(bar)
+
         # Initialize dfs for all instruments
         for instrument in self.instruments:
             # Get ohlc pandas DataFrame
             df = self.get_historical_data(instrument, bar)
-            # Add indicators to df and save to algo
-            self.dfs[instrument][bar] = self.add_indicators(df)
+            # Add indicators to df and save to algo as a bar frame
+            df = self.add_indicators(df, bar)
+            self.dfs[instrument][bar] = self.get_bar_frame(
+                df, bar, len(df) + day_bars)
+            # Create streaming indicators to update df bar by bar
+            self.engines[instrument][bar] = self.get_indicator_engine(df, bar)
 
 
 ###############################################################################
-    def get_historical_data(self, instrument, bar, end_date="", use_RTH=True):
+    def get_historical_data(self, instrument, bar, end_date="", use_RTH=True,
+                            duration=None):
         """
         Get historical bars for instrument.
         https://interactivebrokers.github.io/tws-api/historical_bars.html
         """
-        # Get max duration for a given bar size
-        if bar in ['1 day','1 week','1 month']:
-            duration = '1 Y' # one year
-        elif bar in ['30 mins','1 hour','2 hours','3 hours','4 hours','8 hours']:
-            duration = '1 M' # one month
-        elif bar in ['3 mins','10 mins','20 mins']:
-            duration = '1 W' # one week
-        elif bar == '2 mins':
-            duration = '2 D' # two days
-        elif bar == '1 min':
-            duration = '1 D' # one day
-        else:
-            raise ValueError(
-                    'Invalid bar: {} for get_historical_data()'.format(bar))
+        # Get max duration for a given bar size (unless given)
+        if duration is None:
+            if bar in ['1 day','1 week','1 month']:
+                duration = '1 Y' # one year
+            elif bar in ['30 mins','1 hour','2 hours','3 hours','4 hours','8 hours']:
+                duration = '1 M' # one month
+            elif bar in ['3 mins','10 mins','20 mins']:
+                duration = '1 W' # one week
+            elif bar == '2 mins':
+                duration = '2 D' # two days
+            elif bar == '1 min':
+                duration = '1 D' # one day
+            else:
+                raise ValueError(
+                        'Invalid bar: {} for get_historical_data()'.format(bar))
+
+        # Up to date bars come from the local bar store, which only
+        # requests the bars it is missing from TWS
+        if end_date == "":
+            hist = self.bar_store.get_bars(instrument, bar,
+                                           what_to_show='MIDPOINT',
+                                           duration=duration,
+                                           use_rth=use_RTH)
+            hist.set_index('date', inplace=True)
+            # Intraday bars are stored in UTC, daily bars as dates
+            if bar in ['1 day','1 week','1 month']:
+                return hist.tz_localize(TWS_TIMEZONE)
+            return hist.tz_localize('UTC').tz_convert(TWS_TIMEZONE)
 
         # Get historical bars        
         bars = self.ib.reqHistoricalData(
@@ -813,59 +831,175 @@ class IBAlgoStrategy(object):
 ###############################################################################
     def update_bar(self, df, instrument, bar, end_date="", use_RTH=True):
         """
-        Update historical bars for instrument df.
+        Update historical bars for instrument bar frame.
         """
-        # Set duration for 1 day
-        duration = '1 D' # one day
+        # Get the last day of bars
+        hist = self.get_historical_data(instrument, bar, end_date, use_RTH,
+                                        duration='1 D')
+
+        # Keep bars from the last df bar onwards. The last df bar may have
+        # still been forming when it was fetched, so it gets replaced.
+        hist = hist[hist.index >= df.index[-1]]
+        if len(hist) == 0:
+            return df
+        df.truncate(hist.index[0])
+
+        # Append new bars with their indicators (the last is still forming)
+        engine = self.engines[instrument][bar]
+        for row in hist.iloc[:-1].itertuples():
+            values = engine.update(row.high, row.low, row.close,
+                                   date=row.Index)
+            df.append(row.Index, open=row.open, high=row.high, low=row.low,
+                      close=row.close, **values)
+        last = hist.iloc[-1]
+        values = engine.peek(last['high'], last['low'], last['close'])
+        df.append(hist.index[-1], open=last['open'], high=last['high'],
+                  low=last['low'], close=last['close'], **values)
 
-        # Get historical bars
-        bars = self.ib.reqHistoricalData(
-            instrument,
-            endDateTime=end_date,
-            durationStr=duration,
-            barSizeSetting=bar,
-            whatToShow='MIDPOINT',
-            useRTH=use_RTH) # use regular trading hours
+        return df
 
-        # Convert bars to a pandas dataframe
-        hist = util.df(bars)
 
-        # Make the 'date' column the index
-        hist.set_index('date', inplace=True)
+###############################################################################
+    def start_streaming(self):
+        """Stream 5 second bars and aggregate them into the intraday bars"""
+        bars = [b for b in self.bars if b[-3:] == 'min' or b[-4:] == 'mins'
+                or b[-4:] == 'hour' or b[-5:] == 'hours']
+        if not bars:
+            return
+        for instrument in self.instruments:
+            aggregator = BarAggregator(self.ib, instrument, bars,
+                                       what_to_show='MIDPOINT')
+            aggregator.barEvent += self.on_bar
+            aggregator.start()
+            self.aggregators[instrument] = aggregator
+        self.log('Streaming {} bars'.format(bars))
 
-        # Remove the 'volume', 'barCount', and 'average' columns
-        hist.drop(columns=['volume', 'barCount', 'average'], inplace=True)
 
-        # Add TWS time zone to datetimes
-        hist = hist.tz_localize(TWS_TIMEZONE)
+###############################################################################
+    def stop_streaming(self):
+        """Cancel real-time bar subscriptions"""
+        for aggregator in self.aggregators.values():
+            aggregator.barEvent -= self.on_bar
+            aggregator.stop()
+        self.aggregators.clear()
 
-        # Check if hist last date != df last date
-        if hist.index[-1] != df.index[-1]:
-            # Append new bar to df
-            try:
-                df = df.append(hist, sort=True)
-            except:
-                df = df.append(hist)
-            # Add indicators to df
-            df = self.add_indicators(df)
 
-        return df
+###############################################################################
+    def wait_for_data(self, timeout):
+        """Sleep up to timeout seconds, returning early on new bars"""
+        if self.new_bar_instruments:
+            return
+        try:
+            util.run(asyncio.wait_for(self.new_data, timeout))
+        except asyncio.TimeoutError:
+            pass
 
 
 ###############################################################################
-    def add_indicators(self, df):
-        """Add technical indicators to pandas DataFrame"""
-        # Check for RSI in indicators
-        if 'RSI' in self.indicators:
-            # Add RSI to df
-            df = self.get_RSI(df)
-        # Check for ATR in indicators
-        if 'ATR' in self.indicators:
-            df = self.get_ATR(df)
-        if 'HL' in self.indicators:
-            df = self.get_HL(df)
+    def on_bar(self, instrument, bar, new_bar):
+        """
+        Add a closed streamed bar to the instrument/bar df.
+        Signals are processed from the run loop, not from this callback.
+        """
+        df = self.dfs[instrument][bar]
+        engine = self.engines[instrument][bar]
+        date = pd.Timestamp(new_bar.date).tz_convert(TWS_TIMEZONE)
+        high, low = new_bar.high, new_bar.low
+        open_ = new_bar.open
+
+        # Commit df bars the engine has not seen (the last bar from history)
+        first = 0
+        if engine.last_date is not None:
+            first = df.index.searchsorted(engine.last_date, side='right')
+        for i in range(first, df.index.searchsorted(date)):
+            row = df.row(i)
+            engine.update(row['high'], row['low'], row['close'],
+                          date=row['date'])
+
+        # Streaming may have started part way through the bar, so merge
+        # in the part of it that came from history
+        if len(df) > 0 and df.index[-1] == date:
+            last = df.row(-1)
+            open_ = last['open']
+            high = max(high, last['high'])
+            low = min(low, last['low'])
+
+        values = engine.update(high, low, new_bar.close, date=date)
+        df.truncate(date)
+        df.append(date, open=open_, high=high, low=low, close=new_bar.close,
+                  **values)
+        self.dfs[instrument][bar] = df
+        self.journal.record('indicators', symbol=instrument.symbol, bar=bar,
+                            date=date, open=open_, high=high, low=low,
+                            close=new_bar.close, **values)
+
+        if instrument not in self.new_bar_instruments:
+            self.new_bar_instruments.append(instrument)
+        self.new_data.emit(instrument)
+
+
+###############################################################################
+    def on_quote(self, instrument, bid, ask, mid):
+        """Check stops on every new quote, going flat when one triggers"""
+        if self.trailing_exit_signal(instrument, mid):
+            # Go flat
+            self.go_flat(instrument)
+            latency = self.trailing_stops.exit_sent(instrument.conId)
+            self.journal.record('trigger', symbol=instrument.symbol,
+                                price=mid, latency=latency)
+
+
+###############################################################################
+    def on_position(self, contract, qty, avg_price):
+        """Keep the stop engine's positions current"""
+        self.trailing_stops.set_position(contract.conId, qty, avg_price)
+
+
+###############################################################################
+    def get_pipeline(self, bar):
+        """
+        Returns the indicator pipeline for bar: the indicators that
+        signals read from it, sharing their intermediate calculations.
+        """
+        outputs = []
+        if bar == self.bars[0]:
+            for names in SIGNAL_INDICATORS.values():
+                outputs += [n for n in names if n not in outputs]
+
+        # Indicators configured with add_RSI/add_ATR/add_HL
+        nodes = indicator_nodes(
+            rsi_length=self.RSI_length if 'RSI' in self.indicators else None,
+            rsi_alpha=getattr(self, 'RSI_alpha', 'Wilders'),
+            atr_length=self.ATR_length if 'ATR' in self.indicators else None,
+            atr_mamode=getattr(self, 'ATR_mamode', 'Simple'),
+            hl_length=self.HL_Len if 'HL' in self.indicators else None)
+        return IndicatorPipeline(nodes, outputs)
+
+
+###############################################################################
+    def add_indicators(self, df, bar):
+        """Add bar's technical indicators to pandas DataFrame"""
+        return pd.concat([df, self.pipelines[bar].compute(df)], axis=1)
 
-        return df
+
+###############################################################################
+    def get_bar_frame(self, df, bar, capacity):
+        """Returns df's OHLC and indicator columns as a bar frame"""
+        columns = ['open', 'high', 'low', 'close']
+        columns += self.pipelines[bar].outputs
+        return BarFrame.from_frame(df, columns, capacity)
+
+
+###############################################################################
+    def get_indicator_engine(self, df, bar):
+        """
+        Returns bar's streaming indicators primed with df's bars.
+        The last bar of df is still forming, so it is not committed.
+        """
+        engine = self.pipelines[bar].engine()
+        for row in df.iloc[:-1].itertuples():
+            engine.update(row.high, row.low, row.close, date=row.Index)
+        return engine
 
 
 ###############################################################################
@@ -883,30 +1017,6 @@ class IBAlgoStrategy(object):
         self.indicators.append('RSI')
 
 
-###############################################################################
-    def get_RSI(self, df):
-        """Add the RSI calculations to pandas DataFrame"""
-        # Using Wilder's EMA: alpha=1/n instead of standard alpha = 2/(n+1)
-        df['delta'] = df['close'].diff()
-        df['gain'], df['loss'] = df['delta'].copy(), df['delta'].copy()
-        df['gain'][df['gain']<0] = 0
-        df['loss'][df['loss']>0] = 0
-
-        # Get alpha for RSI EMA
-        if self.RSI_alpha == 'Wilders': # alpha=1/n
-            alpha = float(1.0/self.RSI_length)
-        elif self.RSI_alpha == 'Standard':
-            alpha = float(2.0/(self.RSI_length+1))
-
-        # Calculate the avg gain and loss
-        df['avg_gain'] = df['gain'].ewm(alpha=alpha).mean()
-        df['avg_loss'] = df['loss'].ewm(alpha=alpha).mean()
-
-        # Calculate RS and RSI
-        df['RSI'] = abs(df['avg_gain']/df['avg_loss'])
-        df['RSI'] = 100.0-(100.0/(1+df['RSI']))
-        return df
-
 ############################################################################### ---Addit
 
     def add_HL(self,length):
@@ -916,40 +1026,20 @@ class IBAlgoStrategy(object):
         self.HL_Len = length
         self.indicators.append('HL')
 
-############################################################################### ---Addit
-
-    def get_HL(self,df):
-        '''Adds HH LL (both) to pd DF'''
-        c = df['close']
-        #High
-        for i in range(self.HL_Len - 1):
-            if c.iloc[-i] < c.iloc[-i -1]:
-                df['HH'] = False
-            df['HH'] = True
-        for i in range(self.HL_Len - 1):
-            if c.iloc[-i] > c.iloc[-i -1]:
-                df['LL'] = False
-            df['LL'] = True
-        return df
-
 ###############################################################################
-    def add_ATR(self, length):
+    def add_ATR(self, length, mamode='Simple'):
         """Add the ATR indicator to the list of indicators."""
+        # Verify correct mamode input
+        valid_mamode_list = ['Simple', 'Wilders']
+        if mamode not in valid_mamode_list:
+            raise ValueError('Invalid ATR mamode input ({}). Must be {}'.format(
+                    mamode, valid_mamode_list))
         # Save ATR input parameters to algo
         self.ATR_length = length
+        self.ATR_mamode = mamode
         # Add ATR to list of indicators
         self.indicators.append('ATR')
 
-###############################################################################
-    def get_ATR(self, df):
-        """Add the ATR calculations to pandas DataFrame"""
-        df['tr1'] = df['high'] - df['low'] # H-L
-        df['tr2'] = abs(df['high'] - df['close'].shift()) # abs(H-prev_close)
-        df['tr3'] = abs(df['low'] - df['close'].shift()) # abs(L-prev_close)
-        df['tr'] = df[['tr1', 'tr2', 'tr3']].apply(max,axis=1) #axis=1 for row max, axis=0 for column max
-        df['atr'] = df['tr'].rolling(self.ATR_length).mean()
-        return df
-
 ############################################################################### #ADDED
     '''DYNAMIC VERSION OF FIXED QTY IN USD -- CALCULATES EACH TIME'''
 
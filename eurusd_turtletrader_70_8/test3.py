@@ -34,6 +34,7 @@ import pytz
 import sys
 import pandas as pd
 import pandas_ta as ta
+from order_batch import submit_order_groups
 
 #####################################################
 # Algorithmic strategy class for interactive brokers:
@@ -289,10 +290,9 @@ class IBAlgoStrategy(object):
                                     + str(instrument.localSymbol)
                                     + str(self.ib.client.getReqId()),
                                     ocaType=1)
-        for o in oca:
-            self.ib.placeOrder(instrument, o)
-            #self.log("Placed order {}".format(o))
-            self.ib.sleep(2)
+        # Place each bracket in one go, waiting for TWS to acknowledge
+        submit_order_groups(self.ib, instrument, [long_bracket,
+                                                  short_bracket])
         # self.log("Current Orders Number = {}"
         #          .format(len(self.ib.openOrders())))
 
@@ -310,10 +310,7 @@ class IBAlgoStrategy(object):
                                                    instrument,
                                                    price_condition,
                                                    sl_size)
-        for o in bracket:
-            self.ib.placeOrder(instrument, o)
-            #self.log("Placed order {}".format(o))
-            self.ib.sleep(2)
+        submit_order_groups(self.ib, instrument, [bracket])
 
 #####################################################
     def place_compound_short_order(self, instrument, indicators, parent):
@@ -0,0 +1,85 @@
+#####################################################
+# Persistent market data subscriptions.
+#
+# One reqMktData subscription per contract (by conId), kept open for the
+# session. The latest bid, ask and mid of each contract are updated from
+# pendingTickersEvent, and quoteEvent is emitted for every contract whose
+# quote changed, so callers can react to ticks instead of polling.
+import math
+import time
+from eventkit import Event
+
+
+#####################################################
+def valid_price(price):
+    """True for a usable price (TWS sends NaN or -1 when there is none)"""
+    return price is not None and not math.isnan(price) and price > 0
+
+
+#####################################################
+class TickerPool(object):
+    """
+    Latest quotes of subscribed contracts, kept current from ticks.
+    quoteEvent emits (contract, bid, ask, mid) on each quote change.
+    """
+
+    def __init__(self, ib, timeout=20.0):
+        """Initialize pool, waiting up to timeout for a first quote"""
+        self.ib = ib
+        self.timeout = timeout
+        self.tickers = {}    # conId -> ticker
+        self.contracts = {}  # id(ticker) -> contract
+        self.quotes = {}     # conId -> (bid, ask, mid)
+        self.updated = {}    # conId -> time of latest quote
+        self.quoteEvent = Event('quoteEvent')
+        ib.pendingTickersEvent += self.on_pending_tickers
+
+    def subscribe(self, contract):
+        """Starts streaming a contract's quotes, once"""
+        if contract.conId not in self.tickers:
+            ticker = self.ib.reqMktData(contract, '', False, False)
+            self.tickers[contract.conId] = ticker
+            self.contracts[id(ticker)] = contract
+            self.on_ticker(ticker)
+
+    def unsubscribe_all(self):
+        """Cancels all market data subscriptions"""
+        for ticker in self.tickers.values():
+            self.ib.cancelMktData(ticker.contract)
+        self.tickers.clear()
+        self.contracts.clear()
+
+    def on_pending_tickers(self, tickers):
+        """Stores the quotes of updated tickers"""
+        for ticker in tickers:
+            if id(ticker) in self.contracts:
+                self.on_ticker(ticker)
+
+    def on_ticker(self, ticker):
+        """Stores a ticker's quote if it has a bid and ask"""
+        bid, ask = ticker.bid, ticker.ask
+        if not valid_price(bid) or not valid_price(ask):
+            return
+        contract = self.contracts[id(ticker)]
+        quote = (float(bid), float(ask), (bid + ask) / 2.0)
+        if self.quotes.get(contract.conId) != quote:
+            self.quotes[contract.conId] = quote
+            self.updated[contract.conId] = time.time()
+            self.quoteEvent.emit(contract, *quote)
+
+    def get_quote(self, contract):
+        """
+        Returns the latest (bid, ask, mid) for contract, waiting for the
+        first quote if needed. Returns (None, None, None) on timeout.
+        """
+        self.subscribe(contract)
+        deadline = time.time() + self.timeout
+        while contract.conId not in self.quotes:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.ib.waitOnUpdate(timeout=remaining):
+                return None, None, None
+        return self.quotes[contract.conId]
+
+    def age(self, contract):
+        """Returns seconds since contract's quote last changed"""
+        return time.time() - self.updated.get(contract.conId, 0.0)
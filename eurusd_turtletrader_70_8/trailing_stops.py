@@ -0,0 +1,119 @@
+#####################################################
+# Tick-driven stop loss and trailing stop engine.
+#
+# Keeps one compact record per instrument (keyed by conId) with the
+# position, the stop loss / profit target / trailing percent, and the
+# profit high-water mark. evaluate() is called with every new mid price
+# and says what, if anything, the tick triggered:
+#   'stop_loss'      - profit fell to -stop_loss
+#   'trail_enabled'  - profit reached profit_target, trailing is now on
+#   'trailing_exit'  - profit fell pct below its high since trailing began
+# An exit disarms the record until a new position opens (from flat, or
+# reversed through it), so partial fills of the exit order do not send
+# another; the time from the triggering tick to exit_sent() is kept as
+# the exit latency.
+import time
+
+
+#####################################################
+class StopRecord(object):
+    """
+    Stop state of one instrument
+    """
+    __slots__ = ('quantity', 'cost_basis', 'stop_loss', 'profit_target',
+                 'trail_pct', 'enabled', 'profit_high', 'profit',
+                 'triggered_at')
+
+    def __init__(self, stop_loss, profit_target, trail_pct):
+        """Initialize record with no position"""
+        self.quantity = 0.0
+        self.cost_basis = 0.0
+        self.stop_loss = stop_loss
+        self.profit_target = profit_target
+        self.trail_pct = trail_pct
+        self.enabled = False
+        self.profit_high = 0.0
+        self.profit = 0.0
+        self.triggered_at = None
+
+
+#####################################################
+class TrailingStopEngine(object):
+    """
+    Stop loss / trailing stop state for all instruments
+    """
+
+    def __init__(self, stop_loss, profit_target, trail_pct):
+        """Initialize engine with default SL, PT and trailing percent"""
+        self.stop_loss = stop_loss
+        self.profit_target = profit_target
+        self.trail_pct = trail_pct
+        self.records = {}    # conId -> StopRecord
+        self.latencies = []  # seconds from trigger to exit order
+
+    def record(self, key):
+        """Returns the record for key, creating it if needed"""
+        record = self.records.get(key)
+        if record is None:
+            record = StopRecord(self.stop_loss, self.profit_target,
+                                self.trail_pct)
+            self.records[key] = record
+        return record
+
+    def set_position(self, key, quantity, cost_basis):
+        """Updates the position behind key's stops"""
+        record = self.record(key)
+        if quantity != 0 and quantity * record.quantity <= 0:
+            # A new position re-arms stops that already fired, while a
+            # partly filled exit leaves them disarmed
+            record.triggered_at = None
+        record.quantity = quantity
+        record.cost_basis = cost_basis
+
+    def reset(self, key, enabled=False):
+        """Starts a new trade: trailing enabled or not, no profit high"""
+        record = self.record(key)
+        record.enabled = enabled
+        record.profit_high = 0.0
+        record.triggered_at = None
+
+    def evaluate(self, key, mid):
+        """Returns the event a new mid price triggers, or None"""
+        record = self.records.get(key)
+        if record is None or record.quantity == 0 \
+                or record.triggered_at is not None:
+            return None
+
+        # Current profit on the whole position
+        profit = (mid - record.cost_basis) * record.quantity
+        record.profit = profit
+
+        # Stop loss
+        if profit <= -abs(record.stop_loss):
+            record.triggered_at = time.perf_counter()
+            return 'stop_loss'
+
+        # Trailing stop is enabled once the profit target is reached
+        if not record.enabled:
+            if profit >= record.profit_target:
+                record.enabled = True
+                record.profit_high = 0.0
+                return 'trail_enabled'
+            return None
+
+        # New profit high
+        if profit > record.profit_high:
+            record.profit_high = profit
+            return None
+
+        # Trailing exit
+        if profit < (1.0 - record.trail_pct) * record.profit_high:
+            record.triggered_at = time.perf_counter()
+            return 'trailing_exit'
+        return None
+
+    def exit_sent(self, key):
+        """Records and returns the latency of key's exit order"""
+        latency = time.perf_counter() - self.records[key].triggered_at
+        self.latencies.append(latency)
+        return latency
@@ -0,0 +1,148 @@
+#####################################################
+# Turtle unit state machine.
+#
+# One compact record per instrument holds its turtle state:
+#   flat      - no position, entry orders rest on both sides
+#   long n/4  - long, with n of 4 pyramid units' worth of risk
+#   short n/4 - short, with n of 4 pyramid units' worth of risk
+#   exiting   - a stop or exit has filled and the position is not yet flat
+# Fills and account cash balances move the position and the state. The
+# exposure (|position| * stop size * rate, in base currency) and pyramid
+# level are recomputed only when the position, stop size, rate or unit
+# size change. orders_key records what a record's resting orders were
+# placed for, so a cycle in which nothing changed need place nothing.
+# A cash balance may be reported before or after the fill that moved it,
+# so a FillReconciler keeps a fill from being counted twice.
+from position_book import FillReconciler
+
+FLAT = 'flat'
+LONG = 'long'
+SHORT = 'short'
+EXITING = 'exiting'
+
+
+#####################################################
+class UnitRecord(object):
+    """
+    Turtle state of one instrument
+    """
+    __slots__ = ('state', 'position', 'sl_size', 'rate', 'max_unit_size',
+                 'exposure', 'level', 'fills', 'dirty', 'orders_key')
+
+    def __init__(self):
+        """Initialize flat record"""
+        self.state = FLAT
+        self.position = 0.0
+        self.sl_size = 0.0
+        self.rate = 0.0
+        self.max_unit_size = 0.0
+        self.exposure = 0.0
+        self.level = 1
+        self.fills = 0
+        self.dirty = True
+        self.orders_key = None
+
+
+#####################################################
+class UnitStateMachine(object):
+    """
+    Turtle unit records by instrument key (conId)
+    """
+
+    def __init__(self, min_position=100.0, max_units=4):
+        """
+        Initialize machine. Positions within min_position units of zero
+        count as flat.
+        """
+        self.min_position = min_position
+        self.max_units = max_units
+        self.records = {}  # key -> UnitRecord
+        self.reconciler = FillReconciler()
+
+    def record(self, key):
+        """Returns the record for key, creating it if needed"""
+        record = self.records.get(key)
+        if record is None:
+            record = UnitRecord()
+            self.records[key] = record
+        return record
+
+    def transition(self, record, exit_fill=False):
+        """Moves a record to the state its position implies"""
+        if abs(record.position) <= self.min_position:
+            record.state = FLAT
+        elif exit_fill or record.state == EXITING:
+            record.state = EXITING
+        elif record.position > 0:
+            record.state = LONG
+        else:
+            record.state = SHORT
+
+    def set_position(self, key, position):
+        """Sets key's position (e.g. from its account cash balance)"""
+        record = self.record(key)
+        if key not in self.reconciler.reported:
+            self.reconciler.seed(key, position)
+        else:
+            position = self.reconciler.report(key, position)
+        if position != record.position:
+            record.position = position
+            record.dirty = True
+            self.transition(record)
+
+    def on_fill(self, key, exec_id, shares, order_ref=''):
+        """Applies a fill of signed shares, once per execution"""
+        if not self.reconciler.fill(key, exec_id, shares):
+            return
+        record = self.record(key)
+        record.position = self.reconciler.quantity(key)
+        record.fills += 1
+        record.dirty = True
+        self.transition(record, exit_fill='_sl' in order_ref
+                        or '_exit' in order_ref)
+
+    def update(self, key, sl_size, rate, max_unit_size):
+        """
+        Returns key's record at the start of a cycle, with its exposure
+        and level recomputed if anything behind them changed
+        """
+        record = self.record(key)
+        if record.state == EXITING:
+            # The cycle trades what is left of the position
+            record.state = FLAT
+            self.transition(record)
+        if record.dirty or sl_size != record.sl_size \
+                or rate != record.rate \
+                or max_unit_size != record.max_unit_size:
+            record.sl_size = sl_size
+            record.rate = rate
+            record.max_unit_size = max_unit_size
+            record.exposure = abs(record.position * sl_size * rate)
+            # Units already risked, in quarters of the maximum unit size
+            record.level = self.max_units
+            for n in range(1, self.max_units):
+                if record.exposure < max_unit_size * n / self.max_units:
+                    record.level = n
+                    break
+            record.dirty = False
+        return record
+
+    def unit_full(self, record):
+        """True unless a position has room for more pyramid units"""
+        return record.state == FLAT or \
+            not record.exposure < record.max_unit_size
+
+    def units(self, record):
+        """Returns the units a record holds, negative when short"""
+        if record.state == LONG:
+            return record.level
+        if record.state == SHORT:
+            return -record.level
+        return 0
+
+    def label(self, record):
+        """Returns a record's state, e.g. 'long 2/4'"""
+        if record.state in (LONG, SHORT):
+            return '{} {}/{}'.format(record.state, record.level,
+                                     self.max_units)
+        return record.state
@@ -1,12 +1,38 @@
 #####################################################
+import asyncio
 import datetime
 from ib_insync import *
 from ibapi import *
-import logging
 import pytz
 import sys
 import pandas as pd
-import pandas_ta as ta
+from account_state import AccountState
+from bar_store import BarStore
+from condition_engine import ConditionEngine
+from event_journal import EventJournal
+from fx_rates import FxRateService
+from indicators import turtle_engine
+from order_batch import submit_order_groups, submit_order_groups_async
+from order_book import OrderBook
+from portfolio_risk import PortfolioRisk
+from scheduler import TimerWheel
+from ticker_pool import TickerPool
+from unit_state import FLAT, LONG, SHORT, UnitStateMachine
+
+#####################################################
+# Daily FX bars roll over at 17:00 New York time:
+BAR_CLOSE_TIMEZONE = pytz.timezone('US/Eastern')
+BAR_CLOSE_HOUR = 17
+# Seconds after the daily bar close to run, with --daily
+RUN_DELAY = 60
+# Set to True to hold price-conditioned orders locally, sending them as
+# plain orders when triggered, instead of leaving the conditions to IB
+LOCAL_CONDITIONS = False
+# Journal of decisions, orders, fills, indicators and log messages
+EVENT_JOURNAL = 'IBKRTradingAlgorithm.ndjson'
+# Daily bars the indicators are calculated from
+DAILY_BARS = dict(bar_size='1 day', what_to_show='MIDPOINT',
+                  duration='6 M', use_rth=True)
 
 #####################################################
 # Algorithmic strategy class for interactive brokers:
@@ -15,217 +41,326 @@ class IBAlgoStrategy(object):
     Algorithmic trading strategy for Interactive Brokers
     """
 
-    def __init__(self):
+    def __init__(self, ib=None):
         """Initialize Algorithm"""
-        self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(logging.INFO)
-        self.handler = logging.FileHandler('IBKRTradingAlgorithm.log')
-        self.handler.setLevel(logging.INFO)
-        self.formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        self.handler.setFormatter(self.formatter)
-        self.logger.addHandler(self.handler)
-        self.logger.info('Starting log at {}'.format(datetime.datetime.now()))
-
-        # Connect to IB
-        self.ib = self.connect()
+        self.journal = EventJournal(EVENT_JOURNAL)
+        self.journal.log('Starting log at {}'.format(datetime.datetime.now()))
+
+        # Connect to IB, unless given an IB (e.g. a SimulatedIB) to use
+        self.ib = ib if ib is not None else self.connect()
+
+        # Local store of historical bars, topped up from TWS
+        self.bar_store = BarStore(self.ib)
+
+        # Open trades and fills, kept current from IB events
+        self.order_book = OrderBook(self.ib)
+
+        # Streaming FX conversion rates
+        self.fx_rates = FxRateService(self.ib)
+
+        # Turtle state of each instrument, kept current from fills and
+        # cash balances
+        self.units = UnitStateMachine()
+        self.ib.execDetailsEvent += self.on_fill
+        self.ib.accountValueEvent += self.on_account_value
+
+        # Units held across all instruments, against the Turtle limits
+        self.risk = PortfolioRisk()
+
+        # Locally held price-conditioned orders, triggered by live quotes
+        self.conditions = ConditionEngine(self.ib.placeOrder)
+        if LOCAL_CONDITIONS:
+            self.ticker_pool = TickerPool(self.ib)
+            self.ticker_pool.quoteEvent += self.on_quote
+
+        # Account values, kept current from IB events
+        self.account_state = AccountState(self.ib)
+        self.account_snapshot = self.account_state.snapshot()
 
         # Create empty list of instruments
         self.instruments = []
 
+        # Indicator snapshots keyed by conId: (bar close, indicators)
+        self.indicator_cache = {}
+        # Streaming indicator engines and their per-bar values by conId
+        self.indicator_engines = {}
+        self.indicator_rows = {}
+
         # Run main loop
         self.run()
 
 #####################################################
     def run(self):
         """Run logic for today's trading"""
+        self.begin_cycle()
+
+        for instrument in self.instruments:
+            indicators = self.get_indicators(instrument)
+            self.place_orders(instrument,
+                              self.process_instrument(instrument, indicators))
+
+#####################################################
+    async def run_async(self):
+        """
+        Run logic for today's trading with all instruments concurrently.
+        An error on one instrument is logged and does not stop the others.
+        """
+        self.begin_cycle()
+        results = await asyncio.gather(*[self.run_instrument_async(i)
+                                         for i in self.instruments],
+                                       return_exceptions=True)
+        for instrument, result in zip(self.instruments, results):
+            if isinstance(result, Exception):
+                self.log('Error trading {}: {!r}'
+                         .format(instrument.localSymbol, result))
+
+#####################################################
+    async def run_instrument_async(self, instrument):
+        """Fetches data for, then trades, one instrument"""
+        indicators = await self.get_indicators_async(instrument)
+        # Wait for the conversion rate here, so it is cached for
+        # get_base_exchange rather than waited on in a blocking call
+        base = self.account_snapshot.base_currency
+        await self.fx_rates.rate_async(instrument.localSymbol[-3:], base)
+        groups = self.process_instrument(instrument, indicators)
+        await self.place_orders_async(instrument, groups)
+
+#####################################################
+    def process_instrument(self, instrument, indicators):
+        """Cancels stale orders, returns the order groups to place"""
+        # INITIAL VARIABLE SETUP
+        # Order groups to place
+        groups = []
+        # Turtle state: position, long/short, exposure and pyramid level
+        unit = self.update_unit(instrument, indicators)
+        self.risk.set_units(instrument.conId, self.units.units(unit))
+        self.log('{} is {}'.format(instrument.localSymbol,
+                                   self.units.label(unit)))
+        # Cash balance for current instrument as units of that instrument
+        cash_balance = unit.position
+        # Is the total unit (max 4 entries) full?
+        unit_full = self.units.unit_full(unit)
+        # Are we long/short on this instrument?
+        is_long = unit.state == LONG
+        is_short = unit.state == SHORT
+
+        # Keep the resting orders if nothing they depend on has changed:
+        # the daily bar, fills and state
+        orders_key = (self.get_last_bar_close(), unit.fills, unit.state)
+        if orders_key == unit.orders_key and (
+                (unit.state != FLAT and unit_full)
+                or self.get_open_trades(instrument)):
+            self.log('No change for {}, keeping its orders'
+                     .format(instrument.localSymbol))
+            self.record_decision(instrument, unit, 'keep', groups)
+            return groups
+        unit.orders_key = orders_key
+
+        # If not long or short, place initial entry orders:
+        if not is_long and not is_short:
+            # Fills of a closed position must not anchor the next one
+            self.order_book.clear_fills(instrument.localSymbol)
+            orders = self.get_open_trades(instrument)
+            for o in orders:
+                self.cancel_order(o.order)
+            groups = self.create_initial_entry_orders(instrument, indicators)
+
+        # If there is a unit that is not full:
+        if not unit_full:
+
+            # Save stop information:
+            stops = []
+            for t in self.get_open_trades(instrument):
+                if "sl" in t.order.orderRef:
+                    stops.append(self.place_order(instrument,
+                                 self.ib.client.getReqId(),
+                                 action=t.order.action,
+                                 order_type=t.order.orderType,
+                                 tif=t.order.tif,
+                                 total_quantity=t.order.totalQuantity,
+                                 transmit=t.order.transmit,
+                                 price_condition=t.order.conditions[0].price,
+                                 order_ref=instrument.localSymbol + "_sl_" +
+                                 str(t.order.orderRef)[-1:],
+                                 is_more=t.order.conditions[0].isMore))
+            
+            self.log("Saved stops {}".format(stops))
+
+            # Cancel open (unfilled) orders:
+            for t in self.get_open_trades(instrument):
+                self.cancel_order(t.order)
+
+            # Check how many more entries can be made before unit is full.
+            # i=4 indicates the unit is full.
+            i = unit.level
+
+            # Set compound order offset to be last fill price:
+            last_fill_price = 0
+            for f in self.get_filled_executions(instrument):
+                if f.execution.avgPrice > last_fill_price:
+                    last_fill_price = f.execution.avgPrice
+
+            # If long (>100 units), place compound long and exit orders:
+            if is_long:
+
+                # Create compound orders, as far as portfolio limits allow
+                last_unit = self.get_last_unit(instrument, 1, i)
+                while i < last_unit:
+                    groups.append(self.go_long(
+                        instrument,
+                        indicators,
+                        offset=i,
+                        is_compound_order=True,
+                        last_fill_price=last_fill_price))
+                    i += 1
+
+                # Create exit order
+                long_exit_all = self.go_long(instrument,
+                                             indicators,
+                                             total_quantity=cash_balance,
+                                             is_exit_all=True)
+
+                # Put all stops and exit orders into an OCA:
+                oca = []
+                for s in stops:
+                    oca.append(s)
+                for o in long_exit_all:
+                    oca.append(o)
+                self.ib.oneCancelsAll(orders=oca,
+                                      ocaGroup="OCA_"
+                                      + str(instrument.localSymbol)
+                                      + str(self.ib.client.getReqId()),
+                                      ocaType=2)
+
+                # Queue all orders for placement:
+                groups.append(oca)
+
+            # If short (<100 units), place compound short and exit orders:
+            elif is_short:
+                # Create compound orders, as far as portfolio limits allow
+                last_unit = self.get_last_unit(instrument, -1, i)
+                while i < last_unit:
+                    groups.append(self.go_short(
+                        instrument,
+                        indicators,
+                        offset=i,
+                        is_compound_order=True,
+                        last_fill_price=last_fill_price))
+                    i += 1
+
+                # Create exit order
+                short_exit_all = self.go_short(instrument,
+                                               indicators,
+                                               total_quantity=cash_balance,
+                                               is_exit_all=True)
+
+                # Put all stops and exit orders into an OCA:
+                oca = []
+                for s in stops:
+                    oca.append(s)
+                for o in short_exit_all:
+                    oca.append(o)
+                self.ib.oneCancelsAll(orders=oca,
+                                      ocaGroup="OCA_"
+                                      + str(instrument.localSymbol)
+                                      + str(self.ib.client.getReqId()),
+                                      ocaType=2)
+
+                # Queue all orders for placement:
+                groups.append(oca)
+
+        # VARIABLES USED IN LOGGING ONLY
+        # Current total unit size in base currency.
+        current_unit = round(cash_balance * unit.sl_size * unit.rate)
+        self.log('Currently risking {} base currency on {}'
+                 .format(current_unit, instrument.localSymbol))
+        self.record_decision(instrument, unit,
+                             'enter' if unit.state == FLAT else 'compound',
+                             groups)
+        return groups
+
+####################################################
+    def record_decision(self, instrument, unit, action, groups):
+        """Journals what a cycle decided for an instrument"""
+        self.journal.record('decision',
+                            symbol=instrument.localSymbol,
+                            action=action,
+                            state=unit.state,
+                            position=unit.position,
+                            level=unit.level,
+                            exposure=unit.exposure,
+                            sl_size=unit.sl_size,
+                            rate=unit.rate,
+                            orders=[o.orderRef for g in groups for o in g])
+
+####################################################
+    def update_unit(self, instrument, indicators):
+        """Returns instrument's unit record, for this cycle's ATR and rate"""
+        # Maximum unit size (2% of portfolio) in base currency
+        max_unit_size = self.account_snapshot.get_float(
+            'CashBalance', 'BASE') * float(0.02)
+        return self.units.update(instrument.conId,
+                                 self.get_atr_multiple(instrument,
+                                                       indicators,
+                                                       multiplier=0.5),
+                                 self.get_base_exchange(instrument),
+                                 max_unit_size)
+
+####################################################
+    def get_last_unit(self, instrument, direction, level):
+        """
+        Returns the pyramid level compound orders may be placed up to
+        (from level, at most 4) within the portfolio risk limits
+        """
+        room, limit = self.risk.headroom(instrument.conId, direction)
+        if level + room < 4:
+            self.log('{} {} units capped at {} by the {} limit'.format(
+                instrument.localSymbol, 'Long' if direction > 0 else 'Short',
+                level + room, limit))
+        return min(4, level + room)
+
+####################################################
+    def on_fill(self, trade, fill):
+        """Moves an instrument's unit state on each of its fills"""
+        execution = fill.execution
+        shares = float(execution.shares)
+        if execution.side != 'BOT':
+            shares = -shares
+        self.journal.record('fill',
+                            symbol=fill.contract.localSymbol,
+                            exec_id=execution.execId,
+                            order_id=execution.orderId,
+                            order_ref=execution.orderRef,
+                            shares=shares,
+                            price=execution.price,
+                            exec_time=execution.time)
+        for instrument in self.instruments:
+            if instrument.conId == fill.contract.conId:
+                self.units.on_fill(instrument.conId, execution.execId,
+                                   shares, execution.orderRef)
+
+####################################################
+    def on_account_value(self, value):
+        """Keeps unit positions equal to their currencies' cash balances"""
+        if value.tag != 'CashBalance' \
+                or value.account != self.account_state.account:
+            return
+        for instrument in self.instruments:
+            if instrument.localSymbol[0:3] == value.currency:
+                self.units.set_position(instrument.conId, float(value.value))
+
+####################################################
+    def begin_cycle(self):
+        """Logs the start of a trading cycle and snapshots the account"""
         self.log()
         start_time = datetime.datetime.now(tz=pytz.timezone('Asia/Shanghai'))
         self.log('Beginning to run trading algorithm at {} HKT'
                  .format(start_time))
 
-        for instrument in self.instruments:
-
-            # INITIAL VARIABLE SETUP
-            # Indicators
-            indicators = self.get_indicators(instrument)
-            # Cash balance for current instrument as units of that instrument
-            cash_balance = self.get_cash_balance(instrument)
-            # Is the total unit (max 4 entries) full?
-            unit_full = True
-            # Are we long/short on this instrument?
-            is_long = False
-            is_short = False
-
-            # Maximum unit size (2% of portfolio) in base currency
-            max_unit_size = 0
-            for v in self.ib.accountSummary():
-                if v.currency == 'BASE' and v.tag == 'CashBalance':
-                    max_unit_size = float(v.value) * float(0.02)
-
-            # Check if long or short based on whether >/< 100 units are traded
-            if cash_balance > float(100):
-                is_long = True
-
-            if cash_balance < float(-100):
-                is_short = True
-
-            # Check if current unit is small enough to be not full
-            if abs(self.get_cash_balance(instrument)
-               * self.get_atr_multiple(instrument,
-                                       indicators,
-                                       multiplier=0.5)
-               * self.get_base_exchange(instrument)) < \
-               max_unit_size:
-                if is_long or is_short:
-                    unit_full = False
-
-            # If not long or short, place initial entry orders:
-            if not is_long and not is_short:
-                orders = self.get_open_trades(instrument)
-                for o in orders:
-                    self.ib.cancelOrder(o.order)
-                self.place_initial_entry_orders(instrument, indicators)
-
-            # If there is a unit that is not full:
-            if not unit_full:
-
-                # Save stop information:
-                stops = []
-                for t in self.get_open_trades(instrument):
-                    if "sl" in t.order.orderRef:
-                        stops.append(self.place_order(instrument,
-                                     self.ib.client.getReqId(),
-                                     action=t.order.action,
-                                     order_type=t.order.orderType,
-                                     tif=t.order.tif,
-                                     total_quantity=t.order.totalQuantity,
-                                     transmit=t.order.transmit,
-                                     price_condition=t.order.conditions[0].price,
-                                     order_ref=instrument.localSymbol + "_sl_" +
-                                     str(t.order.orderRef)[-1:],
-                                     is_more=t.order.conditions[0].isMore))
-                
-                self.log("Saved stops {}".format(stops))
-
-                # Cancel open (unfilled) orders:
-                for t in self.get_open_trades(instrument):
-                    self.ib.cancelOrder(t.order)
-
-                # Check how many more entries can be made before unit is full.
-                # i=4 indicates the unit is full.
-                if abs(self.get_cash_balance(instrument)
-                       * self.get_base_exchange(instrument)
-                       * self.get_atr_multiple(instrument,
-                                               indicators,
-                                               multiplier=0.5)) < \
-                   max_unit_size * float(0.25):
-                    i = 1
-                elif abs(self.get_cash_balance(instrument)
-                         * self.get_base_exchange(instrument)
-                         * self.get_atr_multiple(instrument,
-                                                 indicators,
-                                                 multiplier=0.5)) < \
-                        max_unit_size * float(0.5):
-                    i = 2
-                elif abs(self.get_cash_balance(instrument)
-                         * self.get_base_exchange(instrument)
-                         * self.get_atr_multiple(instrument,
-                                                 indicators,
-                                                 multiplier=0.5)) < \
-                        max_unit_size * float(0.75):
-                    i = 3
-                else:
-                    i = 4
-
-                # Set compound order offset to be last fill price:
-                last_fill_price = 0
-                for f in self.get_filled_executions(instrument):
-                    if f.execution.avgPrice > last_fill_price:
-                        last_fill_price = f.execution.avgPrice
-
-                # If long (>100 units), place compound long and exit orders:
-                if is_long:
-
-                    # Create compound orders
-                    while i < 4:
-                        for o in self.go_long(instrument,
-                                              indicators,
-                                              offset=i,
-                                              is_compound_order=True,
-                                              last_fill_price=last_fill_price):
-                            self.ib.placeOrder(instrument, o)
-                            self.ib.sleep(1)
-                        i += 1
-
-                    # Create exit order
-                    long_exit_all = self.go_long(instrument,
-                                                 indicators,
-                                                 total_quantity=cash_balance,
-                                                 is_exit_all=True)
-
-                    # Put all stops and exit orders into an OCA:
-                    oca = []
-                    for s in stops:
-                        oca.append(s)
-                    for o in long_exit_all:
-                        oca.append(o)
-                    self.ib.oneCancelsAll(orders=oca,
-                                          ocaGroup="OCA_"
-                                          + str(instrument.localSymbol)
-                                          + str(self.ib.client.getReqId()),
-                                          ocaType=2)
-
-                    # Place all orders:
-                    for o in oca:
-                        self.ib.placeOrder(instrument, o)
-                        self.ib.sleep(1)
-
-                # If short (<100 units), place compound short and exit orders:
-                elif is_short:
-                    # Create compound orders
-                    while i < 4:
-                        for o in self.go_short(instrument,
-                                               indicators,
-                                               offset=i,
-                                               is_compound_order=True,
-                                               last_fill_price=last_fill_price):
-                            self.ib.placeOrder(instrument, o)
-                            self.ib.sleep(1)
-                        i += 1
-
-                    # Create exit order
-                    short_exit_all = self.go_short(instrument,
-                                                   indicators,
-                                                   total_quantity=cash_balance,
-                                                   is_exit_all=True)
-
-                    # Put all stops and exit orders into an OCA:
-                    oca = []
-                    for s in stops:
-                        oca.append(s)
-                    for o in short_exit_all:
-                        oca.append(o)
-                    self.ib.oneCancelsAll(orders=oca,
-                                          ocaGroup="OCA_"
-                                          + str(instrument.localSymbol)
-                                          + str(self.ib.client.getReqId()),
-                                          ocaType=2)
-
-                    # Place all orders:
-                    for o in oca:
-                        self.ib.placeOrder(instrument, o)
-                        self.ib.sleep(1)
-
-            # VARIABLES USED IN LOGGING ONLY
-            # Current total unit size in base currency.
-            current_unit = round(cash_balance
-                                 * self.get_atr_multiple(instrument,
-                                                         indicators,
-                                                         multiplier=0.5)
-                                 * self.get_base_exchange(instrument))
-            self.log('Currently risking {} base currency on {}'
-                     .format(current_unit, instrument.localSymbol))
+        # Consistent view of the account for this cycle
+        self.account_snapshot = self.account_state.snapshot()
+        self.log('Account values version {}'
+                 .format(self.account_snapshot.version))
 
 ####################################################
     def connect(self):
@@ -248,18 +383,14 @@ class IBAlgoStrategy(object):
 
 #####################################################
     def log(self, msg=""):
-        """Add log to output file"""
-        self.logger.info(msg)
-        print(msg)
+        """Add log to the event journal, and the console"""
+        self.journal.log(msg)
 
 #####################################################
     def get_open_trades(self, instrument):
         """Returns the number of unfilled trades open for a currency"""
-        orders = []
-        self.ib.sleep(1)
-        for t in self.ib.openTrades():
-            if t.contract.localSymbol == instrument.localSymbol:
-                orders.append(t)
+        orders = self.order_book.get_open_trades(instrument.localSymbol) \
+            + self.conditions.get_held(instrument.localSymbol)
         order_count = len(orders)
         self.log('Currently in {} open orders for instrument {}.'
                  .format(order_count, instrument.localSymbol))
@@ -268,12 +399,9 @@ class IBAlgoStrategy(object):
 #####################################################
     def get_filled_executions(self, instrument):
         """Returns the number of filled executions in past week"""
-        fills = []
-        self.ib.sleep(1)
-        for f in self.ib.reqExecutions():
-            if f.contract.localSymbol == instrument.localSymbol:
-                self.log('Found trade with symbol {}: {}'.format(f.contract.localSymbol, f.execution.avgPrice))
-                fills.append(f)
+        fills = self.order_book.get_fills(instrument.localSymbol)
+        for f in fills:
+            self.log('Found trade with symbol {}: {}'.format(f.contract.localSymbol, f.execution.avgPrice))
         fill_count = len(fills)
         self.log('Currently in {} filled trades for instrument {}.'
                  .format(fill_count, instrument.localSymbol))
@@ -294,34 +422,26 @@ class IBAlgoStrategy(object):
 
         self.ib.qualifyContracts(instrument)
         self.instruments.append(instrument)
+        self.risk.add_market(instrument.conId)
+        self.units.set_position(instrument.conId,
+                                self.get_cash_balance(instrument))
+        if LOCAL_CONDITIONS:
+            self.ticker_pool.subscribe(instrument)
 
 #####################################################
     def get_available_funds(self):
         """Returns available funds in USD"""
-        account_values = self.ib.accountValues()
-        available_funds = 0
-        i = 0
-        for value in account_values:
-            if account_values[i].tag == 'AvailableFunds':
-                available_funds = float(account_values[i].value)
-                break
-            i += 1
-        self.log('Available funds: {} {}'.format(available_funds,
-                                                 account_values[i].currency))
+        base = self.account_snapshot.base_currency
+        available_funds = self.account_snapshot.get_float('AvailableFunds',
+                                                          base)
+        self.log('Available funds: {} {}'.format(available_funds, base))
         return available_funds
 
 #####################################################
     def get_cash_balance(self, instrument):
         """Returns current position for currency pair in units"""
-        account_values = self.ib.accountValues()
-        cash_balance = 0
-        i = 0
-        for value in account_values:
-            if account_values[i].tag == 'CashBalance' and \
-               account_values[i].currency == instrument.localSymbol[0:3]:
-                cash_balance = float(account_values[i].value)
-                break
-            i += 1
+        cash_balance = self.account_snapshot.get_float(
+            'CashBalance', instrument.localSymbol[0:3])
         self.log("Current {} cash balance: {} units"
                  .format(instrument.localSymbol[0:3], cash_balance))
         return cash_balance
@@ -332,34 +452,14 @@ class IBAlgoStrategy(object):
         assert (instrument.localSymbol in ['GBP.JPY', 'AUD.CAD', 'EUR.USD']), \
                'Invalid Currency!'
 
-        base = ""
-
-        for v in self.ib.accountValues():
-            if v.tag == 'AvailableFunds':
-                base = v.currency
+        base = self.account_snapshot.base_currency
 
-        if base == instrument.localSymbol[-3:]:
-            return 1
-        elif instrument.localSymbol[-3:] != 'USD':
-            pair = base + instrument.localSymbol[-3:]
-            self.log("Getting current exchange rate for pair {}".format(pair))
-
-            ticker = self.ib.reqMktData(contract=Forex(pair=pair,
-                                                       symbol=base,
-                                                       currency=instrument
-                                                       .localSymbol[-3:]))
-            self.ib.sleep(1)
-            return 1 / ticker.marketPrice()
-        elif instrument.localSymbol[-3:] == 'USD':
-            pair = instrument.localSymbol[-3:] + base
-            self.log("Getting current exchange rate for pair {}".format(pair))
-
-            ticker = self.ib.reqMktData(contract=Forex(pair=pair,
-                                                       symbol=instrument
-                                                       .localSymbol[-3:],
-                                                       currency=base))
-            self.ib.sleep(1)
-            return ticker.marketPrice()
+        # Units of base currency per unit of the instrument's quote currency
+        quote = instrument.localSymbol[-3:]
+        rate = self.fx_rates.rate(quote, base)
+        if self.fx_rates.is_stale(quote, base):
+            self.log("Exchange rate {}/{} is stale".format(quote, base))
+        return rate
 
 #####################################################
     def set_position_size(self, instrument, indicators, sl_size):
@@ -370,11 +470,7 @@ class IBAlgoStrategy(object):
         available_funds = self.get_available_funds()
         equity_at_risk = available_funds * 0.005
 
-        base = ""
-
-        for v in self.ib.accountValues():
-            if v.tag == 'AvailableFunds':
-                base = v.currency
+        base = self.account_snapshot.base_currency
 
         if base == instrument.localSymbol[-3:]:
             position_size = round(equity_at_risk / sl_size)
@@ -388,7 +484,8 @@ class IBAlgoStrategy(object):
 #####################################################
     def get_atr_multiple(self, instrument, indicators, multiplier=0.5):
         """Sets absolute value of SL equal to 1/2 ATR"""
-        indicators = self.get_indicators(instrument)
+        if indicators is None:
+            indicators = self.get_indicators(instrument)
         volatility = indicators['atr'][(indicators.axes[0].stop - 1)]
         sl_size = self.adjust_for_price_increments(instrument,
                                                    multiplier * volatility)
@@ -604,6 +701,13 @@ class IBAlgoStrategy(object):
 #####################################################
     def place_initial_entry_orders(self, instrument, indicators):
         """Places initial long & short order entries with IBKR for instrument"""
+        self.place_orders(instrument,
+                          self.create_initial_entry_orders(instrument,
+                                                           indicators))
+
+#####################################################
+    def create_initial_entry_orders(self, instrument, indicators):
+        """Returns initial long & short order entry groups for instrument"""
         # Trade parameters:
         sl_size = self.get_atr_multiple(instrument, indicators)
         total_quantity = self.set_position_size(instrument,
@@ -622,24 +726,94 @@ class IBAlgoStrategy(object):
                                              sl_size=sl_size,
                                              total_quantity=total_quantity)
 
+        # Drop entries a new unit would breach portfolio limits with:
+        groups = []
+        for orders, direction in [(long_entry_attempts, 1),
+                                  (short_entry_attempts, -1)]:
+            room, limit = self.risk.headroom(instrument.conId, direction)
+            if room > 0:
+                groups.append(orders)
+            else:
+                self.log('Not placing {}, {} limit reached'
+                         .format(orders[0].orderRef, limit))
+
         # Put long and short order entries into OCA:
-        self.ib.oneCancelsAll(orders=[long_entry_attempts[0],
-                                      short_entry_attempts[0]],
-                              ocaGroup="OCA_"
-                              + str(instrument.localSymbol)
-                              + str(self.ib.client.getReqId()),
-                              ocaType=1)
-
-        # Place orders:
-        orders = []
-        for o in long_entry_attempts:
-            orders.append(o)
-        for o in short_entry_attempts:
-            orders.append(o)
+        if len(groups) == 2:
+            self.ib.oneCancelsAll(orders=[long_entry_attempts[0],
+                                          short_entry_attempts[0]],
+                                  ocaGroup="OCA_"
+                                  + str(instrument.localSymbol)
+                                  + str(self.ib.client.getReqId()),
+                                  ocaType=1)
 
-        for o in orders:
-            self.ib.placeOrder(instrument, o)
-            self.ib.sleep(1)
+        return groups
+
+#####################################################
+    def place_orders(self, instrument, groups):
+        """Places bracket/OCA order groups and waits for acknowledgement"""
+        groups = self.hold_conditional_orders(instrument, groups)
+        self.log_acknowledgements(submit_order_groups(self.ib, instrument,
+                                                      groups))
+
+#####################################################
+    async def place_orders_async(self, instrument, groups):
+        """As place_orders(), without blocking the event loop"""
+        groups = self.hold_conditional_orders(instrument, groups)
+        self.log_acknowledgements(await submit_order_groups_async(
+            self.ib, instrument, groups))
+
+#####################################################
+    def hold_conditional_orders(self, instrument, groups):
+        """
+        With LOCAL_CONDITIONS, holds the price-conditioned orders of
+        groups locally. Returns the groups of orders to send to IB.
+        """
+        if not LOCAL_CONDITIONS:
+            return groups
+        groups = [self.conditions.add_group(instrument, orders)
+                  for orders in groups]
+        return [orders for orders in groups if orders]
+
+#####################################################
+    def cancel_order(self, order):
+        """Cancels an order, whether held locally or with IB"""
+        if not self.conditions.cancel(order.orderId):
+            self.ib.cancelOrder(order)
+
+#####################################################
+    def on_quote(self, instrument, bid, ask, mid):
+        """Sends the locally held orders a new quote triggers"""
+        for held in self.conditions.on_price(instrument.conId, mid):
+            self.journal.record('trigger',
+                                symbol=instrument.localSymbol,
+                                order_ref=held.trade.order.orderRef,
+                                level=held.level,
+                                price=mid)
+
+#####################################################
+    def log_acknowledgements(self, placed):
+        """Logs how long TWS took to acknowledge each order group"""
+        for group in placed:
+            refs = [t.order.orderRef for t in group.trades]
+            for trade in group.trades:
+                order = trade.order
+                self.journal.record('order',
+                                    symbol=trade.contract.localSymbol,
+                                    order_id=order.orderId,
+                                    parent_id=order.parentId,
+                                    order_ref=order.orderRef,
+                                    action=order.action,
+                                    quantity=order.totalQuantity,
+                                    trigger=[c.price for c in
+                                             order.conditions],
+                                    oca_group=order.ocaGroup,
+                                    status=trade.orderStatus.status,
+                                    latency=group.latency)
+            if group.latency is None:
+                self.log('Orders {} not acknowledged by TWS'.format(refs))
+            else:
+                self.log('Orders {} acknowledged in {:.3f}s'
+                         .format(refs, group.latency))
 
 #####################################################
     def place_order(self,
@@ -683,41 +857,138 @@ class IBAlgoStrategy(object):
 
         return order
 
+#####################################################
+    def get_last_bar_close(self):
+        """Returns the close time of the most recent completed daily bar"""
+        now = datetime.datetime.now(tz=BAR_CLOSE_TIMEZONE)
+        bar_close = now.replace(hour=BAR_CLOSE_HOUR, minute=0,
+                                second=0, microsecond=0)
+        if now < bar_close:
+            bar_close -= datetime.timedelta(days=1)
+        return bar_close
+
+#####################################################
+    def get_next_bar_close(self):
+        """Returns the close time of the daily bar now forming"""
+        now = datetime.datetime.now(tz=BAR_CLOSE_TIMEZONE)
+        bar_close = now.replace(hour=BAR_CLOSE_HOUR, minute=0,
+                                second=0, microsecond=0)
+        if now >= bar_close:
+            # Localize the next day's close, so DST changes are respected
+            next_day = (now + datetime.timedelta(days=1)).date()
+            bar_close = BAR_CLOSE_TIMEZONE.localize(datetime.datetime(
+                next_day.year, next_day.month, next_day.day, BAR_CLOSE_HOUR))
+        return bar_close
+
+#####################################################
+    def run_daily(self, use_async=False):
+        """
+        Runs after every daily bar close, sleeping in between.
+        Runs until interrupted.
+        """
+        scheduler = TimerWheel()
+
+        def run_cycle():
+            if use_async:
+                self.ib.run(self.run_async())
+            else:
+                self.run()
+            schedule_next()
+
+        def schedule_next():
+            when = self.get_next_bar_close().timestamp() + RUN_DELAY
+            scheduler.schedule(when, run_cycle, name='daily run')
+            self.log('Next run at {}'.format(
+                datetime.datetime.fromtimestamp(when, tz=BAR_CLOSE_TIMEZONE)))
+
+        schedule_next()
+        while True:
+            self.ib.sleep(scheduler.seconds_until_due())
+            scheduler.advance()
+
+#####################################################
+    def invalidate_indicators(self, instrument=None):
+        """Drops cached indicators for instrument (or all instruments)"""
+        if instrument is None:
+            self.indicator_cache.clear()
+        else:
+            self.indicator_cache.pop(instrument.conId, None)
+
 #####################################################
     def get_indicators(self, instrument):
-        """Returns 55 & 20 donchian channels for instrument"""
-        bars = self.ib.reqHistoricalData(contract=instrument,
-                                         endDateTime='',
-                                         durationStr='6 M',
-                                         barSizeSetting='1 day',
-                                         whatToShow='MIDPOINT',
-                                         useRTH=True)
-        df = pd.DataFrame(bars)
-        del df['volume']
-        del df['barCount']
-        del df['average']
-        atr = pd.DataFrame(ta.atr(high=df['high'],
-                           low=df['low'],
-                           close=df['close'],
-                           length=20))
-        long_donchian = pd.DataFrame(ta.donchian(high=df['high'],
-                                                 low=df['low'],
-                                                 upper_length=55,
-                                                 lower_length=55))
-        short_donchian = pd.DataFrame(ta.donchian(high=df['high'],
-                                                  low=df['low'],
-                                                  upper_length=20,
-                                                  lower_length=20))
-        df = pd.concat([df, atr, long_donchian, short_donchian],
-                       axis=1,
-                       join="outer")
-        df.columns.values[5] = 'atr'
-        df.columns.values[6] = 'long_dcl'
-        df.columns.values[7] = 'long_dcm'
-        df.columns.values[8] = 'long_dcu'
-        df.columns.values[9] = 'short_dcl'
-        df.columns.values[10] = 'short_dcm'
-        df.columns.values[11] = 'short_dcu'
+        """Returns cached indicators, recalculated once per daily bar"""
+        bar_close = self.get_last_bar_close()
+        indicators = self.cached_indicators(instrument, bar_close)
+        if indicators is None:
+            df = self.bar_store.get_bars(instrument, **DAILY_BARS)
+            indicators = self.cache_indicators(instrument, bar_close, df)
+        return indicators
+
+#####################################################
+    async def get_indicators_async(self, instrument):
+        """As get_indicators(), without blocking the event loop"""
+        bar_close = self.get_last_bar_close()
+        indicators = self.cached_indicators(instrument, bar_close)
+        if indicators is None:
+            df = await self.bar_store.get_bars_async(instrument,
+                                                     **DAILY_BARS)
+            indicators = self.cache_indicators(instrument, bar_close, df)
+        return indicators
+
+#####################################################
+    def cached_indicators(self, instrument, bar_close):
+        """Returns indicators cached since bar_close, or None"""
+        cached = self.indicator_cache.get(instrument.conId)
+        if cached is not None and cached[0] == bar_close:
+            return cached[1]
+        self.log('New daily bar for {}, recalculating indicators'
+                 .format(instrument.localSymbol))
+        return None
+
+#####################################################
+    def cache_indicators(self, instrument, bar_close, df):
+        """Calculates, caches and journals indicators of daily bars df"""
+        indicators = self.calculate_indicators(instrument, df)
+        self.indicator_cache[instrument.conId] = (bar_close, indicators)
+        self.record_indicators(instrument, indicators)
+        return indicators
+
+#####################################################
+    def record_indicators(self, instrument, indicators):
+        """Journals the latest indicator values of an instrument"""
+        self.journal.record('indicators',
+                            symbol=instrument.localSymbol,
+                            **indicators.iloc[-1].to_dict())
+
+#####################################################
+    def calculate_indicators(self, instrument, df):
+        """Returns 55 & 20 donchian channels for instrument's daily bars"""
+
+        # Feed the engine only the bars it has not seen yet. The last bar
+        # may still be forming, so it is peeked at rather than committed.
+        if instrument.conId not in self.indicator_engines:
+            self.indicator_engines[instrument.conId] = turtle_engine(
+                atr_length=20, long_length=55, short_length=20)
+            self.indicator_rows[instrument.conId] = []
+        engine = self.indicator_engines[instrument.conId]
+        rows = self.indicator_rows[instrument.conId]
+        for bar in df.iloc[:-1].itertuples():
+            if engine.last_date is None or bar.date > engine.last_date:
+                values = engine.update(bar.high, bar.low, bar.close,
+                                       date=bar.date)
+                values['date'] = bar.date
+                rows.append(values)
+        del rows[:-len(df)]
+        # Completed bars also update the portfolio's correlations
+        completed = df.iloc[:-1]
+        self.risk.add_bars(instrument.conId, completed['date'],
+                           completed['close'])
+        last = df.iloc[-1]
+        values = engine.peek(last['high'], last['low'], last['close'])
+        values['date'] = last['date']
+
+        # Columns: date, OHLC, atr, long_dcl/m/u, short_dcl/m/u
+        df = df.merge(pd.DataFrame(rows + [values]), on='date', how='left')
         # self.log(df.tail())
         return df
 
@@ -732,5 +1003,12 @@ if __name__ == '__main__':
     algo.add_instrument('Forex', ticker='EURUSD', symbol='EUR', currency='USD')
     # algo.add_instrument('Forex', ticker='AUDCAD', symbol='AUD', currency='CAD')
 
-    # Run for the day
-    algo.run()
\ No newline at end of file
+    # Run for the day, with --async to trade all instruments concurrently
+    if '--async' in sys.argv:
+        algo.ib.run(algo.run_async())
+    else:
+        algo.run()
+
+    # With --daily, run again after every daily bar close
+    if '--daily' in sys.argv:
+        algo.run_daily(use_async='--async' in sys.argv)
\ No newline at end of file